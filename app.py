@@ -1,22 +1,159 @@
 #!/usr/bin/env python
+import argparse
 import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from multiprocessing.pool import ThreadPool
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import configure_mappers
 from flask import (
+    Blueprint,
     Flask,
-    jsonify,
+    Response,
+    current_app,
     request,
     make_response,
-    abort
+    abort,
+    stream_with_context,
+    url_for
 )
-from flask.ext.sqlalchemy import SQLAlchemy
+
+from cache import LRUCache, RedisBackend, VersionedCache
+from database import SQLAlchemy
+import hierarchy
+import membercounts
+from membership import MembershipIndex
+from metrics import RequestMetrics
+import search
+from serialization import get_backend
+import snapshot
+from validation import Schema, array, error, record, string
+import migrations
 
 ###############################
 #                             #
 # Basic app boilerplate setup #
 #                             #
 ###############################
-app = Flask('user_group_app')
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:////tmp/test.db'
-db = SQLAlchemy(app)
+# Database settings can be overridden from the environment, see the
+# README for what each one does.
+ENV_CONFIG = [
+    ('DATABASE_URL', 'SQLALCHEMY_DATABASE_URI', str),
+    ('DB_POOL_SIZE', 'SQLALCHEMY_POOL_SIZE', int),
+    ('DB_MAX_OVERFLOW', 'SQLALCHEMY_MAX_OVERFLOW', int),
+    ('DB_POOL_TIMEOUT', 'SQLALCHEMY_POOL_TIMEOUT', int),
+    ('DB_POOL_RECYCLE', 'SQLALCHEMY_POOL_RECYCLE', int),
+    ('DB_POOL_PRE_PING', 'DB_POOL_PRE_PING',
+     lambda x: x.lower() in ('1', 'true', 'yes')),
+    ('SQLITE_PROFILE', 'SQLITE_PROFILE', str),
+    ('SQLITE_BUSY_TIMEOUT', 'SQLITE_BUSY_TIMEOUT', int),
+    ('SQLITE_MMAP_SIZE', 'SQLITE_MMAP_SIZE', int),
+    ('DB_REPLICA_URLS', 'DB_REPLICA_URLS',
+     lambda x: [url.strip() for url in x.split(',') if url.strip()]),
+    ('DB_REPLICA_EJECT_SECONDS', 'DB_REPLICA_EJECT_SECONDS', int),
+    ('DB_READ_YOUR_WRITES_SECONDS', 'DB_READ_YOUR_WRITES_SECONDS', float),
+    ('DB_SHARD_URLS', 'DB_SHARD_URLS',
+     lambda x: [url.strip() for url in x.split(',') if url.strip()]),
+]
+db = SQLAlchemy()
+
+# Request latency and SQL instrumentation served at /metrics, off
+# unless METRICS_ENABLED is set.
+metrics = RequestMetrics()
+
+# Every route and request hook of the API, registered on each app
+# create_app() builds.
+api = Blueprint('api', __name__)
+
+READ_PRIMARY_COOKIE = 'read_primary_until'
+
+
+def create_app(config=None):
+    """
+    Builds an app serving the API.  Settings come from the environment,
+    see ENV_CONFIG, then from config, and anything left unset gets its
+    default.  The database isn't touched until the first request, its
+    schema is created or upgraded separately by migrations.upgrade().
+
+    :param config: optional dict of config values
+    :return: flask app
+    """
+    app = Flask('user_group_app')
+    for env_name, config_name, cast in ENV_CONFIG:
+        if env_name in os.environ:
+            app.config[config_name] = cast(os.environ[env_name])
+    app.config.update(config or {})
+    app.config.setdefault('SQLALCHEMY_DATABASE_URI',
+                          'sqlite:////tmp/test.db')
+
+    # With read replicas configured GET requests are served by one of
+    # them, except for a client's requests for this many seconds after
+    # it last wrote something, which go to the primary so it sees its
+    # own writes.
+    app.config.setdefault('DB_READ_YOUR_WRITES_SECONDS', 5)
+
+    # Optional cache for user documents and group member lists, see
+    # get_cache().  CACHE_BACKEND is either 'memory' for a cache local
+    # to each process or 'redis' for one shared by every worker.
+    app.config.setdefault('CACHE_ENABLED', False)
+    app.config.setdefault('CACHE_BACKEND', 'memory')
+    app.config.setdefault('CACHE_MAX_ENTRIES', 10000)
+    app.config.setdefault('CACHE_TTL', 60)
+    app.config.setdefault('CACHE_REDIS_URL', 'redis://localhost:6379/0')
+
+    # Request and response bodies are handled by the fastest JSON
+    # library installed, see serialization.py.  'json' or 'orjson'
+    # picks one.
+    app.config.setdefault('JSON_BACKEND', 'auto')
+
+    # Answer membership checks from an in-memory index instead of the
+    # database.  The index is per process and only sees writes made by
+    # the process it lives in.
+    app.config.setdefault('MEMBERSHIP_INDEX_ENABLED', False)
+
+    # Most userids a single POST /users/_mget may ask for, up to 500
+    # are looked up with one IN clause each for users and their groups.
+    app.config.setdefault('USERS_MGET_MAX_IDS', 500)
+
+    # Index terms GET /users/_search ranks at most, see search.py.
+    # Higher makes results for short prefixes more complete and slower.
+    app.config.setdefault('USERS_SEARCH_MAX_CANDIDATES', 500)
+
+    db.init_app(app)
+    metrics.init_app(app, db)
+    app.register_blueprint(api)
+    return app
+
+# SQLite limits the number of bound parameters in a statement so
+# set based lookups are split into slices of this many values.
+IN_CLAUSE_CHUNK_SIZE = 500
+
+# Largest page a client can ask for when paging through group members
+# and the number of rows fetched per round trip when streaming them.
+MAX_PAGE_SIZE = 1000
+STREAM_BATCH_SIZE = 1000
+
+# Content-Type of newline delimited json bulk bodies and what stands in
+# for their lines that aren't valid json.
+NDJSON_MIMETYPE = 'application/x-ndjson'
+INVALID_JSON = object()
+
+# Most groupids a single POST /groups/_query expression may name.
+MAX_QUERY_TERMS = 64
+
+# Default and largest page of GET /users/_search results and the most
+# words a search may have.
+SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_PAGE_SIZE = 100
+MAX_SEARCH_WORDS = 8
+
+# Longest a GET /changes?wait=<seconds> long-poll is held open and how
+# often it looks for new changes meanwhile.
+CHANGES_MAX_WAIT = 30
+CHANGES_POLL_INTERVAL = 0.5
 
 ###################
 #                 #
@@ -24,9 +161,61 @@ db = SQLAlchemy(app)
 #                 #
 ###################
 user_groups = db.Table('usergroups',
-    db.Column('userid', db.Integer, db.ForeignKey('users.id')),
-    db.Column('groupid', db.Integer, db.ForeignKey('groups.id')),
-    db.PrimaryKeyConstraint('userid', 'groupid')
+    db.Column('userid', db.Integer,
+              db.ForeignKey('users.id', ondelete='CASCADE')),
+    db.Column('groupid', db.Integer,
+              db.ForeignKey('groups.id', ondelete='CASCADE')),
+    db.PrimaryKeyConstraint('userid', 'groupid'),
+    # The primary key only helps user -> groups lookups, this covers
+    # group -> users.
+    db.Index('ix_usergroups_groupid_userid', 'groupid', 'userid')
+)
+
+# Groups nested in groups and every ancestor/descendant pair reachable
+# through them, maintained together by hierarchy.py.
+group_groups = db.Table('groupgroups',
+    db.Column('parentid', db.Integer,
+              db.ForeignKey('groups.id', ondelete='CASCADE')),
+    db.Column('childid', db.Integer,
+              db.ForeignKey('groups.id', ondelete='CASCADE')),
+    db.PrimaryKeyConstraint('parentid', 'childid'),
+    db.Index('ix_groupgroups_childid', 'childid')
+)
+
+group_closure = db.Table('groupclosure',
+    db.Column('ancestor', db.Integer,
+              db.ForeignKey('groups.id', ondelete='CASCADE')),
+    db.Column('descendant', db.Integer,
+              db.ForeignKey('groups.id', ondelete='CASCADE')),
+    db.Column('depth', db.Integer, nullable=False),
+    db.Column('paths', db.Integer, nullable=False),
+    db.PrimaryKeyConstraint('ancestor', 'descendant', 'depth'),
+    # The primary key covers descendants of a group, this ancestors
+    db.Index('ix_groupclosure_descendant_ancestor', 'descendant',
+             'ancestor')
+)
+
+# Every word of each user's userid and names for GET /users/_search,
+# maintained by search.py.
+user_terms = db.Table('userterms',
+    db.Column('term', db.String(32), nullable=False),
+    db.Column('userid', db.Integer,
+              db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False),
+    db.Column('field', db.SmallInteger, nullable=False),
+    # Prefix searches are range scans of the primary key
+    db.PrimaryKeyConstraint('term', 'userid', 'field'),
+    db.Index('ix_userterms_userid', 'userid')
+)
+
+# Append-only log of every user and group written, one row per entity
+# per write, see record_changes().  seq never goes backwards so
+# consumers can sync from the last seq they saw.
+changes = db.Table('changes',
+    db.Column('seq', db.Integer, primary_key=True),
+    db.Column('entity', db.String(8), nullable=False),
+    db.Column('key', db.String(32), nullable=False),
+    db.Column('op', db.String(8), nullable=False),
+    sqlite_autoincrement=True
 )
 
 
@@ -36,6 +225,9 @@ class User(db.Model):
     first_name = db.Column(db.String(32))
     last_name = db.Column(db.String(32))
     userid = db.Column(db.String(32), unique=True)
+    # Bumped by every write that changes the user's document
+    version = db.Column(db.Integer, nullable=False, default=1,
+                        server_default='1')
     groups = db.relationship('Group',
                              secondary=user_groups,
                              backref='users')
@@ -53,6 +245,12 @@ class Group(db.Model):
     __tablename__ = 'groups'
     id = db.Column(db.Integer, primary_key=True)
     groupid = db.Column(db.String(32), unique=True)
+    # Bumped by every write that changes the group's member list
+    version = db.Column(db.Integer, nullable=False, default=1,
+                        server_default='1')
+    # Rows of the group in usergroups, kept by membercounts.adjust()
+    member_count = db.Column(db.Integer, nullable=False, default=0,
+                             server_default='0')
 
     def __init__(self, groupid=None):
         self.groupid = groupid
@@ -60,18 +258,112 @@ class Group(db.Model):
     def __repr__(self):
         return '<Group {}>'.format(self.groupid)
 
+###################
+#                 #
+# Request Schemas #
+#                 #
+###################
+USER_SCHEMA = Schema(record({
+    'userid': string(non_empty=True),
+    'first_name': string(non_empty=True),
+    'last_name': string(non_empty=True),
+    'groups': array(string(), non_empty=True)
+}, required=['userid', 'first_name', 'last_name', 'groups']))
+
+USER_GROUPS_PATCH_SCHEMA = Schema(record({
+    'add': array(string()),
+    'remove': array(string())
+}))
+
+GROUP_SCHEMA = Schema(record({'name': string()}, required=['name']))
+
+GROUP_MEMBERS_SCHEMA = Schema(array(string()))
+
+USERIDS_SCHEMA = Schema(array(string()))
+
+GROUPIDS_SCHEMA = Schema(array(string()))
+
+MEMBERSHIP_CHECK_SCHEMA = Schema(array(record({
+    'userid': string(),
+    'groupid': string()
+}, required=['userid', 'groupid'])))
+
 ##########################
 #                        #
 # API Routes / Endpoints #
 #                        #
 ##########################
-@app.route('/users', methods=['POST'])
+@api.before_app_request
+def route_reads():
+    """
+    Sends GET requests to a read replica unless the client asked for
+    the primary with an X-Read-Primary header or wrote something in the
+    last DB_READ_YOUR_WRITES_SECONDS.
+    """
+    if request.method not in ('GET', 'HEAD'):
+        return
+    if request.headers.get('X-Read-Primary'):
+        return
+
+    try:
+        read_primary_until = float(request.cookies.get(READ_PRIMARY_COOKIE, 0))
+    except ValueError:
+        read_primary_until = 0
+    if read_primary_until > time.time():
+        return
+
+    db.use_replica()
+
+
+@api.after_app_request
+def remember_write(resp):
+    """
+    Marks a client that just wrote something so its next reads go to
+    the primary until the replicas have caught up.
+    """
+    if (request.method not in ('GET', 'HEAD') and resp.status_code < 400
+            and db.get_replica_pool() is not None):
+        seconds = current_app.config['DB_READ_YOUR_WRITES_SECONDS']
+        resp.set_cookie(READ_PRIMARY_COOKIE, repr(time.time() + seconds),
+                        max_age=int(seconds) + 1)
+    return resp
+
+
+@api.app_errorhandler(412)
+def precondition_failed(exc):
+    """
+    Rolls back whatever the request wrote before its If-Match check
+    failed, wherever that check was made, so the response never goes
+    out with half a write pending in the session.
+    """
+    db.session.rollback()
+    return exc
+
+
+@api.app_errorhandler(DBAPIError)
+def replica_failed(exc):
+    """
+    Ejects a replica that failed to answer and runs the request again
+    on the primary.  Errors from the primary are raised as usual.
+    """
+    db.session.rollback()
+    replica = db.use_primary()
+    if replica is None or db.session.info.get('shard'):
+        raise
+
+    db.get_replica_pool().eject(replica)
+    current_app.logger.warning('Ejected read replica %s: %s', replica, exc)
+    return current_app.make_response(current_app.dispatch_request())
+
+
+@api.route('/users', methods=['POST'])
 def new_user():
     user_data = validate_user_data(request.data)
     userid = user_data.get('userid')
     first_name = user_data.get('first_name')
     last_name = user_data.get('last_name')
-    groupids = user_data.get('groups', [])
+    groupids = set(user_data.get('groups', []))
+    db.use_shard(db.shard_for(userid))
 
     # Next see if we already have a user with this userid
     db_user = User.query.filter_by(userid=userid).first()
@@ -79,54 +371,196 @@ def new_user():
         # We already have this user, return "Conflict"
         abort(409)
 
-    # We have a new user but before we create that
-    # we need to make sure the groups exist.
-    db_groups = []
-    for groupid in groupids:
-        db_group = Group.query.filter_by(groupid=groupid).first()
-        if not db_group:
-            # Group doesn't exist so we need to create it
-            db_group = Group(groupid=groupid)
-            db.session.add(db_group)
-            db.session.commit()
-
-        db_groups.append(db_group)
+    # Groups that don't exist yet are created in the same transaction
+    # as the user, so they are logged with it or not created at all.
+    group_ids = get_group_ids(groupids)
 
     # Create a new user and save to the db
     db_user = User(first_name=first_name, last_name=last_name, userid=userid)
-    for db_group in db_groups:
-        db_user.groups.append(db_group)
-
     db.session.add(db_user)
+    db.session.flush()
+    db.session.execute(user_groups.insert(), [
+        {'userid': db_user.id, 'groupid': x} for x in group_ids.values()])
+    membercounts.adjust(db.session,
+                        dict((x, 1) for x in group_ids.values()))
+    search.index_users(db.session,
+                       [(db_user.id, userid, first_name, last_name)])
+    bump_versions(groupids=groupids)
+    record_changes(userids=[userid], groupids=groupids)
     db.session.commit()
+    invalidate_cache(userids=[userid], groupids=groupids)
+    update_membership_index(user_ids=[db_user.id])
 
     # Build a result for the new user response
     return create_user_response(db_user)
 
 
-@app.route('/users/<userid>', methods=['GET'])
+@api.route('/users/_bulk', methods=['POST'])
+def bulk_new_users():
+    records = parse_bulk_data(request.data, request.mimetype)
+    if not isinstance(records, list):
+        bad_request((), 'must be an array')
+
+    # Work out the status of every record up front so that
+    # everything valid can be written in one go.
+    results = []
+    new_users = []
+    seen = set()
+    for user_data in records:
+        if user_data is INVALID_JSON:
+            errors = [error((), 'must be valid json')]
+        else:
+            errors = USER_SCHEMA.errors(user_data)
+        if errors:
+            userid = None
+            if isinstance(user_data, dict):
+                userid = user_data.get('userid')
+            results.append({'userid': userid, 'status': 400,
+                            'result': 'invalid', 'errors': errors})
+            continue
+
+        userid = user_data['userid']
+        results.append({'userid': userid, 'status': 200,
+                        'result': 'created'})
+        if userid in seen:
+            # Duplicated within the request body itself.
+            results[-1].update(status=409, result='conflict')
+            continue
+
+        seen.add(userid)
+        new_users.append((user_data, results[-1]))
+
+    if db.get_shard_binds():
+        by_shard = {}
+        for item in new_users:
+            bind = db.shard_for(item[0]['userid'])
+            by_shard.setdefault(bind, []).append(item)
+        created = on_shards(lambda bind: insert_users(by_shard.get(bind, [])))
+    else:
+        created = [insert_users(new_users)]
+
+    invalidate_cache(userids=[x for shard in created for x in shard[0]],
+                     groupids=set(x for shard in created for x in shard[1]))
+    update_membership_index(user_ids=[x for shard in created
+                                      for x in shard[2]])
+
+    return json_response(results)
+
+
+@api.route('/users/_mget', methods=['POST'])
+def get_users():
+    userids = decode_json(request.data, USERIDS_SCHEMA)
+    max_ids = current_app.config['USERS_MGET_MAX_IDS']
+    if len(userids) > max_ids:
+        bad_request((), 'must not have more than {} userids'.format(max_ids))
+
+    if db.get_shard_binds():
+        by_shard = {}
+        for userid in userids:
+            by_shard.setdefault(db.shard_for(userid), []).append(userid)
+        documents = {}
+        for shard in on_shards(
+                lambda bind: get_user_documents(by_shard.get(bind, []))):
+            documents.update(shard)
+    else:
+        documents = get_user_documents(userids)
+
+    # Users that don't exist are listed with null
+    return json_response(dict((x, documents.get(x)) for x in userids))
+
+
+@api.route('/users/_search', methods=['GET'])
+def search_users():
+    query = request.args.get('q', u'')
+    words = search.tokenize(query)
+    if not words or len(words) > MAX_SEARCH_WORDS:
+        bad_request(('q',), 'must have between 1 and {} words'.format(
+            MAX_SEARCH_WORDS))
+
+    limit = get_number_arg('limit', SEARCH_PAGE_SIZE, 1, MAX_SEARCH_PAGE_SIZE)
+    offset = get_number_arg('offset', 0, 0)
+
+    # One more than the page to know whether there's a next one
+    def find(bind):
+        return search.search(
+            db.session, query, offset + limit + 1,
+            max_candidates=current_app.config['USERS_SEARCH_MAX_CANDIDATES'])
+
+    if db.get_shard_binds():
+        ranked = sorted(x for shard in on_shards(find) for x in shard)
+    else:
+        ranked = find(None)
+
+    resp = json_response([
+        {'userid': userid, 'first_name': first_name, 'last_name': last_name}
+        for _, userid, first_name, last_name
+        in ranked[offset:offset + limit]])
+    if len(ranked) > offset + limit:
+        next_url = url_for('.search_users', q=query, limit=limit,
+                           offset=offset + limit)
+        resp.headers['Link'] = '<{}>; rel="next"'.format(next_url)
+
+    return resp
+
+
+@api.route('/users/<userid>', methods=['GET'])
 def find_user(userid):
-    # See if user exists
-    db_user = User.query.filter_by(userid=userid).first()
-    if not db_user:
-        abort(404)
+    db.use_shard(db.shard_for(userid))
 
-    return create_user_response(db_user)
+    # Clients polling with the ETag they have only need the version
+    if request.if_none_match:
+        row = get_user_version(userid)
+        if row is None:
+            abort(404)
 
+        etag = make_etag(*row)
+        if request.if_none_match.contains_weak(etag):
+            return not_modified(etag)
 
-@app.route('/users/<userid>', methods=['PUT'])
+    cache = get_cache()
+    result, version = None, None
+    if cache:
+        result, version = cache.lookup('user', userid)
+
+    if result is None:
+        # See if user exists
+        document = get_user_document(userid)
+        if not document:
+            abort(404)
+
+        etag, result = document
+        result = pack_etag(etag, get_json_backend().dumps(result))
+        if cache and not reading_replica():
+            cache.store('user', userid, version, result)
+
+    return etag_response(*unpack_etag(result))
+
+
+@api.route('/users/<userid>', methods=['PUT'])
 def modify_user(userid):
+    db.use_shard(db.shard_for(userid))
+
     # See if user exists
     db_user = User.query.filter_by(userid=userid).first()
     if not db_user:
         abort(404)
 
+    old_userid = db_user.userid
+
     user_data = validate_user_data(request.data)
     userid = user_data.get('userid')
+    if db.shard_for(userid) != db.shard_for(old_userid):
+        bad_request(('userid',), "can't move the user to another shard")
+
+    claim_version(User.__table__, db_user.id, db_user.version)
     first_name = user_data.get('first_name')
     last_name = user_data.get('last_name')
     groupids = user_data.get('groups', [])
 
+    if (userid, first_name, last_name) != \
+            (old_userid, db_user.first_name, db_user.last_name):
+        search.index_users(db.session,
+                           [(db_user.id, userid, first_name, last_name)])
     db_user.userid = userid
     db_user.first_name = first_name
     db_user.last_name = last_name
@@ -135,119 +569,256 @@ def modify_user(userid):
     # need to send all the groups a user belongs
     # to and if the group isn't present in the
     # request body then it is deleted, otherwise
-    # it's added.
-
-    # Remove any groups that are associated with the user
-    # that weren't sent in the request body.
-
-    # for group in db_user.groups:
-    #     if group.groupid not in groupids:
-    #         db_user.groups.remove(group)
-    # TODO(imsplitbit): For some reason even though the for loop
-    # above should iterate over all groups for
-    # a user it's not actually doing it.  It gets the first group
-    # and deletes it and then moves on.  I'm doing a while loop to
-    # just delete all groups and then add the user back to groups
-    # passed in the request body.  This is not ideal but I didn't
-    # want to burn too much time on this one problem.  The initial
-    # idea was to remove only groups that were in the db for the user
-    # that wasn't in the submitted groups in the request body.
-
-    while len(db_user.groups) > 0:
-        for group in db_user.groups:
-            db_user.groups.remove(group)
-
-    # Add groups from the request body that aren't in there
-    # already.
-    for groupid in groupids:
-        if groupid not in [x.groupid for x in db_user.groups]:
-            db_group = Group.query.filter_by(groupid=groupid).first()
-            if not db_group:
-                db_group = Group(groupid=groupid)
-                db.session.add(db_group)
-                db.session.commit()
-
-            db_user.groups.append(db_group)
+    # it's added.  Only the difference between what
+    # is stored and what was sent is written.
+    current = get_user_groupids(db_user.id)
+    requested = set(groupids)
+    update_user_groups(db_user.id,
+                       add=requested - current,
+                       remove=current - requested)
+
+    # A new userid shows up in the member list of every group
+    # the user is in, not just the ones that changed.
+    changed = current ^ requested
+    if userid != old_userid:
+        changed = current | requested
+    bump_versions(groupids=changed)
+    deleted = [old_userid] if userid != old_userid else []
+    record_changes(userids=[userid], groupids=changed,
+                   deleted_userids=deleted)
 
     db.session.add(db_user)
     db.session.commit()
+    invalidate_cache(userids=[old_userid, db_user.userid], groupids=changed)
+    update_membership_index(user_ids=[db_user.id])
 
     return create_user_response(db_user)
 
 
-@app.route('/users/<userid>', methods=['DELETE'])
-def delete_user(userid):
+@api.route('/users/<userid>/groups', methods=['PATCH'])
+def patch_user_groups(userid):
+    db.use_shard(db.shard_for(userid))
+
     # See if user exists
     db_user = User.query.filter_by(userid=userid).first()
     if not db_user:
         abort(404)
 
-    db.session.delete(db_user)
+    data = decode_json(request.data, USER_GROUPS_PATCH_SCHEMA)
+    add = data.get('add', [])
+    remove = data.get('remove', [])
+    both = sorted(set(add) & set(remove))
+    if both:
+        bad_request(('remove',), 'must not also be added: {}'.format(
+            ', '.join(both)))
+
+    claim_version(User.__table__, db_user.id, db_user.version)
+    current = get_user_groupids(db_user.id)
+    add = set(add) - current
+    remove = set(remove) & current
+    update_user_groups(db_user.id, add=add, remove=remove)
+    bump_versions(groupids=add | remove)
+    record_changes(userids=[db_user.userid], groupids=add | remove)
     db.session.commit()
+    invalidate_cache(userids=[db_user.userid], groupids=add | remove)
+    update_membership_index(user_ids=[db_user.id])
+
+    return create_user_response(db_user)
+
+
+@api.route('/users/<userid>', methods=['DELETE'])
+def delete_user(userid):
+    db.use_shard(db.shard_for(userid))
+
+    # See if user exists
+    row = get_user_version(userid)
+    if row is None:
+        abort(404)
+
+    # Memberships are removed by the database through ON DELETE CASCADE
+    user_id, version = row
+    user_table = User.__table__
+    groupids = get_user_groupids(user_id)
+    membercounts.adjust(db.session, dict(
+        (x, -1) for x in lookup_group_ids(groupids).values()))
+    claim_row(user_table.delete(), user_table, user_id, version)
+    bump_versions(groupids=groupids)
+    record_changes(groupids=groupids, deleted_userids=[userid])
+    db.session.commit()
+    invalidate_cache(userids=[userid], groupids=groupids)
+    update_membership_index(removed_user_ids=[user_id])
 
     return make_response('', 200)
 
 
-@app.route('/groups/<groupid>', methods=['GET'])
+@api.route('/groups/<groupid>', methods=['GET'])
 def list_group(groupid):
+    if db.get_shard_binds():
+        return list_sharded_group(groupid)
+
+    paginated = 'limit' in request.args or 'after' in request.args
+    whole = not (paginated or 'stream' in request.args)
+
+    # Clients polling with the ETag they have only need the version
+    if whole and request.if_none_match:
+        row = get_group_version(groupid)
+        if row is None:
+            abort(404)
+
+        etag = make_etag(*row)
+        if request.if_none_match.contains_weak(etag):
+            return not_modified(etag)
+
+    cache = get_cache() if whole else None
+    if cache:
+        result, version = cache.lookup('group', groupid)
+        if result is not None:
+            return etag_response(*unpack_etag(result))
+
     # See if the group exists
-    db_group = Group.query.filter_by(groupid=groupid).first()
-    if not db_group:
+    row = get_group_version(groupid)
+    if row is None:
         abort(404)
 
-    result = [x.userid for x in db_group.users]
-    return make_response(json.dumps(result), 200)
+    group_id = row[0]
+    if 'stream' in request.args:
+        return Response(stream_with_context(stream_group_members(group_id)),
+                        mimetype='application/json')
 
+    if whole:
+        query = group_members_query(group_id)
+        rows = db.session.execute(query)
+        result = get_json_backend().dumps([x[0] for x in rows])
+        result = pack_etag(make_etag(*row), result)
+        if cache and not reading_replica():
+            cache.store('group', groupid, version, result)
+        return etag_response(*unpack_etag(result))
 
-@app.route('/groups/<groupid>', methods=['DELETE'])
+    # Keyset pagination, the page starts after the given userid
+    limit, after_id = get_page_args()
+    query = group_members_query(group_id, after_id=after_id)
+    return make_page_response(query, limit, '.list_group', groupid=groupid)
+
+
+@api.route('/groups/<groupid>', methods=['DELETE'])
 def delete_group(groupid):
+    if db.get_shard_binds():
+        return delete_sharded_group(groupid)
+
     # See if the group exists
-    db_group = Group.query.filter_by(groupid=groupid).first()
-    if not db_group:
+    row = get_group_version(groupid)
+    if row is None:
         abort(404)
 
-    db.session.delete(db_group)
+    # Memberships are removed by the database through ON DELETE CASCADE
+    group_id, version = row
+    group_table = Group.__table__
+    userids = [x[0] for x in
+               db.session.execute(group_members_query(group_id))]
+
+    # The cascade would drop the group's own closure rows but not the
+    # paths that went through it.
+    parents, children = hierarchy.get_edges(db.session, group_id)
+    for parent_id in parents:
+        hierarchy.remove_edge(db.session, parent_id, group_id)
+    for child_id in children:
+        hierarchy.remove_edge(db.session, group_id, child_id)
+
+    claim_row(group_table.delete(), group_table, group_id, version)
+    bump_versions(userids=userids)
+    record_changes(userids=userids, groupids=get_groupids(parents),
+                   deleted_groupids=[groupid])
     db.session.commit()
+    invalidate_cache(userids=userids, groupids=[groupid])
+    update_membership_index(removed_group_ids=[group_id])
 
     return make_response('', 200)
 
 
-@app.route('/groups/<groupid>', methods=['PUT'])
+@api.route('/groups/<groupid>', methods=['PUT'])
 def modify_group(groupid):
+    if db.get_shard_binds():
+        return modify_sharded_group(groupid)
+
     # See if the group exists
-    db_group = Group.query.filter_by(groupid=groupid).first()
-    if not db_group:
+    row = get_group_version(groupid)
+    if row is None:
         abort(404)
 
-    users = json.loads(request.data)
-    for user in db_group.users:
-        if user.userid not in users:
-            db_group.users.remove(user)
-
-    for userid in users:
-        if userid not in [x.userid for x in db_group.users]:
-            db_user = User.query.filter_by(userid=userid).first()
-            if db_user:
-                db_group.users.append(db_user)
-
-    db.session.add(db_group)
+    group_id, version = row
+    users = decode_json(request.data, GROUP_MEMBERS_SCHEMA)
+    claim_version(Group.__table__, group_id, version)
+    requested, changed = replace_group_members(group_id, users)
+    bump_versions(userids=changed)
+    record_changes(userids=changed, groupids=[groupid])
     db.session.commit()
+    invalidate_cache(userids=changed, groupids=[groupid])
+    update_membership_index(group_ids=[group_id])
+
+    row = get_group_version(groupid)
+    query = group_members_query(group_id)
+    resp = json_response([x[0] for x in db.session.execute(query)])
+    resp.set_etag(make_etag(*row))
+
+    # Userids that don't exist can't be added, let the client know
+    # which ones were skipped.
+    unknown = sorted(set(users) - set(requested))
+    if unknown:
+        resp.headers['X-Unknown-Userids'] = json.dumps(unknown)
+
+    return resp
+
+
+@api.route('/groups', methods=['GET'])
+def list_groups():
+    limit = get_number_arg('limit', MAX_PAGE_SIZE, 1, MAX_PAGE_SIZE)
+
+    # Keyset pagination, the page starts after the given groupid
+    after = request.args.get('after')
+    if db.get_shard_binds():
+        # Every group on the merged page is on the first page of each
+        # shard it's on, its count is the sum of theirs.
+        counts = Counter()
+        for shard in on_shards(
+                lambda bind: get_group_counts(after, limit + 1)):
+            counts.update(dict(shard))
+        page = sorted(counts.items())[:limit + 1]
+    else:
+        # One more than the page to know whether there's a next one
+        page = get_group_counts(after, limit + 1)
+
+    resp = json_response([{'groupid': groupid, 'member_count': count}
+                          for groupid, count in page[:limit]])
+    if len(page) > limit:
+        next_url = url_for('.list_groups', after=page[limit - 1][0],
+                           limit=limit)
+        resp.headers['Link'] = '<{}>; rel="next"'.format(next_url)
+
+    return resp
+
+
+@api.route('/groups/<groupid>/stats', methods=['GET'])
+def group_stats(groupid):
+    if db.get_shard_binds():
+        rows = on_shards(lambda bind: get_group_stats(groupid))
+    else:
+        rows = [get_group_stats(groupid)]
+
+    rows = [x for x in rows if x is not None]
+    if not rows:
+        abort(404)
 
-    return make_response(json.dumps([x.userid for x in db_group.users]), 200)
+    return json_response({'groupid': groupid,
+                          'member_count': sum(x[0] for x in rows),
+                          'subgroup_count': sum(x[1] for x in rows)})
 
 
-@app.route('/groups', methods=['POST'])
+@api.route('/groups', methods=['POST'])
 def add_group():
-    data = json.loads(request.data)
-
-    # Do some basic validation
-    if 'name' not in data:
-        abort(400)
-
-    if not isinstance(data['name'], unicode):
-        abort(400)
-
+    data = decode_json(request.data, GROUP_SCHEMA)
     groupid = data.get('name')
+    if db.get_shard_binds():
+        return add_sharded_group(groupid)
 
     # See if the group exists already
     db_group = Group.query.filter_by(groupid=groupid).first()
@@ -256,10 +827,240 @@ def add_group():
 
     db_group = Group(groupid=groupid)
     db.session.add(db_group)
+    record_changes(groupids=[groupid])
     db.session.commit()
+    invalidate_cache(groupids=[groupid])
+    update_membership_index(group_ids=[db_group.id])
+
+    return json_response([x.userid for x in db_group.users])
+
+
+@api.route('/groups/<groupid>/groups', methods=['GET'])
+def list_subgroups(groupid):
+    if db.get_shard_binds():
+        abort(501)
+
+    row = get_group_version(groupid)
+    if row is None:
+        abort(404)
+
+    return json_response(get_subgroupids(row[0]))
+
+
+@api.route('/groups/<groupid>/groups', methods=['PUT'])
+def modify_subgroups(groupid):
+    if db.get_shard_binds():
+        abort(501)
+
+    row = get_group_version(groupid)
+    if row is None:
+        abort(404)
+
+    group_id = row[0]
+    subgroupids = decode_json(request.data, GROUPIDS_SCHEMA)
+
+    # Written first so the cycle checks below can't race another write
+    # to the hierarchy, SQLite only has one writer at a time.
+    record_changes(groupids=[groupid])
+
+    # Work out the difference between the stored and requested
+    # subgroups and only write that.
+    requested = lookup_group_ids(subgroupids)
+    _, current = hierarchy.get_edges(db.session, group_id)
+    current = set(current)
+    for child_id in current - set(requested.values()):
+        hierarchy.remove_edge(db.session, group_id, child_id)
+
+    for i, subgroupid in enumerate(subgroupids):
+        child_id = requested.get(subgroupid)
+        if child_id is None or child_id in current:
+            continue
+
+        if hierarchy.would_cycle(db.session, group_id, child_id):
+            db.session.rollback()
+            abort(json_response({'errors': [
+                error((i,), 'would make {} a group of itself'.format(
+                    groupid))
+            ]}, 409))
+
+        hierarchy.add_edge(db.session, group_id, child_id)
+        current.add(child_id)
+
+    db.session.commit()
+
+    resp = json_response(get_subgroupids(group_id))
+
+    # Groups that don't exist can't be nested, let the client know
+    # which ones were skipped.
+    unknown = sorted(set(subgroupids) - set(requested))
+    if unknown:
+        resp.headers['X-Unknown-Groupids'] = json.dumps(unknown)
+
+    return resp
+
+
+@api.route('/groups/<groupid>/members', methods=['GET'])
+def list_effective_members(groupid):
+    if db.get_shard_binds():
+        abort(501)
+
+    row = get_group_version(groupid)
+    if row is None:
+        abort(404)
+
+    query = effective_members_query(row[0], get_max_depth())
+    return json_response([x[0] for x in db.session.execute(query)])
 
-    result = [x.userid for x in db_group.users]
-    return make_response(json.dumps(result), 200)
+
+@api.route('/users/<userid>/groups', methods=['GET'])
+def list_effective_groups(userid):
+    if db.get_shard_binds():
+        abort(501)
+
+    user_id = get_user_id(userid)
+    if user_id is None:
+        abort(404)
+
+    query = effective_groups_query(user_id, get_max_depth())
+    return json_response([x[0] for x in db.session.execute(query)])
+
+
+@api.route('/groups/_query', methods=['POST'])
+def query_groups():
+    if db.get_shard_binds():
+        # Would need paging cursors spanning every shard
+        abort(501)
+
+    expr = decode_json(request.data)
+    errors = []
+    groupids = parse_group_expression(expr, errors=errors)
+    if groupids is None:
+        abort(json_response({'errors': errors}, 400))
+
+    # Every group named in the expression has to exist
+    group_ids = lookup_group_ids(groupids)
+    if len(group_ids) != len(set(groupids)):
+        abort(404)
+
+    if 'stream' in request.args:
+        query = group_expression_query(expr, group_ids)
+        return Response(stream_with_context(stream_userids(query)),
+                        mimetype='application/json')
+
+    limit, after_id = get_page_args()
+    query = group_expression_query(expr, group_ids, after_id=after_id)
+    return make_page_response(query, limit, '.query_groups')
+
+
+@api.route('/groups/<groupid>/members/<userid>', methods=['GET'])
+def check_membership(groupid, userid):
+    member = is_member([(userid, groupid)])[0]
+    if member is None:
+        # Either the user or the group doesn't exist
+        abort(404)
+
+    return json_response({'userid': userid, 'groupid': groupid,
+                          'member': member})
+
+
+@api.route('/memberships/_check', methods=['POST'])
+def check_memberships():
+    pairs = decode_json(request.data, MEMBERSHIP_CHECK_SCHEMA)
+    members = is_member([(x['userid'], x['groupid']) for x in pairs])
+    result = [{'userid': x['userid'], 'groupid': x['groupid'], 'member': m}
+              for x, m in zip(pairs, members)]
+    return json_response(result)
+
+
+@api.route('/changes', methods=['GET'])
+def list_changes():
+    if db.get_shard_binds():
+        # Every shard has a change log of its own
+        abort(501)
+
+    since = get_number_arg('since', 0)
+    limit = get_number_arg('limit', MAX_PAGE_SIZE, 1, MAX_PAGE_SIZE)
+    wait = get_number_arg('wait', 0, 0, number=float)
+
+    # Long-poll: hold the request until something changes or the wait
+    # is over, giving the connection back to the pool in between.
+    deadline = time.time() + min(wait, CHANGES_MAX_WAIT)
+    while True:
+        result = get_changes(since, limit)
+        if result or time.time() >= deadline:
+            break
+
+        db.session.rollback()
+        time.sleep(max(0, min(CHANGES_POLL_INTERVAL,
+                              deadline - time.time())))
+
+    return json_response({
+        'changes': result,
+        'next': result[-1]['seq'] if result else since,
+        'latest': db.session.execute(
+            db.select([db.func.max(changes.c.seq)])).scalar() or 0
+    })
+
+
+@api.route('/export', methods=['GET'])
+def export():
+    if db.get_shard_binds():
+        abort(501)
+
+    # The snapshot reads through its own connection rather than the
+    # session, the request context is only kept for the metrics.
+    fmt = request.args.get('format', 'ndjson')
+    if fmt == 'ndjson':
+        chunks = snapshot.export_ndjson(db.engine,
+                                        dumps=get_json_backend().dumps)
+        return Response(stream_with_context(chunks),
+                        mimetype=NDJSON_MIMETYPE)
+
+    if fmt == 'binary':
+        return Response(stream_with_context(
+            snapshot.export_binary(db.engine)),
+            mimetype='application/octet-stream')
+
+    bad_request(('format',), 'must be ndjson or binary')
+
+
+@api.route('/_cache/stats', methods=['GET'])
+def cache_stats():
+    cache = get_cache()
+    if not cache:
+        abort(404)
+
+    return json_response(cache.stats())
+
+
+@api.route('/metrics', methods=['GET'])
+def get_metrics():
+    if not current_app.config['METRICS_ENABLED']:
+        abort(404)
+
+    extra = []
+    cache = get_cache()
+    if cache:
+        stats = cache.stats()
+        for name in ('hits', 'misses', 'errors', 'evictions', 'expirations',
+                     'size', 'max_entries'):
+            if name in stats:
+                extra.append(('cache_{}'.format(name),
+                              'Cache {}.'.format(name.replace('_', ' ')),
+                              'gauge', stats[name]))
+
+    pool = db.get_replica_pool()
+    if pool is not None:
+        stats = pool.stats()
+        extra.append(('db_replicas_ejected', 'Read replicas ejected now.',
+                      'gauge', len(stats['ejected'])))
+        extra.append(('db_replica_ejections_total',
+                      'Read replicas ejected since startup.', 'counter',
+                      stats['ejections']))
+
+    resp = make_response(metrics.render(extra), 200)
+    resp.mimetype = 'text/plain'
+    return resp
 
 
 ##################
@@ -267,6 +1068,221 @@ def add_group():
 # Helper Methods #
 #                #
 ##################
+def get_cache():
+    """
+    Returns the app's cache, creating it from the CACHE_* config
+    values the first time it's needed.
+
+    :return: VersionedCache or None when caching is disabled
+    """
+    config = current_app.config
+    if not config['CACHE_ENABLED']:
+        return None
+
+    cache = current_app.extensions.get('user_group_cache')
+    if cache is None:
+        if config['CACHE_BACKEND'] == 'redis':
+            backend = RedisBackend.from_url(config['CACHE_REDIS_URL'],
+                                            ttl=config['CACHE_TTL'])
+        else:
+            backend = LRUCache(max_entries=config['CACHE_MAX_ENTRIES'],
+                               ttl=config['CACHE_TTL'])
+        cache = VersionedCache(backend)
+        current_app.extensions['user_group_cache'] = cache
+
+    return cache
+
+
+def reading_replica():
+    """
+    Documents read from a replica may predate the latest write, so they
+    must not be cached under the version the cache is at now.
+
+    :return: True when the current request reads from a replica
+    """
+    return bool(db.session.info.get('replica'))
+
+
+def invalidate_cache(userids=(), groupids=()):
+    """
+    Moves the users and groups touched by a write to a new cache
+    version so no worker serves their old documents or member lists.
+    Called after the write is committed.
+
+    :param userids: userids whose documents changed
+    :param groupids: groupids whose member lists changed
+    """
+    cache = get_cache()
+    if not cache:
+        return
+
+    cache.invalidate('user', userids)
+    cache.invalidate('group', groupids)
+
+
+_membership_index_lock = threading.Lock()
+
+
+def get_membership_index(build=True):
+    """
+    Returns the app's membership index, loading it from the database
+    the first time it's needed.
+
+    :param build: load the index if it hasn't been loaded yet
+    :return: MembershipIndex or None when the index is disabled, or
+             hasn't been loaded and build is False
+    """
+    # users.id and groups.id are only unique within a shard
+    if (not current_app.config['MEMBERSHIP_INDEX_ENABLED'] or
+            db.get_shard_binds()):
+        return None
+
+    index = current_app.extensions.get('membership_index')
+    if index is None and build:
+        with _membership_index_lock:
+            index = current_app.extensions.get('membership_index')
+            if index is None:
+                index = load_membership_index()
+                current_app.extensions['membership_index'] = index
+
+    return index
+
+
+def load_membership_index():
+    """
+    :return: MembershipIndex holding every user, group and membership
+    """
+    user_table = User.__table__
+    group_table = Group.__table__
+    # Always from the primary, a lagging replica would leave the index
+    # missing writes it will never see again.
+    conn = db.session.connection(bind=db.engine).execution_options(
+        stream_results=True)
+    index = MembershipIndex()
+    index.load(
+        conn.execute(db.select([user_table.c.id, user_table.c.userid])),
+        conn.execute(db.select([group_table.c.id, group_table.c.groupid])),
+        conn.execute(db.select([user_groups.c.userid,
+                                user_groups.c.groupid])))
+    return index
+
+
+def update_membership_index(user_ids=(), group_ids=(), removed_user_ids=(),
+                            removed_group_ids=()):
+    """
+    Re-reads the memberships of users and groups touched by a write
+    into the membership index.  Called after the write is committed.
+
+    :param user_ids: users.id of users whose groups changed
+    :param group_ids: groups.id of groups whose members changed
+    :param removed_user_ids: users.id of deleted users
+    :param removed_group_ids: groups.id of deleted groups
+    """
+    user_table = User.__table__
+    group_table = Group.__table__
+    # The index is only looked for once the lock is held.  A load that
+    # is under way may have read the database before this write was
+    # committed, so the update waits for it rather than being skipped.
+    # Without a load under way, the next one will see the write.
+    with _membership_index_lock:
+        index = get_membership_index(build=False)
+        if index is None:
+            return
+
+        for user_id in removed_user_ids:
+            index.remove_user(user_id)
+
+        for group_id in removed_group_ids:
+            index.remove_group(group_id)
+
+        for chunk in chunked(list(user_ids)):
+            users = {}
+            joined = user_table.outerjoin(
+                user_groups, user_groups.c.userid == user_table.c.id
+            ).outerjoin(
+                group_table, group_table.c.id == user_groups.c.groupid)
+            rows = db.session.execute(
+                db.select([user_table.c.id, user_table.c.userid,
+                           group_table.c.id, group_table.c.groupid])
+                .select_from(joined)
+                .where(user_table.c.id.in_(chunk)))
+            for user_id, userid, group_id, groupid in rows:
+                groups = users.setdefault((user_id, userid), [])
+                if group_id is not None:
+                    groups.append((group_id, groupid))
+
+            for (user_id, userid), groups in users.items():
+                index.set_user(user_id, userid, groups)
+
+        for chunk in chunked(list(group_ids)):
+            groups = {}
+            joined = group_table.outerjoin(
+                user_groups, user_groups.c.groupid == group_table.c.id
+            ).outerjoin(
+                user_table, user_table.c.id == user_groups.c.userid)
+            rows = db.session.execute(
+                db.select([group_table.c.id, group_table.c.groupid,
+                           user_table.c.id, user_table.c.userid])
+                .select_from(joined)
+                .where(group_table.c.id.in_(chunk)))
+            for group_id, groupid, user_id, userid in rows:
+                users = groups.setdefault((group_id, groupid), [])
+                if user_id is not None:
+                    users.append((user_id, userid))
+
+            for (group_id, groupid), users in groups.items():
+                index.set_group(group_id, groupid, users)
+
+
+def is_member(pairs):
+    """
+    Answers membership checks from the membership index when it's
+    enabled, otherwise with one lookup of the users, the groups and
+    the usergroups rows between them.
+
+    :param pairs: list of (userid, groupid) tuples
+    :return: list of True, False or None where the user or group
+             doesn't exist, in the same order as pairs
+    """
+    index = get_membership_index()
+    if index is not None:
+        return [index.is_member(userid, groupid) for userid, groupid in pairs]
+
+    if db.get_shard_binds():
+        return is_member_sharded(pairs)
+
+    return query_memberships(pairs)
+
+
+def query_memberships(pairs):
+    """
+    :param pairs: list of (userid, groupid) tuples
+    :return: list of True, False or None where the user or group
+             doesn't exist, in the same order as pairs
+    """
+    user_ids = get_user_ids(x[0] for x in pairs)
+    group_ids = lookup_group_ids(x[1] for x in pairs)
+    found = set()
+    wanted_users = list(set(user_ids.values()))
+    wanted_groups = list(set(group_ids.values()))
+    for chunk in chunked(wanted_users):
+        for groups in chunked(wanted_groups):
+            rows = db.session.execute(
+                db.select([user_groups.c.userid, user_groups.c.groupid])
+                .where(db.and_(user_groups.c.userid.in_(chunk),
+                               user_groups.c.groupid.in_(groups))))
+            found.update((x[0], x[1]) for x in rows)
+
+    result = []
+    for userid, groupid in pairs:
+        if userid not in user_ids or groupid not in group_ids:
+            result.append(None)
+        else:
+            result.append((user_ids[userid], group_ids[groupid]) in found)
+
+    return result
+
+
 def create_user_response(db_user):
     result = {
         'first_name': db_user.first_name,
@@ -274,7 +1290,341 @@ def create_user_response(db_user):
         'userid': db_user.userid,
         'groups': [x.groupid for x in db_user.groups]
     }
-    return make_response(jsonify(result), 200)
+    resp = json_response(result)
+    resp.set_etag(make_etag(db_user.id, db_user.version))
+    return resp
+
+
+def get_user_document(userid):
+    """
+    Builds the user response body straight from a single joined column
+    query so no ORM objects have to be created for the user or its
+    groups.
+
+    :param userid: userid of the user to look up
+    :return: tuple of the document's ETag and a dict matching
+             create_user_response, or None if the user doesn't exist
+    """
+    user_table = User.__table__
+    group_table = Group.__table__
+    rows = db.session.execute(
+        db.select([user_table.c.first_name,
+                   user_table.c.last_name,
+                   user_table.c.userid,
+                   group_table.c.groupid,
+                   user_table.c.id,
+                   user_table.c.version])
+        .select_from(user_table
+                     .outerjoin(user_groups,
+                                user_groups.c.userid == user_table.c.id)
+                     .outerjoin(group_table,
+                                group_table.c.id == user_groups.c.groupid))
+        .where(user_table.c.userid == userid)).fetchall()
+    if not rows:
+        return None
+
+    first_name, last_name, userid, _, user_id, version = rows[0]
+    return make_etag(user_id, version), {
+        'first_name': first_name,
+        'last_name': last_name,
+        'userid': userid,
+        'groups': [x[3] for x in rows if x[3] is not None]
+    }
+
+
+def get_user_documents(userids):
+    """
+    Builds the documents of many users with one query for the users and
+    one for the groupids of all of them, per IN_CLAUSE_CHUNK_SIZE users.
+
+    :param userids: iterable of userid strings
+    :return: dict of userid -> dict matching create_user_response for
+             the users that exist
+    """
+    user_table = User.__table__
+    group_table = Group.__table__
+    documents = {}
+    for chunk in chunked(list(set(userids))):
+        rows = db.session.execute(
+            db.select([user_table.c.id, user_table.c.userid,
+                       user_table.c.first_name, user_table.c.last_name])
+            .where(user_table.c.userid.in_(chunk)))
+        for user_id, userid, first_name, last_name in rows:
+            documents[user_id] = {
+                'first_name': first_name,
+                'last_name': last_name,
+                'userid': userid,
+                'groups': []
+            }
+
+    for chunk in chunked(list(documents)):
+        rows = db.session.execute(
+            db.select([user_groups.c.userid, group_table.c.groupid])
+            .select_from(user_groups.join(
+                group_table, group_table.c.id == user_groups.c.groupid))
+            .where(user_groups.c.userid.in_(chunk)))
+        for user_id, groupid in rows:
+            documents[user_id]['groups'].append(groupid)
+
+    return dict((x['userid'], x) for x in documents.values())
+
+
+def get_json_backend():
+    """
+    Returns the app's JSON backend, picking it from the JSON_BACKEND
+    config value the first time it's needed.
+
+    :return: backend from serialization.py
+    """
+    backend = current_app.extensions.get('json_backend')
+    if backend is None:
+        backend = get_backend(current_app.config['JSON_BACKEND'])
+        current_app.extensions['json_backend'] = backend
+
+    return backend
+
+
+def json_response(data, status=200):
+    """
+    Encodes data straight into the body of a json response.
+
+    :param data: object to encode
+    :param status: HTTP status code
+    :return: response
+    """
+    body = get_json_backend().dumps(data)
+    return Response(body, status, mimetype='application/json')
+
+
+def bad_request(path, message):
+    """
+    Aborts with an HTTP Status Code of 400 ("Bad Request") and an
+    "errors" body like the one decode_json() sends.
+
+    :param path: tuple of keys leading to the invalid body value or the
+                 name of the invalid query argument, () for the body
+    :param message: what is wrong with it
+    """
+    abort(json_response({'errors': [error(path, message)]}, 400))
+
+
+def get_number_arg(name, default, minimum=None, maximum=None, number=int):
+    """
+    Reads a numeric query argument of the current request, aborting
+    with a 400 naming it when it isn't a number in range.
+
+    :param name: name of the query argument
+    :param default: returned when the argument isn't given
+    :param minimum: smallest value allowed, None for no limit
+    :param maximum: largest value allowed, None for no limit
+    :param number: int for whole numbers, float for any
+    :return: value of the argument
+    """
+    if name not in request.args:
+        return default
+
+    try:
+        value = number(request.args[name])
+    except ValueError:
+        value = None
+
+    # Neither NaN nor infinity are of any use as an argument
+    if value is None or value != value or abs(value) == float('inf'):
+        bad_request((name,), 'must be a {}'.format(
+            'whole number' if number is int else 'number'))
+
+    if minimum is not None and maximum is not None and \
+            not minimum <= value <= maximum:
+        bad_request((name,), 'must be between {} and {}'.format(
+            minimum, maximum))
+    elif minimum is not None and value < minimum:
+        bad_request((name,), 'must be at least {}'.format(minimum))
+    elif maximum is not None and value > maximum:
+        bad_request((name,), 'must be at most {}'.format(maximum))
+
+    return value
+
+
+def decode_json(raw_data, schema=None):
+    """
+    Decodes a json request body and checks it against a schema.  An
+    HTTP Status Code of 400 ("Bad Request") is returned with every
+    problem found listed under "errors" if the body isn't valid.
+
+    :param raw_data: raw request data
+    :param schema: Schema the body has to match, None for any json
+    :return: deserialized json request data
+    """
+    try:
+        data = get_json_backend().loads(raw_data)
+    except ValueError:
+        errors = [error((), 'must be valid json')]
+    else:
+        errors = schema.errors(data) if schema is not None else []
+
+    if errors:
+        abort(json_response({'errors': errors}, 400))
+
+    return data
+
+
+def make_etag(row_id, version):
+    """
+    Builds a strong ETag from a user or group row.  The primary key is
+    part of it so a deleted and recreated entity doesn't reuse an old
+    ETag.
+
+    :param row_id: primary key of the row
+    :param version: version of the row
+    :return: unquoted ETag
+    """
+    return '{}.{}'.format(row_id, version)
+
+
+def pack_etag(etag, body):
+    """
+    Joins an ETag and the encoded body it belongs to into one value so
+    they are cached together.
+
+    :param etag: unquoted ETag
+    :param body: encoded json body
+    :return: bytes
+    """
+    return etag.encode('ascii') + b' ' + body
+
+
+def unpack_etag(value):
+    """
+    :param value: bytes made by pack_etag
+    :return: tuple of the ETag and the encoded json body
+    """
+    etag, body = value.split(b' ', 1)
+    return etag.decode('ascii'), body
+
+
+def etag_response(etag, body):
+    """
+    :param etag: unquoted ETag of the body
+    :param body: encoded json body
+    :return: json response, or 304 ("Not Modified") if the client's
+             If-None-Match header already names the ETag
+    """
+    resp = Response(body, 200, mimetype='application/json')
+    resp.set_etag(etag)
+    return resp.make_conditional(request)
+
+
+def not_modified(etag):
+    """
+    :param etag: unquoted ETag the client already has
+    :return: empty 304 ("Not Modified") response
+    """
+    resp = Response(status=304)
+    resp.set_etag(etag)
+    return resp
+
+
+def claim_version(table, row_id, version, conditional=None):
+    """
+    Bumps the version of the user or group a write is aimed at.  When
+    the request has an If-Match header it has to name the version read
+    at the start of the request, and the update only matches the row
+    while it's still at that version, so of two writers holding the
+    same ETag only the first wins.  The other gets 412 ("Precondition
+    Failed").
+
+    :param table: users or groups table
+    :param row_id: primary key of the row
+    :param version: version of the row read by the request
+    :param conditional: None to follow the request's If-Match header,
+                        otherwise whether the row has to still be at
+                        version, for callers that checked If-Match
+                        themselves
+    """
+    claim_row(table.update().values(version=table.c.version + 1),
+              table, row_id, version, conditional)
+
+
+def claim_row(statement, table, row_id, version, conditional=None):
+    """
+    Runs an update or delete of one user or group row honoring If-Match
+    the same way as claim_version.
+
+    :param statement: update or delete of table without a where clause
+    :param table: users or groups table
+    :param row_id: primary key of the row
+    :param version: version of the row read by the request
+    :param conditional: same as for claim_version
+    """
+    statement = statement.where(table.c.id == row_id)
+    if conditional is None and request.if_match:
+        if not request.if_match.contains(make_etag(row_id, version)):
+            abort(412)
+
+        conditional = not request.if_match.star_tag
+
+    if conditional:
+        statement = statement.where(table.c.version == version)
+
+    if db.session.execute(statement).rowcount != 1:
+        abort(412)
+
+
+def record_changes(userids=(), groupids=(), deleted_userids=(),
+                   deleted_groupids=()):
+    """
+    Appends the users and groups a write touched to the change log.
+    Called before the write is committed so the log entries commit, or
+    roll back, with it.
+
+    :param userids: userids of users created or changed, including
+                    users whose groups changed
+    :param groupids: groupids of groups created or whose members changed
+    :param deleted_userids: userids of deleted or renamed users
+    :param deleted_groupids: groupids of deleted groups
+    """
+    rows = ([('user', x, 'delete') for x in deleted_userids] +
+            [('group', x, 'delete') for x in deleted_groupids] +
+            [('user', x, 'put') for x in set(userids)] +
+            [('group', x, 'put') for x in set(groupids)])
+    if rows:
+        db.session.execute(changes.insert(), [
+            {'entity': entity, 'key': key, 'op': op}
+            for entity, key, op in rows])
+
+
+def get_changes(since, limit):
+    """
+    :param since: return changes after this seq
+    :param limit: most changes to return
+    :return: list of change dicts in seq order
+    """
+    rows = db.session.execute(
+        db.select([changes.c.seq, changes.c.entity, changes.c.key,
+                   changes.c.op])
+        .where(changes.c.seq > since)
+        .order_by(changes.c.seq)
+        .limit(limit))
+    return [{'seq': seq, 'entity': entity, 'id': key, 'op': op}
+            for seq, entity, key, op in rows]
+
+
+def bump_versions(userids=(), groupids=()):
+    """
+    Bumps the versions of users and groups whose documents or member
+    lists a write changes so their ETags change too.  Called before the
+    write is committed.
+
+    :param userids: userids of the users to bump
+    :param groupids: groupids of the groups to bump
+    """
+    for table, column, ids in ((User.__table__, 'userid', userids),
+                               (Group.__table__, 'groupid', groupids)):
+        for chunk in chunked(list(ids)):
+            db.session.execute(
+                table.update()
+                .where(table.c[column].in_(chunk))
+                .values(version=table.c.version + 1))
 
 
 def validate_user_data(user_data):
@@ -286,42 +1636,1008 @@ def validate_user_data(user_data):
     :param user_data: raw json request data
     :return: dict of deserialized json request data
     """
-    user_data = json.loads(user_data)
-    userid = user_data.get('userid')
-    first_name = user_data.get('first_name')
-    last_name = user_data.get('last_name')
-    groupids = user_data.get('groups', [])
+    return decode_json(user_data, USER_SCHEMA)
+
+
+def parse_bulk_data(raw_data, mimetype):
+    """
+    Deserializes a bulk request body, newline delimited json (one
+    document per line) when sent as NDJSON_MIMETYPE and a single json
+    array otherwise.
+
+    :param raw_data: raw request data
+    :param mimetype: mimetype of the request's Content-Type
+    :return: list of deserialized records, INVALID_JSON in place of
+             each line that isn't valid json
+    """
+    if mimetype != NDJSON_MIMETYPE:
+        return decode_json(raw_data)
+
+    records = []
+    loads = get_json_backend().loads
+    for line in raw_data.splitlines():
+        if not line.strip():
+            continue
+
+        # A bad line only fails its own record
+        try:
+            records.append(loads(line))
+        except ValueError:
+            records.append(INVALID_JSON)
+
+    return records
+
+
+def chunked(items, size=IN_CLAUSE_CHUNK_SIZE):
+    """
+    Splits a list into lists of at most ``size`` items.  SQLite caps
+    the number of bound parameters in a single statement so large
+    ``IN (...)`` lookups have to be issued in slices.
+
+    :param items: list to split
+    :param size: maximum length of each slice
+    :return: generator of lists
+    """
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def get_user_id(userid):
+    """
+    :param userid: userid string
+    :return: primary key of the user row or None
+    """
+    user_table = User.__table__
+    return db.session.execute(
+        db.select([user_table.c.id])
+        .where(user_table.c.userid == userid)).scalar()
+
+
+def get_user_version(userid):
+    """
+    :param userid: userid string
+    :return: tuple of the primary key and version of the user row or
+             None
+    """
+    user_table = User.__table__
+    return db.session.execute(
+        db.select([user_table.c.id, user_table.c.version])
+        .where(user_table.c.userid == userid)).first()
+
+
+def get_user_ids(userids):
+    """
+    Maps userids to the primary keys of their user rows.
+
+    :param userids: iterable of userid strings
+    :return: dict of userid -> users.id for the users that exist
+    """
+    user_table = User.__table__
+    user_ids = {}
+    for chunk in chunked(list(set(userids))):
+        rows = db.session.execute(
+            db.select([user_table.c.userid, user_table.c.id])
+            .where(user_table.c.userid.in_(chunk)))
+        user_ids.update(rows.fetchall())
+
+    return user_ids
+
+
+def get_group_members(group_id):
+    """
+    :param group_id: primary key of the group row
+    :return: dict of userid -> users.id for every member of the group
+    """
+    user_table = User.__table__
+    rows = db.session.execute(
+        db.select([user_table.c.userid, user_table.c.id])
+        .select_from(user_groups.join(
+            user_table, user_table.c.id == user_groups.c.userid))
+        .where(user_groups.c.groupid == group_id))
+    return dict(rows.fetchall())
+
+
+def get_group_version(groupid):
+    """
+    :param groupid: groupid string
+    :return: tuple of the primary key and version of the group row or
+             None
+    """
+    group_table = Group.__table__
+    return db.session.execute(
+        db.select([group_table.c.id, group_table.c.version])
+        .where(group_table.c.groupid == groupid)).first()
+
+
+def get_subgroupids(group_id):
+    """
+    :param group_id: primary key of the group row
+    :return: sorted groupids of the groups directly in the group
+    """
+    group_table = Group.__table__
+    rows = db.session.execute(
+        db.select([group_table.c.groupid])
+        .select_from(group_groups.join(
+            group_table, group_table.c.id == group_groups.c.childid))
+        .where(group_groups.c.parentid == group_id)
+        .order_by(group_table.c.groupid))
+    return [x[0] for x in rows]
+
+
+def get_groupids(group_ids):
+    """
+    :param group_ids: iterable of groups.id
+    :return: groupids of the groups that exist
+    """
+    group_table = Group.__table__
+    groupids = []
+    for chunk in chunked(list(set(group_ids))):
+        rows = db.session.execute(
+            db.select([group_table.c.groupid])
+            .where(group_table.c.id.in_(chunk)))
+        groupids.extend(x[0] for x in rows)
+
+    return groupids
+
+
+def get_max_depth():
+    """
+    Reads the max_depth query argument of the effective membership
+    routes.  An HTTP Status Code of 400 ("Bad Request") is returned if
+    it isn't a whole number of at least 0.
+
+    :return: most levels of nesting to follow, None for all of them
+    """
+    return get_number_arg('max_depth', None, 0)
+
+
+def effective_members_query(group_id, max_depth=None):
+    """
+    Builds a query selecting the userids of a group's members and of
+    the members of every group nested in it, with one lookup in the
+    closure table.
+
+    :param group_id: primary key of the group row
+    :param max_depth: most levels of nesting to follow, 0 for only the
+                      direct members, None for all of them
+    :return: select statement
+    """
+    user_table = User.__table__
+    direct = db.select([user_groups.c.userid]).where(
+        user_groups.c.groupid == group_id)
+    nested = (db.select([user_groups.c.userid])
+              .select_from(group_closure.join(
+                  user_groups,
+                  user_groups.c.groupid == group_closure.c.descendant))
+              .where(group_closure.c.ancestor == group_id))
+    if max_depth is not None:
+        nested = nested.where(group_closure.c.depth <= max_depth)
+
+    return (db.select([user_table.c.userid])
+            .where(user_table.c.id.in_(db.union(direct, nested)))
+            .order_by(user_table.c.id))
+
+
+def effective_groups_query(user_id, max_depth=None):
+    """
+    Builds a query selecting the groupids of a user's groups and of
+    every group they're nested in, with one lookup in the closure
+    table.
+
+    :param user_id: primary key of the user row
+    :param max_depth: most levels of nesting to follow, 0 for only the
+                      direct groups, None for all of them
+    :return: select statement
+    """
+    group_table = Group.__table__
+    direct = db.select([user_groups.c.groupid]).where(
+        user_groups.c.userid == user_id)
+    nested = (db.select([group_closure.c.ancestor])
+              .select_from(user_groups.join(
+                  group_closure,
+                  group_closure.c.descendant == user_groups.c.groupid))
+              .where(user_groups.c.userid == user_id))
+    if max_depth is not None:
+        nested = nested.where(group_closure.c.depth <= max_depth)
+
+    return (db.select([group_table.c.groupid])
+            .where(group_table.c.id.in_(db.union(direct, nested)))
+            .order_by(group_table.c.groupid))
+
+
+def group_members_query(group_id, after_id=None):
+    """
+    Builds a query selecting the userid and users.id of a group's
+    members in usergroups primary key order so it can be used for
+    keyset pagination.
+
+    :param group_id: primary key of the group row
+    :param after_id: only return members with a users.id after this one
+    :return: select statement
+    """
+    user_table = User.__table__
+    query = (db.select([user_table.c.userid,
+                        user_groups.c.userid.label('user_id')])
+             .select_from(user_groups.join(
+                 user_table, user_table.c.id == user_groups.c.userid))
+             .where(user_groups.c.groupid == group_id)
+             .order_by(user_groups.c.userid))
+    if after_id is not None:
+        query = query.where(user_groups.c.userid > after_id)
+
+    return query
+
+
+def stream_group_members(group_id):
+    """
+    Yields a group's member list as a json array in pieces.
+
+    :param group_id: primary key of the group row
+    :return: generator of json fragments
+    """
+    return stream_userids(group_members_query(group_id))
+
+
+def stream_userids(query):
+    """
+    Yields the first column of a query as a json array in pieces,
+    reading the rows from a server side cursor in fixed size batches so
+    memory use doesn't depend on the size of the result.
+
+    :param query: select statement
+    :return: generator of json fragments
+    """
+    dumps = get_json_backend().dumps
+    conn = db.session.connection().execution_options(stream_results=True)
+    rows = conn.execute(query)
+    yield b'['
+    first = True
+    while True:
+        batch = rows.fetchmany(STREAM_BATCH_SIZE)
+        if not batch:
+            break
+
+        # Encode the whole batch as one list and drop its brackets
+        chunk = dumps([x[0] for x in batch])[1:-1]
+        if not first:
+            chunk = b',' + chunk
+        first = False
+        yield chunk
+
+    yield b']'
+
+
+def get_page_args():
+    """
+    Reads the limit and after keyset pagination arguments of the
+    current request, aborting with a 400 when either is invalid.  The
+    after cursor is the users.id the previous page ended with, it stays
+    valid when that user is renamed or deleted.
+
+    :return: tuple of (limit, users.id to start after or None)
+    """
+    limit = get_number_arg('limit', MAX_PAGE_SIZE, 1, MAX_PAGE_SIZE)
+    after_id = get_number_arg('after', None)
+    return limit, after_id
+
+
+def make_page_response(query, limit, endpoint, **values):
+    """
+    Runs a page of a userid query and links to the next page when
+    there is one, with the users.id of the page's last user as cursor.
+
+    :param query: select statement of userids and users.id in users.id
+                  order, without a limit
+    :param limit: page size
+    :param endpoint: endpoint the next page link points at
+    :param values: url values of the endpoint
+    :return: response with a json list of userids
+    """
+    # One more than the page to know whether there's a next one
+    rows = db.session.execute(query.limit(limit + 1)).fetchall()
+    resp = json_response([x[0] for x in rows[:limit]])
+    if len(rows) > limit:
+        next_url = url_for(endpoint, after=rows[limit - 1][1], limit=limit,
+                           **values)
+        resp.headers['Link'] = '<{}>; rel="next"'.format(next_url)
+
+    return resp
+
+
+def parse_group_expression(expr, groupids=None, errors=None, path=()):
+    """
+    Checks a group set expression, which is either a groupid string or
+    a single key object: {"and": [expr, ...]} for users in every
+    operand, {"or": [expr, ...]} for users in any operand and
+    {"not": expr} for users outside the operand.
+
+    :param expr: decoded json expression
+    :param groupids: list the groupids found are appended to
+    :param errors: list the error of an invalid expression is appended
+                   to, its field is the path to the invalid part
+    :param path: path of expr within the whole expression
+    :return: list of the groupids named in expr, None if it's invalid
+    """
+    if groupids is None:
+        groupids = []
+
+    def invalid(path, message):
+        if errors is not None:
+            errors.append(error(path, message))
+        return None
+
+    if isinstance(expr, unicode):
+        groupids.append(expr)
+        if len(groupids) > MAX_QUERY_TERMS:
+            return invalid((), 'must not name more than {} groups'.format(
+                MAX_QUERY_TERMS))
+        return groupids
+
+    if not isinstance(expr, dict) or len(expr) != 1:
+        return invalid(path, 'must be a groupid or an object with one of '
+                             'and, or or not')
+
+    op, operands = expr.items()[0]
+    if op == 'not':
+        paths = [path + (op,)]
+        operands = [operands]
+    elif op not in ('and', 'or'):
+        return invalid(path, 'unknown operator {}, must be and, or or '
+                             'not'.format(op))
+    elif not isinstance(operands, list) or not operands:
+        return invalid(path + (op,), 'must be a non empty array')
+    else:
+        paths = [path + (op, i) for i in range(len(operands))]
+
+    for operand, operand_path in zip(operands, paths):
+        if parse_group_expression(operand, groupids, errors,
+                                  operand_path) is None:
+            return None
+
+    return groupids
+
+
+def group_expression_clause(expr, group_ids, user_id):
+    """
+    Translates a group set expression into a condition on a users.id
+    column, each groupid becoming an EXISTS on the usergroups primary
+    key.
+
+    :param expr: expression accepted by parse_group_expression
+    :param group_ids: dict of groupid to groups.id
+    :param user_id: column holding the users.id to test
+    :return: sql condition
+    """
+    if isinstance(expr, unicode):
+        return db.exists().where(db.and_(
+            user_groups.c.userid == user_id,
+            user_groups.c.groupid == group_ids[expr]))
 
-    # Validate user input
-    if not (userid and first_name and last_name and groupids):
-        # Required data doesn't exist, "Bad Request"
-        abort(400)
+    op, operands = expr.items()[0]
+    if op == 'not':
+        return db.not_(group_expression_clause(operands, group_ids, user_id))
 
-    if not (isinstance(userid, unicode) and
-            isinstance(first_name, unicode) and
-            isinstance(last_name, unicode)):
-        # Userid, first_name or last_name isn't a
-        # unicode string, "Bad Request"
-        abort(400)
+    clauses = [group_expression_clause(x, group_ids, user_id)
+               for x in operands]
+    return db.and_(*clauses) if op == 'and' else db.or_(*clauses)
 
-    # Ensure groups is a list
-    if not isinstance(groupids, list):
-        # Groups is not a list, "Bad Request"
-        abort(400)
 
-    for groupid in groupids:
-        if not isinstance(groupid, unicode):
-            # GroupID isn't a unicode sting, "Bad Request"
-            abort(400)
+def group_expression_query(expr, group_ids, after_id=None):
+    """
+    Builds a query selecting the userid and users.id of the users
+    matching a group set expression in users.id order.
+
+    When the expression requires membership of a group, either by being
+    a groupid or an "and" with a groupid operand, the query walks that
+    group's members through the (groupid, userid) index and tests the
+    rest of the expression for each of them.  Otherwise it has to walk
+    the users table.
+
+    :param expr: expression accepted by parse_group_expression
+    :param group_ids: dict of groupid to groups.id
+    :param after_id: only return users with a users.id after this one
+    :return: select statement
+    """
+    user_table = User.__table__
+    operands = [expr]
+    if isinstance(expr, dict) and expr.keys() == ['and']:
+        operands = expr['and']
+
+    driver = None
+    for operand in operands:
+        if isinstance(operand, unicode):
+            driver = operand
+            break
+
+    if driver is None:
+        user_id = user_table.c.id
+        query = (db.select([user_table.c.userid, user_id.label('user_id')])
+                 .where(group_expression_clause(expr, group_ids, user_id)))
+    else:
+        members = user_groups.alias('members')
+        user_id = members.c.userid
+        rest = list(operands)
+        rest.remove(driver)
+        query = (db.select([user_table.c.userid, user_id.label('user_id')])
+                 .select_from(members.join(
+                     user_table, user_table.c.id == user_id))
+                 .where(members.c.groupid == group_ids[driver]))
+        if rest:
+            query = query.where(group_expression_clause(
+                {'and': rest}, group_ids, user_id))
+
+    query = query.order_by(user_id)
+    if after_id is not None:
+        query = query.where(user_id > after_id)
+
+    return query
+
+
+def get_user_groupids(user_id):
+    """
+    Fetches the groupids a user currently belongs to without loading
+    any Group objects.
+
+    :param user_id: primary key of the user row
+    :return: set of groupid strings
+    """
+    group_table = Group.__table__
+    rows = db.session.execute(
+        db.select([group_table.c.groupid])
+        .select_from(group_table.join(
+            user_groups, user_groups.c.groupid == group_table.c.id))
+        .where(user_groups.c.userid == user_id))
+    return set(x[0] for x in rows)
+
+
+def update_user_groups(user_id, add=(), remove=()):
+    """
+    Applies a membership delta for one user with bulk statements on
+    the usergroups table and adjusts the groups' member counts.  Groups
+    in ``add`` that don't exist yet are created.  The caller is
+    responsible for committing the session.
+
+    :param user_id: primary key of the user row
+    :param add: groupids the user should be added to
+    :param remove: groupids the user should be removed from
+    """
+    deltas = {}
+    removed = list(lookup_group_ids(remove).values())
+    for chunk in chunked(removed):
+        db.session.execute(user_groups.delete().where(db.and_(
+            user_groups.c.userid == user_id,
+            user_groups.c.groupid.in_(chunk))))
+    deltas.update((x, -1) for x in removed)
+
+    if add:
+        group_ids = get_group_ids(add)
+        db.session.execute(user_groups.insert(), [
+            {'userid': user_id, 'groupid': group_ids[x]} for x in add])
+        deltas.update((group_ids[x], 1) for x in add)
+
+    membercounts.adjust(db.session, deltas)
+
+
+def get_group_counts(after, limit):
+    """
+    Reads a page of groups in groupid order from the unique index on
+    groupid, without reading their memberships.
+
+    :param after: groupid the page starts after, None for the first
+    :param limit: page size
+    :return: list of (groupid, member_count)
+    """
+    group_table = Group.__table__
+    query = (db.select([group_table.c.groupid, group_table.c.member_count])
+             .order_by(group_table.c.groupid)
+             .limit(limit))
+    if after is not None:
+        query = query.where(group_table.c.groupid > after)
+    return [tuple(x) for x in db.session.execute(query)]
+
+
+def get_group_stats(groupid):
+    """
+    :param groupid: groupid string
+    :return: tuple of the group's member count and number of direct
+             subgroups, or None when it doesn't exist
+    """
+    group_table = Group.__table__
+    row = db.session.execute(
+        db.select([group_table.c.id, group_table.c.member_count])
+        .where(group_table.c.groupid == groupid)).first()
+    if row is None:
+        return None
+
+    subgroups = db.session.execute(
+        db.select([db.func.count()])
+        .where(group_groups.c.parentid == row[0])).scalar()
+    return row[1], subgroups
+
+
+def lookup_group_ids(groupids):
+    """
+    Maps groupids to the primary keys of their group rows.
+
+    :param groupids: iterable of groupid strings
+    :return: dict of groupid -> groups.id for the groups that exist
+    """
+    group_table = Group.__table__
+    group_ids = {}
+    for chunk in chunked(list(set(groupids))):
+        rows = db.session.execute(
+            db.select([group_table.c.groupid, group_table.c.id])
+            .where(group_table.c.groupid.in_(chunk)))
+        group_ids.update(rows.fetchall())
+
+    return group_ids
+
+
+def get_group_ids(groupids):
+    """
+    Maps groupids to the primary keys of their group rows, creating
+    any groups that don't exist yet with a single batch insert.  The
+    caller is responsible for committing the session.
+
+    :param groupids: iterable of groupid strings
+    :return: dict of groupid -> groups.id
+    """
+    groupids = list(set(groupids))
+    group_table = Group.__table__
+    group_ids = lookup_group_ids(groupids)
+
+    missing = [x for x in groupids if x not in group_ids]
+    if missing:
+        db.session.execute(group_table.insert(),
+                           [{'groupid': x} for x in missing])
+        for chunk in chunked(missing):
+            rows = db.session.execute(
+                db.select([group_table.c.groupid, group_table.c.id])
+                .where(group_table.c.groupid.in_(chunk)))
+            group_ids.update(rows.fetchall())
+
+    return group_ids
+
+
+def insert_users(new_users):
+    """
+    Creates the users of a bulk request that don't exist yet, with a
+    statement for the users and one for their memberships, marks the
+    results of the ones that do as conflicts and commits.
+
+    :param new_users: list of (user data, result dict) for the valid
+                      records
+    :return: tuple of the userids created, the groupids whose members
+             changed and the users.id of the users created
+    """
+    existing = get_user_ids(x['userid'] for x, _ in new_users)
+    for record, result in new_users:
+        if record['userid'] in existing:
+            result.update(status=409, result='conflict')
+
+    new_users = [x for x, _ in new_users if x['userid'] not in existing]
+    user_ids = {}
+    if new_users:
+        group_ids = get_group_ids(
+            groupid for x in new_users for groupid in x['groups'])
+
+        db.session.execute(User.__table__.insert(), [
+            {'userid': x['userid'],
+             'first_name': x['first_name'],
+             'last_name': x['last_name']} for x in new_users])
+
+        user_ids = get_user_ids(x['userid'] for x in new_users)
+
+        memberships = [
+            {'userid': user_ids[x['userid']], 'groupid': group_ids[groupid]}
+            for x in new_users for groupid in set(x['groups'])]
+        db.session.execute(user_groups.insert(), memberships)
+        membercounts.adjust(db.session,
+                            Counter(x['groupid'] for x in memberships))
+        search.index_users(db.session, [
+            (user_ids[x['userid']], x['userid'], x['first_name'],
+             x['last_name']) for x in new_users])
+
+    userids = [x['userid'] for x in new_users]
+    groupids = set(groupid for x in new_users for groupid in x['groups'])
+    bump_versions(groupids=groupids)
+    record_changes(userids=userids, groupids=groupids)
+    db.session.commit()
+
+    return userids, groupids, list(user_ids.values())
+
+
+def replace_group_members(group_id, userids):
+    """
+    Works out the difference between a group's stored and requested
+    members and only writes that.  The caller is responsible for
+    committing the session.
+
+    :param group_id: primary key of the group row
+    :param userids: userids the group should have, ones that don't
+                    exist are skipped
+    :return: tuple of dict of userid -> users.id for the requested
+             users that exist and the set of userids added or removed
+    """
+    requested = get_user_ids(userids)
+    current = get_group_members(group_id)
+    remove = [user_id for userid, user_id in current.items()
+              if userid not in requested]
+    add = [user_id for userid, user_id in requested.items()
+           if userid not in current]
+
+    for chunk in chunked(remove):
+        db.session.execute(user_groups.delete().where(db.and_(
+            user_groups.c.groupid == group_id,
+            user_groups.c.userid.in_(chunk))))
+
+    if add:
+        db.session.execute(user_groups.insert(), [
+            {'userid': x, 'groupid': group_id} for x in add])
+
+    membercounts.adjust(db.session, {group_id: len(add) - len(remove)})
+    return requested, set(current) ^ set(requested)
+
+
+_shard_pool_lock = threading.Lock()
+
+
+def get_shard_pool():
+    """
+    :return: ThreadPool with a thread per shard, created the first
+             time it's needed
+    """
+    pool = current_app.extensions.get('shard_pool')
+    if pool is None:
+        with _shard_pool_lock:
+            pool = current_app.extensions.get('shard_pool')
+            if pool is None:
+                pool = ThreadPool(len(db.get_shard_binds()))
+                current_app.extensions['shard_pool'] = pool
+
+    return pool
+
+
+def on_shards(func):
+    """
+    Calls func for every shard at once on the shard thread pool.  Each
+    call gets an app context, and so a session, of its own bound to
+    its shard, and has to commit anything it writes.  Writes spanning
+    shards are committed shard by shard, not atomically.
+
+    :param func: function called with the bind key of the shard, it
+                 can't use the request
+    :return: list of what func returned for each shard, in shard order
+    """
+    app = current_app._get_current_object()
+    binds = db.get_shard_binds()
+    # Statements run on the pool count towards the request's metrics
+    stats = [metrics.worker_stats() for _ in binds]
+
+    def run(args):
+        bind, worker_stats = args
+        with app.app_context():
+            metrics.use_stats(worker_stats)
+            db.use_shard(bind)
+            return func(bind)
 
-    return user_data
+    try:
+        return get_shard_pool().map(run, zip(binds, stats))
+    finally:
+        metrics.merge_stats(stats)
+
+
+def sharded_etag(rows):
+    """
+    :param rows: (groups.id, version) from every shard, None for the
+                 shards without the group
+    :return: ETag of the whole group or None if no shard has it
+    """
+    if not any(rows):
+        return None
+    return '-'.join(make_etag(*x) if x else '0' for x in rows)
+
+
+def sharded_if_match(etag):
+    """
+    Checks a write's If-Match header against the ETag of a group read
+    from every shard.
+
+    :param etag: ETag from sharded_etag()
+    :return: whether each shard's write has to find the group still at
+             the version read
+    """
+    if not request.if_match:
+        return False
+    if not request.if_match.contains(etag):
+        abort(412)
+    return not request.if_match.star_tag
+
+
+def list_sharded_group(groupid):
+    """
+    GET /groups/<groupid> with the group's members on every shard, in
+    shard order.  Only whole member lists are served, paging and
+    streaming would need cursors spanning every shard.
+
+    :param groupid: groupid string
+    :return: response
+    """
+    if set(request.args) & set(['limit', 'after', 'stream']):
+        abort(501)
+
+    if request.if_none_match:
+        etag = sharded_etag(on_shards(lambda bind: get_group_version(groupid)))
+        if etag is None:
+            abort(404)
+        if request.if_none_match.contains_weak(etag):
+            return not_modified(etag)
+
+    cache = get_cache()
+    version = None
+    if cache:
+        result, version = cache.lookup('group', groupid)
+        if result is not None:
+            return etag_response(*unpack_etag(result))
+
+    def read(bind):
+        row = get_group_version(groupid)
+        if row is None:
+            return None, []
+        query = group_members_query(row[0])
+        return row, [x[0] for x in db.session.execute(query)]
+
+    shards = on_shards(read)
+    etag = sharded_etag([row for row, _ in shards])
+    if etag is None:
+        abort(404)
+
+    result = pack_etag(etag, get_json_backend().dumps(
+        [userid for _, members in shards for userid in members]))
+    if cache and not reading_replica():
+        cache.store('group', groupid, version, result)
+    return etag_response(*unpack_etag(result))
+
+
+def modify_sharded_group(groupid):
+    """
+    PUT /groups/<groupid> with the requested members split by shard.
+    Shards without the group get it if any of their users are added.
+
+    :param groupid: groupid string
+    :return: response
+    """
+    binds = db.get_shard_binds()
+    rows = on_shards(lambda bind: get_group_version(groupid))
+    etag = sharded_etag(rows)
+    if etag is None:
+        abort(404)
+
+    users = decode_json(request.data, GROUP_MEMBERS_SCHEMA)
+    conditional = sharded_if_match(etag)
+    rows = dict(zip(binds, rows))
+    by_shard = {}
+    for userid in users:
+        by_shard.setdefault(db.shard_for(userid), []).append(userid)
+
+    def write(bind):
+        row = rows[bind]
+        wanted = by_shard.get(bind, [])
+        if row is None:
+            if not wanted:
+                return None, [], set(), []
+            db_group = Group(groupid=groupid)
+            db.session.add(db_group)
+            db.session.flush()
+            group_id = db_group.id
+        else:
+            group_id = row[0]
+            claim_version(Group.__table__, group_id, row[1], conditional)
+
+        requested, changed = replace_group_members(group_id, wanted)
+        bump_versions(userids=changed)
+        record_changes(userids=changed, groupids=[groupid])
+        db.session.commit()
+
+        query = group_members_query(group_id)
+        return (get_group_version(groupid), list(requested), changed,
+                [x[0] for x in db.session.execute(query)])
+
+    shards = on_shards(write)
+    changed = set(x for shard in shards for x in shard[2])
+    invalidate_cache(userids=changed, groupids=[groupid])
+
+    resp = json_response([x for shard in shards for x in shard[3]])
+    resp.set_etag(sharded_etag([shard[0] for shard in shards]))
+
+    # Userids that don't exist can't be added, let the client know
+    # which ones were skipped.
+    unknown = sorted(set(users) - set(x for shard in shards
+                                      for x in shard[1]))
+    if unknown:
+        resp.headers['X-Unknown-Userids'] = json.dumps(unknown)
+
+    return resp
+
+
+def delete_sharded_group(groupid):
+    """
+    DELETE /groups/<groupid> on every shard that has the group.
+
+    :param groupid: groupid string
+    :return: response
+    """
+    binds = db.get_shard_binds()
+    rows = on_shards(lambda bind: get_group_version(groupid))
+    etag = sharded_etag(rows)
+    if etag is None:
+        abort(404)
+
+    conditional = sharded_if_match(etag)
+    rows = dict(zip(binds, rows))
+    group_table = Group.__table__
+
+    def delete(bind):
+        row = rows[bind]
+        if row is None:
+            return []
+
+        # Memberships are removed by the database through ON DELETE
+        # CASCADE
+        userids = [x[0] for x in
+                   db.session.execute(group_members_query(row[0]))]
+        claim_row(group_table.delete(), group_table, row[0], row[1],
+                  conditional)
+        bump_versions(userids=userids)
+        record_changes(userids=userids, deleted_groupids=[groupid])
+        db.session.commit()
+        return userids
+
+    userids = [x for shard in on_shards(delete) for x in shard]
+    invalidate_cache(userids=userids, groupids=[groupid])
+
+    return make_response('', 200)
+
+
+def add_sharded_group(groupid):
+    """
+    POST /groups, the group is created on every shard.
+
+    :param groupid: groupid string
+    :return: response
+    """
+    if any(on_shards(lambda bind: get_group_version(groupid))):
+        abort(409)
+
+    def create(bind):
+        db.session.add(Group(groupid=groupid))
+        record_changes(groupids=[groupid])
+        db.session.commit()
+
+    on_shards(create)
+    invalidate_cache(groupids=[groupid])
+
+    return json_response([])
+
+
+def is_member_sharded(pairs):
+    """
+    is_member() with every pair checked on its user's shard.  A group
+    missing from the user's shard only means the user isn't in it if
+    another shard has the group.
+
+    :param pairs: list of (userid, groupid) tuples
+    :return: list of True, False or None where the user or group
+             doesn't exist, in the same order as pairs
+    """
+    by_shard = {}
+    for i, (userid, _) in enumerate(pairs):
+        by_shard.setdefault(db.shard_for(userid), []).append(i)
+
+    def check(bind):
+        indexes = by_shard.get(bind, [])
+        members = query_memberships([pairs[i] for i in indexes])
+        unknown = [i for i, m in zip(indexes, members) if m is None]
+        found = get_user_ids(pairs[i][0] for i in unknown)
+        return (list(zip(indexes, members)),
+                [i for i in unknown if pairs[i][0] in found])
+
+    result = [None] * len(pairs)
+    missing_group = []
+    for members, users_found in on_shards(check):
+        for i, member in members:
+            result[i] = member
+        missing_group.extend(users_found)
+
+    if missing_group:
+        groupids = [pairs[i][1] for i in missing_group]
+        found = set()
+        for group_ids in on_shards(lambda bind: lookup_group_ids(groupids)):
+            found.update(group_ids)
+        for i in missing_group:
+            if pairs[i][1] in found:
+                result[i] = False
+
+    return result
+
+
+def prewarm():
+    """
+    Does the setup the first requests of a process would otherwise pay
+    for: configures the ORM mappers, connects to the database and every
+    shard once, picks the JSON backend and builds the cache and the
+    membership index.  Pooled connections are closed again afterwards,
+    so a process that forks its workers next can share the rest with
+    them while each opens its own connections.
+    """
+    configure_mappers()
+    get_json_backend()
+    get_cache()
+    for bind in [None] + db.get_shard_binds():
+        db.get_engine(current_app, bind).connect().close()
+    get_membership_index()
+    db.session.remove()
+    db.dispose_engines()
 
 #################
 #               #
 # Start the app #
 #               #
 #################
+# The app configured from the environment, the one served by
+# server.py and `gunicorn app:app` and used by the tests.  Code running
+# outside of any app context gets its database.
+app = create_app()
+db.app = app
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Runs the app, exports or restores a snapshot of its '
+                    'database, or recounts the members of its groups.')
+    parser.add_argument('--export', metavar='FILE',
+                        help="write a snapshot to FILE, '-' for stdout")
+    parser.add_argument('--format', choices=['ndjson', 'binary'],
+                        default='ndjson', help='snapshot format to export')
+    parser.add_argument('--restore', metavar='FILE',
+                        help='load a snapshot in either format into an '
+                             'empty database')
+    parser.add_argument('--recount', action='store_true',
+                        help='recompute the member counts of every group')
+    args = parser.parse_args()
+    if (args.export or args.restore) and db.get_shard_binds():
+        parser.error("snapshots of sharded databases aren't supported")
+
+    migrations.upgrade(db)
+    with app.app_context():
+        if args.export:
+            out = open(args.export, 'wb') if args.export != '-' else \
+                getattr(sys.stdout, 'buffer', sys.stdout)
+            if args.format == 'binary':
+                chunks = snapshot.export_binary(db.engine)
+            else:
+                chunks = snapshot.export_ndjson(
+                    db.engine, dumps=get_json_backend().dumps)
+            for chunk in chunks:
+                out.write(chunk)
+            out.close()
+            sys.exit(0)
+
+        if args.restore:
+            with open(args.restore, 'rb') as stream:
+                counts = snapshot.restore(db.engine, stream)
+            print('Restored {users} users, {groups} groups and '
+                  '{memberships} memberships'.format(**counts))
+            sys.exit(0)
+
+        if args.recount:
+            fixed = 0
+            for bind in [None] + db.get_shard_binds():
+                with db.get_engine(app, bind).begin() as conn:
+                    fixed += membercounts.recount(conn)
+            print('Fixed {} wrong member counts'.format(fixed))
+            sys.exit(0)
+
+        prewarm()
+
     app.debug = True
-    db.create_all()
     app.run(host='0.0.0.0')
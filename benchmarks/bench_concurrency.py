@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""
+Measures read throughput of ``GET /users/<userid>`` while other threads
+keep rewriting users with ``PUT /users/<userid>``, once for each SQLite
+tuning profile.  Failed requests are mostly "database is locked" errors.
+
+    python benchmarks/bench_concurrency.py --readers 8 --writers 2
+"""
+import argparse
+import json
+import threading
+import time
+
+from common import app, seed, temp_database
+
+
+def run(args):
+    seed(args.users, args.groups, groups_per_user=1, skew=0)
+
+    stop = threading.Event()
+    counts = {'reads': 0, 'read_errors': 0, 'writes': 0, 'write_errors': 0}
+    lock = threading.Lock()
+
+    def reader(n):
+        client = app.app.test_client()
+        i = n
+        while not stop.is_set():
+            resp = client.get('/users/user{}'.format(i % args.users))
+            with lock:
+                counts['reads' if resp.status_code == 200 else 'read_errors'] += 1
+            i += args.readers
+
+    def writer(n):
+        client = app.app.test_client()
+        i = n
+        while not stop.is_set():
+            userid = u'user{}'.format(i % args.users)
+            body = {
+                'userid': userid,
+                'first_name': u'First{}'.format(i),
+                'last_name': u'Last{}'.format(i),
+                'groups': [u'group{}'.format(i % args.groups)]
+            }
+            resp = client.put('/users/' + userid, data=json.dumps(body))
+            with lock:
+                counts['writes' if resp.status_code == 200 else 'write_errors'] += 1
+            i += args.writers
+
+    threads = ([threading.Thread(target=reader, args=(n,))
+                for n in range(args.readers)] +
+               [threading.Thread(target=writer, args=(n,))
+                for n in range(args.writers)])
+    for thread in threads:
+        thread.start()
+    time.sleep(args.duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    counts['reads_per_second'] = counts['reads'] / float(args.duration)
+    counts['writes_per_second'] = counts['writes'] / float(args.duration)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--groups', type=int, default=50)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--profiles', nargs='+',
+                        default=['default', 'production'])
+    args = parser.parse_args()
+
+    results = {}
+    for profile in args.profiles:
+        with temp_database(SQLITE_PROFILE=profile,
+                           SQLALCHEMY_POOL_SIZE=args.readers + args.writers):
+            results[profile] = run(args)
+
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
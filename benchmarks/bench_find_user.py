@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""
+Compares the ORM based user lookup with the column only read path used
+by ``GET /users/<userid>``.  For each path it reports the number of SQL
+statements issued per request and the mean latency.
+
+    python benchmarks/bench_find_user.py --users 1000 --groups 200
+"""
+import argparse
+import json
+import time
+
+from common import app, seed, temp_database
+from app import db, User, create_user_response, get_user_document
+from sqlalchemy import event
+
+
+def orm_path(userid):
+    db_user = User.query.filter_by(userid=userid).first()
+    return create_user_response(db_user)
+
+
+def column_path(userid):
+    return app.json_response(get_user_document(userid)[1])
+
+
+def measure(func, userids):
+    statements = [0]
+
+    def count(*args):
+        statements[0] += 1
+
+    event.listen(db.engine, 'before_cursor_execute', count)
+    try:
+        with app.app.test_request_context():
+            start = time.time()
+            for userid in userids:
+                func(userid)
+                db.session.remove()
+            elapsed = time.time() - start
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count)
+
+    return {
+        'queries_per_request': float(statements[0]) / len(userids),
+        'mean_latency_ms': elapsed * 1000.0 / len(userids)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--groups', type=int, default=200)
+    parser.add_argument('--groups-per-user', type=int, default=20)
+    parser.add_argument('--requests', type=int, default=1000)
+    args = parser.parse_args()
+
+    with temp_database():
+        seed(args.users, args.groups, args.groups_per_user, skew=0)
+        userids = [u'user{}'.format(i % args.users)
+                   for i in range(args.requests)]
+        results = {
+            'orm': measure(orm_path, userids),
+            'columns': measure(column_path, userids)
+        }
+
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
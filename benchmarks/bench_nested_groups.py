@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+"""
+Measures nested groups on a deep hierarchy, a chain of ``--depth``
+groups, and a wide one, a tree ``--levels`` deep where every group has
+``--width`` subgroups.  For each it reports the closure table's size,
+the time to build the hierarchy edge by edge, the time to move a
+subtree (one edge removed and added again) and the query time of the
+effective groups of a user in a leaf group and effective members of
+the root, against walking the hierarchy with a query per level.
+
+    python benchmarks/bench_nested_groups.py --depth 100 --width 10 --levels 3
+"""
+import argparse
+import json
+import time
+
+from common import app, temp_database, user_record
+from app import db, group_groups
+import hierarchy
+
+
+def build(edges, users_per_group):
+    """
+    :param edges: list of (parent groupid, child groupid)
+    :param users_per_group: members added to every group
+    :return: dict of groupid -> groups.id and seconds spent adding edges
+    """
+    groupids = sorted(set(x for edge in edges for x in edge))
+    with app.app.test_request_context():
+        group_ids = app.get_group_ids(groupids)
+        records = [user_record(i * users_per_group + n, [groupid])
+                   for i, groupid in enumerate(groupids)
+                   for n in range(users_per_group)]
+        db.session.execute(app.User.__table__.insert(), [
+            {'userid': x['userid'], 'first_name': x['first_name'],
+             'last_name': x['last_name']} for x in records])
+        user_ids = app.get_user_ids(x['userid'] for x in records)
+        db.session.execute(app.user_groups.insert(), [
+            {'userid': user_ids[x['userid']],
+             'groupid': group_ids[x['groups'][0]]} for x in records])
+
+        start = time.time()
+        for parent, child in edges:
+            hierarchy.add_edge(db.session, group_ids[parent],
+                               group_ids[child])
+        elapsed = time.time() - start
+        db.session.commit()
+
+    return group_ids, elapsed
+
+
+def walk_groups(user_id):
+    # What every request would do without the closure, one query per
+    # level of nesting.
+    level = set(x[0] for x in db.session.execute(
+        db.select([app.user_groups.c.groupid])
+        .where(app.user_groups.c.userid == user_id)))
+    found = set(level)
+    while level:
+        level = set(x[0] for x in db.session.execute(
+            db.select([group_groups.c.parentid])
+            .where(group_groups.c.childid.in_(list(level))))) - found
+        found |= level
+    return found
+
+
+def timed(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000.0
+
+
+def measure(edges, leaf, root, moved, args):
+    """
+    :param edges: list of (parent groupid, child groupid)
+    :param leaf: groupid of a group at the bottom of the hierarchy
+    :param root: groupid of the group at the top
+    :param moved: (parent groupid, child groupid) of the edge to move
+    :return: dict of results
+    """
+    with temp_database():
+        group_ids, build_seconds = build(edges, args.users_per_group)
+        client = app.app.test_client()
+        leaf_user = client.get('/groups/' + leaf).data
+        userid = json.loads(leaf_user)[0]
+
+        with app.app.test_request_context():
+            closure_rows = db.session.execute(
+                db.select([db.func.count()])
+                .select_from(app.group_closure)).scalar()
+            user_id = app.get_user_id(userid)
+            root_id = group_ids[root]
+            walk_ms = timed(lambda: walk_groups(user_id), args.repeat)
+            groups_ms = timed(lambda: db.session.execute(
+                app.effective_groups_query(user_id)).fetchall(), args.repeat)
+            members_ms = timed(lambda: db.session.execute(
+                app.effective_members_query(root_id)).fetchall(),
+                args.repeat)
+
+            parent, child = group_ids[moved[0]], group_ids[moved[1]]
+
+            def move():
+                hierarchy.remove_edge(db.session, parent, child)
+                hierarchy.add_edge(db.session, parent, child)
+                db.session.commit()
+            move_ms = timed(move, args.repeat)
+
+        return {
+            'groups': len(group_ids),
+            'closure_rows': closure_rows,
+            'build_ms_per_edge': build_seconds * 1000.0 / len(edges),
+            'move_subtree_ms': move_ms,
+            'effective_groups_ms': groups_ms,
+            'walk_groups_ms': walk_ms,
+            'effective_members_ms': members_ms,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--depth', type=int, default=50)
+    parser.add_argument('--width', type=int, default=10)
+    parser.add_argument('--levels', type=int, default=3)
+    parser.add_argument('--users-per-group', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='runs per measurement, the best is reported')
+    args = parser.parse_args()
+
+    chain = [(u'deep{}'.format(i), u'deep{}'.format(i + 1))
+             for i in range(args.depth - 1)]
+    middle = chain[len(chain) // 2]
+
+    tree, level = [], [u'wide']
+    for _ in range(args.levels):
+        following = []
+        for parent in level:
+            for i in range(args.width):
+                following.append(u'{}.{}'.format(parent, i))
+                tree.append((parent, following[-1]))
+        level = following
+
+    results = {
+        'deep': measure(chain, chain[-1][1], chain[0][0], middle, args),
+        'wide': measure(tree, level[-1], u'wide', tree[0], args),
+    }
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
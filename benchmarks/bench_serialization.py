@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+"""
+Microbenchmarks the JSON work each route does: decoding and validating
+the request body and encoding the response body, for every installed
+JSON backend.  ``legacy`` is the encoding routes used before the
+backends existed, ``json.dumps`` for lists and Flask's pretty printed
+``jsonify`` for objects.
+
+Payloads are built in memory so no database is involved, ``--members``
+sets the size of group member lists and ``--batch`` the number of
+records in bulk and membership check bodies.
+
+    python benchmarks/bench_serialization.py --members 100000 --batch 1000
+"""
+import argparse
+import json
+import time
+
+from common import app, user_record
+import serialization
+
+
+def route_payloads(args):
+    """
+    :param args: parsed command line arguments
+    :return: list of (route name, request body or None, validation
+             function or None, response body)
+    """
+    groups = [u'group{}'.format(i) for i in range(20)]
+    members = [u'user{}'.format(i) for i in range(args.members)]
+    records = [user_record(i, groups[:3]) for i in range(args.batch)]
+    pairs = [{'userid': u'user{}'.format(i), 'groupid': groups[i % 20]}
+             for i in range(args.batch)]
+    user = user_record(0, groups)
+    results = [{'userid': x['userid'], 'status': 200, 'result': 'created'}
+               for x in records]
+
+    def validate_bulk(data):
+        return [app.USER_SCHEMA.errors(x) for x in data]
+
+    return [
+        ('new_user', user, app.USER_SCHEMA.errors, user),
+        ('bulk_new_users', records, validate_bulk, results),
+        ('find_user', None, None, user),
+        ('modify_user', user, app.USER_SCHEMA.errors, user),
+        ('patch_user_groups', {'add': groups[:2], 'remove': groups[2:4]},
+         app.USER_GROUPS_PATCH_SCHEMA.errors, user),
+        ('list_group', None, None, members),
+        ('modify_group', members, app.GROUP_MEMBERS_SCHEMA.errors, members),
+        ('add_group', {'name': u'newgroup'}, app.GROUP_SCHEMA.errors, []),
+        ('query_groups', {'and': groups[:2]}, app.parse_group_expression,
+         members),
+        ('check_memberships', pairs, app.MEMBERSHIP_CHECK_SCHEMA.errors,
+         [dict(x, member=True) for x in pairs]),
+    ]
+
+
+def legacy_dumps(obj):
+    if isinstance(obj, dict):
+        return json.dumps(obj, indent=2, separators=(', ', ': '))
+    return json.dumps(obj)
+
+
+def timed(func, arg, repeat):
+    best = None
+    for _ in range(repeat):
+        t = time.time()
+        func(arg)
+        elapsed = time.time() - t
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--members', type=int, default=10000)
+    parser.add_argument('--batch', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='runs per measurement, the best is reported')
+    args = parser.parse_args()
+
+    backends = [serialization.get_backend(x)
+                for x in serialization.available_backends()]
+    results = {}
+    for name, body, validate, response in route_payloads(args):
+        route = results[name] = {}
+        route['legacy'] = {'encode_us': timed(legacy_dumps, response,
+                                              args.repeat)}
+        for backend in backends:
+            timings = route[backend.name] = {
+                'encode_us': timed(backend.dumps, response, args.repeat)
+            }
+            if body is None:
+                continue
+
+            raw = json.dumps(body)
+            timings['decode_us'] = timed(backend.loads, raw, args.repeat)
+            if validate is not None:
+                data = backend.loads(raw)
+                timings['validate_us'] = timed(validate, data, args.repeat)
+
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
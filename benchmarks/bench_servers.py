@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+"""
+Compares the gevent and threaded servers from server.py while many
+client connections sit idle.
+
+Each server is started in its own process against the same seeded
+SQLite file.  The benchmark opens ``--idle`` connections that send an
+incomplete request and then wait, like clients held open by a gateway,
+and measures how many ``GET /users/<userid>`` requests ``--clients``
+busy clients get through in ``--duration`` seconds.
+
+    python benchmarks/bench_servers.py --idle 2000 --clients 16
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+try:
+    from httplib import HTTPConnection
+except ImportError:
+    from http.client import HTTPConnection
+
+from common import percentile, seed, temp_database
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                      'server.py')
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def wait_for(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError('server on port {} never came up'.format(port))
+
+
+def run(server, db_path, args):
+    port = free_port()
+    env = dict(os.environ, DATABASE_URL='sqlite:///' + db_path)
+    proc = subprocess.Popen(
+        [sys.executable, SERVER, '--server', server, '--host', '127.0.0.1',
+         '--port', str(port), '--quiet'], env=env)
+    idle = []
+    try:
+        wait_for(port)
+        idle_errors = 0
+        for _ in range(args.idle):
+            try:
+                sock = socket.create_connection(('127.0.0.1', port), 5)
+                sock.sendall(b'GET /users/user0 HTTP/1.1\r\nHost: bench\r\n')
+                idle.append(sock)
+            except socket.error:
+                idle_errors += 1
+
+        latencies = []
+        errors = [0]
+        lock = threading.Lock()
+        stop = threading.Event()
+
+        def client(n):
+            i = n
+            while not stop.is_set():
+                t = time.time()
+                try:
+                    conn = HTTPConnection('127.0.0.1', port, timeout=10)
+                    conn.request('GET', '/users/user{}'.format(i % args.users))
+                    resp = conn.getresponse()
+                    resp.read()
+                    conn.close()
+                    ok = resp.status == 200
+                except (socket.error, IOError):
+                    ok = False
+                with lock:
+                    if ok:
+                        latencies.append(time.time() - t)
+                    else:
+                        errors[0] += 1
+                i += args.clients
+
+        clients = [threading.Thread(target=client, args=(n,))
+                   for n in range(args.clients)]
+        for c in clients:
+            c.start()
+        time.sleep(args.duration)
+        stop.set()
+        for c in clients:
+            c.join()
+
+        latencies.sort()
+        return {
+            'idle_connections': len(idle),
+            'idle_connection_errors': idle_errors,
+            'requests': len(latencies),
+            'errors': errors[0],
+            'throughput': len(latencies) / args.duration,
+            'p50_ms': (percentile(latencies, 50) or 0) * 1000.0,
+            'p99_ms': (percentile(latencies, 99) or 0) * 1000.0
+        }
+    finally:
+        for sock in idle:
+            sock.close()
+        proc.terminate()
+        proc.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--groups', type=int, default=50)
+    parser.add_argument('--idle', type=int, default=1000)
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=5.0)
+    parser.add_argument('--servers', nargs='+',
+                        default=['threaded', 'gevent'])
+    args = parser.parse_args()
+
+    results = {}
+    with temp_database(SQLITE_PROFILE='production') as db_path:
+        seed(args.users, args.groups)
+        for server in args.servers:
+            results[server] = run(server, db_path, args)
+
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
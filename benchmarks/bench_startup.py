@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+"""
+Measures what a new worker process pays before it serves requests at
+full speed: importing the app, building it with create_app(), and its
+first request, both cold and after app.prewarm().  Every run is a new
+Python process so nothing is cached from an earlier one, the median
+of ``--runs`` is reported along with the time to bootstrap the schema
+of an empty database.
+
+The run fails when a median is over its target.
+
+    python benchmarks/bench_startup.py --runs 10 \\
+        --max-import-ms 1500 --max-first-request-ms 25
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Medians a worker should start within, see --max-import-ms and
+# --max-first-request-ms.
+TARGETS = {
+    'import_ms': 1500.0,
+    'first_request_ms': 25.0,
+    'prewarmed_first_request_ms': 15.0,
+}
+
+
+def child(path, prewarm):
+    """
+    Runs in the measured process.
+
+    :param path: seeded SQLite database to serve from
+    :param prewarm: call app.prewarm() before the first request
+    :return: dict of timings in milliseconds
+    """
+    start = time.time()
+    sys.path.insert(0, ROOT)
+    import app
+    imported = time.time()
+    flask_app = app.create_app(
+        {'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + path})
+    created = time.time()
+    if prewarm:
+        with flask_app.app_context():
+            app.prewarm()
+    warmed = time.time()
+
+    client = flask_app.test_client()
+    resp = client.get('/users/user0')
+    assert resp.status_code == 200, resp.data
+    first = time.time()
+    client.get('/users/user1')
+    second = time.time()
+
+    return {
+        'import_ms': (imported - start) * 1000.0,
+        'create_app_ms': (created - imported) * 1000.0,
+        'prewarm_ms': (warmed - created) * 1000.0,
+        'first_request_ms': (first - warmed) * 1000.0,
+        'second_request_ms': (second - first) * 1000.0,
+    }
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def measure(path, runs):
+    """
+    :param path: seeded SQLite database, with users user0 and user1
+    :param runs: processes started for each of cold and prewarmed
+    :return: dict of median timings in milliseconds
+    """
+    results = {}
+    for mode in ('cold', 'prewarmed'):
+        command = [sys.executable, os.path.abspath(__file__), '--child', path]
+        if mode == 'prewarmed':
+            command.append('--prewarm')
+        timings = [json.loads(subprocess.check_output(command))
+                   for _ in range(runs)]
+        for key in timings[0]:
+            name = key if mode == 'cold' else 'prewarmed_' + key
+            results[name] = median([x[key] for x in timings])
+
+    return results
+
+
+def bootstrap_ms():
+    """
+    :return: milliseconds migrations.upgrade() takes on an empty database
+    """
+    from common import app, temp_database
+    import migrations
+    with temp_database() as path:
+        os.remove(path)
+        with app.app.app_context():
+            start = time.time()
+            migrations.upgrade(app.db)
+            return (time.time() - start) * 1000.0
+
+
+def check(results, targets):
+    """
+    :param results: what measure() returned
+    :param targets: dict of timing name -> most milliseconds allowed
+    :return: list of descriptions of the targets missed
+    """
+    return ['{} {:.2f} > {:.2f}'.format(name, results[name], limit)
+            for name, limit in sorted(targets.items())
+            if results.get(name) is not None and results[name] > limit]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--max-import-ms', type=float,
+                        default=TARGETS['import_ms'])
+    parser.add_argument('--max-first-request-ms', type=float,
+                        default=TARGETS['first_request_ms'])
+    parser.add_argument('--max-prewarmed-first-request-ms', type=float,
+                        default=TARGETS['prewarmed_first_request_ms'])
+    parser.add_argument('--child', metavar='DATABASE', help=argparse.SUPPRESS)
+    parser.add_argument('--prewarm', action='store_true',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(child(args.child, args.prewarm)))
+        return
+
+    from common import seed, temp_database
+    with temp_database() as path:
+        seed(100, 10)
+        results = measure(path, args.runs)
+    results['bootstrap_ms'] = bootstrap_ms()
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+    missed = check(results, {
+        'import_ms': args.max_import_ms,
+        'first_request_ms': args.max_first_request_ms,
+        'prewarmed_first_request_ms': args.max_prewarmed_first_request_ms,
+    })
+    for target in missed:
+        sys.stderr.write('TARGET MISSED {}\n'.format(target))
+    if missed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
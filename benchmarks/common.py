@@ -0,0 +1,112 @@
+"""
+Helpers shared by the benchmark scripts.
+"""
+import bisect
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import app
+from app import db
+
+
+@contextmanager
+def temp_database(name='bench.db', **config):
+    """
+    Points the app at a new SQLite database in a temporary directory
+    for the duration of the block.
+
+    :param name: database file name
+    :param config: extra app config values to set
+    :return: path of the database file
+    """
+    tmpdir = tempfile.mkdtemp()
+    old_config = dict(app.app.config)
+    path = os.path.join(tmpdir, name)
+    app.app.config.update(config)
+    app.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+    try:
+        db.create_all()
+        yield path
+    finally:
+        db.session.remove()
+        db.get_engine(app.app).dispose()
+        app.app.config.clear()
+        app.app.config.update(old_config)
+        shutil.rmtree(tmpdir)
+
+
+def skewed_chooser(num_groups, skew, rng):
+    """
+    Builds a function picking group numbers from a Zipf like
+    distribution so a few groups end up very large and most small.
+
+    :param num_groups: number of groups to choose from
+    :param skew: exponent, 0 for uniform sizes
+    :param rng: random.Random instance
+    :return: function returning a group number
+    """
+    total = 0.0
+    cumulative = []
+    for rank in range(1, num_groups + 1):
+        total += 1.0 / rank ** skew
+        cumulative.append(total)
+
+    def choose():
+        return bisect.bisect_left(cumulative, rng.random() * total)
+
+    return choose
+
+
+def user_record(i, groups, prefix=u'user'):
+    return {
+        'userid': u'{}{}'.format(prefix, i),
+        'first_name': u'First{}'.format(i),
+        'last_name': u'Last{}'.format(i),
+        'groups': groups
+    }
+
+
+def seed(num_users, num_groups, groups_per_user=3, skew=1.0,
+         batch_size=5000, random_seed=0):
+    """
+    Loads users named user0..userN through the bulk import endpoint.
+
+    :param num_users: number of users to create
+    :param num_groups: number of groups named group0..groupN
+    :param groups_per_user: groups each user is put in
+    :param skew: Zipf exponent for how users spread over groups
+    :param batch_size: users per bulk request
+    :param random_seed: seed so runs are repeatable
+    """
+    rng = random.Random(random_seed)
+    choose = skewed_chooser(num_groups, skew, rng)
+    client = app.app.test_client()
+    for start in range(0, num_users, batch_size):
+        records = []
+        for i in range(start, min(start + batch_size, num_users)):
+            groups = set(u'group{}'.format(choose())
+                         for _ in range(groups_per_user))
+            records.append(user_record(i, sorted(groups)))
+
+        resp = client.post('/users/_bulk', data=json.dumps(records))
+        assert resp.status_code == 200, resp.data
+
+
+def percentile(values, percent):
+    """
+    :param values: sorted list of numbers
+    :param percent: percentile to pick, 0-100
+    :return: nearest rank percentile
+    """
+    if not values:
+        return None
+
+    index = int(round(percent / 100.0 * len(values) + 0.5)) - 1
+    return values[max(0, min(index, len(values) - 1))]
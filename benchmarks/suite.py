@@ -0,0 +1,407 @@
+#!/usr/bin/env python
+"""
+Benchmarks every route of the app against a seeded database.
+
+Each route is driven through the Flask test client and through a real
+threaded WSGI server hit by concurrent HTTP clients.  Throughput and
+p50/p99 latency per route are written as JSON, and when a baseline
+result file is given the run fails if any route got slower than the
+threshold allows.  Routes with a latency budget, see ROUTE_TARGETS,
+fail the run whenever they go over it.  Worker startup, import and
+first request latency, is measured by bench_startup.py and fails the
+run when it misses its targets.
+
+    python benchmarks/suite.py --users 100000 --groups 5000 \\
+        --output results.json --baseline baseline.json --threshold 0.2
+"""
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+
+try:
+    from httplib import HTTPConnection
+except ImportError:
+    from http.client import HTTPConnection
+
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+import bench_startup
+from common import app, percentile, seed, skewed_chooser, temp_database, \
+    user_record
+
+# Most milliseconds a route may take whatever the baseline says, by
+# mode and route.  Type-ahead search has to keep up with typing.
+ROUTE_TARGETS = {
+    ('test_client', 'search_users'): {'p50_ms': 10.0, 'p99_ms': 50.0},
+    ('wsgi', 'search_users'): {'p50_ms': 100.0, 'p99_ms': 400.0},
+}
+
+
+def route_requests(args, prefix):
+    """
+    Builds the requests sent for each route.  Every route gets a
+    function returning (method, path, body) for the i-th request.
+    Routes that create things use ``prefix`` so each mode works on its
+    own users and groups, and deletes only remove what was created.
+
+    :param args: parsed command line arguments
+    :param prefix: unique string for the current mode
+    :return: list of (route name, request function)
+    """
+    rng = random.Random(1)
+    choose = skewed_chooser(args.groups, args.skew, rng)
+
+    def existing_user(i):
+        return u'user{}'.format(rng.randrange(args.users))
+
+    def small_group(i):
+        # The tail of the distribution, the head is the large groups
+        return u'group{}'.format(args.groups - 1 - i % (args.groups // 2 or 1))
+
+    def new_user(i):
+        record = user_record(i, [u'group{}'.format(choose())],
+                             prefix=prefix + u'new')
+        return 'POST', '/users', record
+
+    def bulk_new_users(i):
+        records = [user_record(i * 100 + x, [u'group{}'.format(choose())],
+                               prefix=prefix + u'bulk')
+                   for x in range(100)]
+        return 'POST', '/users/_bulk', records
+
+    def find_user(i):
+        return 'GET', u'/users/' + existing_user(i), None
+
+    def get_users(i):
+        # A team page's worth of users in one request
+        return 'POST', '/users/_mget', [existing_user(i) for _ in range(300)]
+
+    def search_users(i):
+        # Type-ahead, a few letters of a userid up to a whole one, or
+        # a first name and the start of a last name
+        n = rng.randrange(args.users)
+        if i % 2:
+            q = u'first{}%20la'.format(n)
+        else:
+            q = u'user{}'.format(n)[:2 + i % 8]
+        return 'GET', u'/users/_search?q={}&limit=20'.format(q), None
+
+    def modify_user(i):
+        userid = u'{}new{}'.format(prefix, i)
+        record = user_record(i, [u'group{}'.format(choose()),
+                                 u'group{}'.format(choose())],
+                             prefix=prefix + u'new')
+        return 'PUT', u'/users/' + userid, record
+
+    def patch_user_groups(i):
+        userid = u'{}new{}'.format(prefix, i)
+        body = {'add': [u'group{}'.format(choose())], 'remove': []}
+        return 'PATCH', u'/users/{}/groups'.format(userid), body
+
+    def delete_user(i):
+        return 'DELETE', u'/users/{}new{}'.format(prefix, i), None
+
+    def list_group(i):
+        return 'GET', u'/groups/' + small_group(i), None
+
+    def list_large_group_page(i):
+        return 'GET', u'/groups/group{}?limit=100'.format(i % 10), None
+
+    def stream_large_group(i):
+        return 'GET', u'/groups/group{}?stream=1'.format(i % 10), None
+
+    def group_stats(i):
+        return 'GET', u'/groups/group{}/stats'.format(i % 10), None
+
+    def list_groups(i):
+        return 'GET', u'/groups?limit=100&after=group{}'.format(
+            choose()), None
+
+    def add_group(i):
+        return 'POST', '/groups', {'name': u'{}group{}'.format(prefix, i)}
+
+    def modify_group(i):
+        members = [u'user{}'.format(rng.randrange(args.users))
+                   for _ in range(10)]
+        return 'PUT', u'/groups/{}group{}'.format(prefix, i), members
+
+    def delete_group(i):
+        return 'DELETE', u'/groups/{}group{}'.format(prefix, i), None
+
+    def check_membership(i):
+        return 'GET', u'/groups/group{}/members/{}'.format(
+            choose(), existing_user(i)), None
+
+    def check_memberships(i):
+        # A page of items, each shown if its user is in its group
+        return 'POST', '/memberships/_check', [
+            {'userid': existing_user(i),
+             'groupid': u'group{}'.format(choose())} for _ in range(100)]
+
+    def query_groups(i):
+        expr = {'and': [u'group{}'.format(i % 10),
+                        {'or': [u'group{}'.format(choose()),
+                                u'group{}'.format(choose())]},
+                        {'not': small_group(i)}]}
+        return 'POST', '/groups/_query?limit=100', expr
+
+    def list_changes(i):
+        return 'GET', '/changes?since={}&limit=100'.format(i * 100), None
+
+    def export(i):
+        # The whole database, every request
+        return 'GET', '/export', None
+
+    def modify_subgroups(i):
+        return 'PUT', u'/groups/{}group{}/groups'.format(prefix, i), \
+            [small_group(i), small_group(i + 1)]
+
+    def list_subgroups(i):
+        return 'GET', u'/groups/{}group{}/groups'.format(prefix, i), None
+
+    def list_effective_members(i):
+        return 'GET', u'/groups/{}group{}/members'.format(prefix, i), None
+
+    def list_effective_groups(i):
+        return 'GET', u'/users/{}/groups'.format(existing_user(i)), None
+
+    # Order matters, later routes work on what earlier ones created
+    return [
+        ('new_user', new_user),
+        ('bulk_new_users', bulk_new_users),
+        ('find_user', find_user),
+        ('get_users', get_users),
+        ('search_users', search_users),
+        ('modify_user', modify_user),
+        ('patch_user_groups', patch_user_groups),
+        ('list_group', list_group),
+        ('list_group_page', list_large_group_page),
+        ('list_group_stream', stream_large_group),
+        ('group_stats', group_stats),
+        ('list_groups', list_groups),
+        ('add_group', add_group),
+        ('modify_group', modify_group),
+        ('modify_subgroups', modify_subgroups),
+        ('list_subgroups', list_subgroups),
+        ('list_effective_members', list_effective_members),
+        ('list_effective_groups', list_effective_groups),
+        ('check_membership', check_membership),
+        ('check_memberships', check_memberships),
+        ('query_groups', query_groups),
+        ('list_changes', list_changes),
+        ('export', export),
+        ('delete_group', delete_group),
+        ('delete_user', delete_user),
+    ]
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def summarize(latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    count = len(latencies)
+    return {
+        'requests': count,
+        'errors': errors,
+        'throughput': count / elapsed if elapsed else None,
+        'mean_ms': sum(latencies) * 1000.0 / count if count else None,
+        'p50_ms': percentile(latencies, 50) * 1000.0 if count else None,
+        'p99_ms': percentile(latencies, 99) * 1000.0 if count else None
+    }
+
+
+def run_test_client(args):
+    client = app.app.test_client()
+    results = {}
+    for name, make_request in route_requests(args, u'tc'):
+        latencies = []
+        errors = 0
+        start = time.time()
+        for i in range(args.requests):
+            method, path, body = make_request(i)
+            data = json.dumps(body) if body is not None else None
+            t = time.time()
+            resp = client.open(path, method=method, data=data)
+            resp.get_data()
+            latencies.append(time.time() - t)
+            if resp.status_code != 200:
+                errors += 1
+        results[name] = summarize(latencies, errors, time.time() - start)
+
+    return results
+
+
+def run_wsgi(args):
+    server = make_server('127.0.0.1', 0, app.app, threaded=True,
+                         request_handler=QuietRequestHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    port = server.server_port
+
+    results = {}
+    try:
+        for name, make_request in route_requests(args, u'ws'):
+            latencies = []
+            errors = [0]
+            lock = threading.Lock()
+            # Build every request up front so the random choices
+            # aren't shared between client threads.
+            requests = [make_request(i) for i in range(args.requests)]
+
+            def client(n):
+                for method, path, body in requests[n::args.concurrency]:
+                    conn = HTTPConnection('127.0.0.1', port)
+                    data = json.dumps(body) if body is not None else None
+                    t = time.time()
+                    conn.request(method, path.encode('utf-8'), data)
+                    resp = conn.getresponse()
+                    resp.read()
+                    elapsed = time.time() - t
+                    conn.close()
+                    with lock:
+                        latencies.append(elapsed)
+                        if resp.status != 200:
+                            errors[0] += 1
+
+            clients = [threading.Thread(target=client, args=(n,))
+                       for n in range(args.concurrency)]
+            start = time.time()
+            for c in clients:
+                c.start()
+            for c in clients:
+                c.join()
+            results[name] = summarize(latencies, errors[0],
+                                      time.time() - start)
+    finally:
+        server.shutdown()
+
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    :param results: results of this run
+    :param baseline: results of an earlier run
+    :param threshold: allowed fractional slowdown, e.g. 0.2 for 20%
+    :return: list of regression descriptions
+    """
+    regressions = []
+    for mode, routes in sorted(results['results'].items()):
+        for route, current in sorted(routes.items()):
+            previous = baseline['results'].get(mode, {}).get(route)
+            if not previous:
+                continue
+
+            for key in ('p50_ms', 'p99_ms'):
+                if previous[key] and current[key] > previous[key] * (1 + threshold):
+                    regressions.append('{} {} {} {:.2f} -> {:.2f}'.format(
+                        mode, route, key, previous[key], current[key]))
+            if previous['throughput'] and \
+                    current['throughput'] < previous['throughput'] * (1 - threshold):
+                regressions.append('{} {} throughput {:.1f} -> {:.1f}'.format(
+                    mode, route, previous['throughput'],
+                    current['throughput']))
+
+    for name, current in sorted(results.get('startup', {}).items()):
+        previous = baseline.get('startup', {}).get(name)
+        if previous and current > previous * (1 + threshold):
+            regressions.append('startup {} {:.2f} -> {:.2f}'.format(
+                name, previous, current))
+
+    return regressions
+
+
+def check_targets(results):
+    """
+    :param results: results of this run
+    :return: list of descriptions of the route budgets missed
+    """
+    missed = []
+    for (mode, route), targets in sorted(ROUTE_TARGETS.items()):
+        current = results['results'].get(mode, {}).get(route)
+        if not current:
+            continue
+
+        for key, limit in sorted(targets.items()):
+            if current[key] > limit:
+                missed.append('{} {} {} {:.2f} > {:.2f}'.format(
+                    mode, route, key, current[key], limit))
+
+    return missed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--groups', type=int, default=500)
+    parser.add_argument('--groups-per-user', type=int, default=3)
+    parser.add_argument('--skew', type=float, default=1.0,
+                        help='Zipf exponent for group sizes, 0 is uniform')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per route and mode')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='concurrent clients against the wsgi server')
+    parser.add_argument('--modes', nargs='+', default=['test_client', 'wsgi'],
+                        choices=['test_client', 'wsgi'])
+    parser.add_argument('--profile', default='production',
+                        help='SQLITE_PROFILE to run with')
+    parser.add_argument('--startup-runs', type=int, default=5,
+                        help='processes started to measure startup, 0 to '
+                             'skip it')
+    parser.add_argument('--output', help='file to write results to')
+    parser.add_argument('--baseline', help='results file to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = {'config': vars(args), 'results': {}}
+    with temp_database(SQLITE_PROFILE=args.profile,
+                       SQLALCHEMY_POOL_SIZE=args.concurrency) as path:
+        start = time.time()
+        seed(args.users, args.groups, args.groups_per_user, args.skew)
+        results['seed_seconds'] = time.time() - start
+
+        runners = {'test_client': run_test_client, 'wsgi': run_wsgi}
+        for mode in args.modes:
+            results['results'][mode] = runners[mode](args)
+
+        if args.startup_runs:
+            results['startup'] = bench_startup.measure(path,
+                                                       args.startup_runs)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+    failed = False
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            sys.stderr.write('REGRESSION {}\n'.format(regression))
+        failed = bool(regressions)
+
+    for target in check_targets(results):
+        sys.stderr.write('TARGET MISSED {}\n'.format(target))
+        failed = True
+    for target in bench_startup.check(results.get('startup', {}),
+                                      bench_startup.TARGETS):
+        sys.stderr.write('TARGET MISSED startup {}\n'.format(target))
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""
+Compressed bitset for sets of non-negative integer ids.
+
+Ids are split on their high 16 bits into chunks.  A chunk holding a few
+ids stores them as a sorted array of 16 bit integers, a chunk holding
+more than ARRAY_MAX ids switches to an 8KB bitmap, the same layout as
+a roaring bitmap.  Both keep membership checks constant time for the
+ids a user or group database table produces.
+"""
+from array import array
+from bisect import bisect_left
+
+# Above this many ids an array chunk is bigger than a bitmap chunk
+ARRAY_MAX = 4096
+BITMAP_BYTES = 1 << 13
+
+
+class _BitmapChunk(object):
+    __slots__ = ('bits', 'count')
+
+    def __init__(self, values=()):
+        self.bits = bytearray(BITMAP_BYTES)
+        self.count = 0
+        for value in values:
+            self.add(value)
+
+    def add(self, low):
+        mask = 1 << (low & 7)
+        if not self.bits[low >> 3] & mask:
+            self.bits[low >> 3] |= mask
+            self.count += 1
+
+    def discard(self, low):
+        mask = 1 << (low & 7)
+        if self.bits[low >> 3] & mask:
+            self.bits[low >> 3] &= ~mask & 0xFF
+            self.count -= 1
+
+    def __contains__(self, low):
+        return bool(self.bits[low >> 3] & (1 << (low & 7)))
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        bits = self.bits
+        for i in range(BITMAP_BYTES):
+            byte = bits[i]
+            if byte:
+                for bit in range(8):
+                    if byte & (1 << bit):
+                        yield (i << 3) | bit
+
+
+class RoaringBitmap(object):
+    """
+    Set of non-negative integers below 2 ** 32.
+    """
+    __slots__ = ('_chunks',)
+
+    def __init__(self, values=()):
+        """
+        :param values: iterable of integers to start with
+        """
+        self._chunks = {}
+        for value in values:
+            self.add(value)
+
+    def add(self, value):
+        high, low = value >> 16, value & 0xFFFF
+        chunk = self._chunks.get(high)
+        if chunk is None:
+            self._chunks[high] = array('H', [low])
+            return
+
+        if isinstance(chunk, _BitmapChunk):
+            chunk.add(low)
+            return
+
+        i = bisect_left(chunk, low)
+        if i < len(chunk) and chunk[i] == low:
+            return
+
+        chunk.insert(i, low)
+        if len(chunk) > ARRAY_MAX:
+            self._chunks[high] = _BitmapChunk(chunk)
+
+    def discard(self, value):
+        high, low = value >> 16, value & 0xFFFF
+        chunk = self._chunks.get(high)
+        if chunk is None:
+            return
+
+        if isinstance(chunk, _BitmapChunk):
+            chunk.discard(low)
+            if len(chunk) <= ARRAY_MAX:
+                self._chunks[high] = array('H', chunk)
+            return
+
+        i = bisect_left(chunk, low)
+        if i < len(chunk) and chunk[i] == low:
+            del chunk[i]
+            if not chunk:
+                del self._chunks[high]
+
+    def __contains__(self, value):
+        chunk = self._chunks.get(value >> 16)
+        if chunk is None:
+            return False
+
+        low = value & 0xFFFF
+        if isinstance(chunk, _BitmapChunk):
+            return low in chunk
+
+        i = bisect_left(chunk, low)
+        return i < len(chunk) and chunk[i] == low
+
+    def __len__(self):
+        return sum(len(x) for x in self._chunks.values())
+
+    def __iter__(self):
+        for high in sorted(self._chunks):
+            base = high << 16
+            for low in self._chunks[high]:
+                yield base | low
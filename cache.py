@@ -0,0 +1,416 @@
+"""
+Caches used to keep recently read user documents and group member
+lists out of the database.
+
+Two backends share the same small interface (get, get_many, set, add,
+set_many, delete and stats):
+
+* LRUCache keeps entries in process memory.
+* RedisBackend talks the Redis protocol to a server shared by every
+  worker process.
+
+VersionedCache sits in front of either one.  Each cached entity has a
+version key and its data is stored under a key that includes the
+current version, so a write only has to replace the version to make
+every worker miss on the old data.  Nothing has to be broadcast.
+"""
+import binascii
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
+
+
+class CacheError(Exception):
+    """
+    Raised by a backend when the cache server can't be reached or
+    returns an error.
+    """
+
+
+class LRUCache(object):
+    """
+    Bounded least recently used cache with an optional time to live.
+
+    Keeps hit, miss, eviction and expiration counters so the cache can
+    be sized from real traffic.
+    """
+
+    def __init__(self, max_entries=10000, ttl=None, clock=time.time):
+        """
+        :param max_entries: number of entries to hold before evicting
+                            the least recently used one
+        :param ttl: seconds an entry stays valid, None to never expire
+        :param clock: function returning the current time in seconds
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        :param key: cache key
+        :return: the cached value or None
+        """
+        with self._lock:
+            return self._get(key)
+
+    def get_many(self, keys):
+        """
+        :param keys: list of cache keys
+        :return: list of cached values, None for every miss
+        """
+        with self._lock:
+            return [self._get(key) for key in keys]
+
+    def set(self, key, value, ttl=None):
+        """
+        :param key: cache key
+        :param value: value to store, None can't be cached
+        :param ttl: seconds the entry stays valid, defaults to the
+                    cache's ttl
+        """
+        with self._lock:
+            self._set(key, value, ttl)
+
+    def set_many(self, mapping, ttl=None):
+        """
+        :param mapping: dict of cache key -> value
+        :param ttl: seconds the entries stay valid
+        """
+        with self._lock:
+            for key, value in mapping.items():
+                self._set(key, value, ttl)
+
+    def add(self, key, value, ttl=None):
+        """
+        Stores a value only if the key isn't already present.
+
+        :param key: cache key
+        :param value: value to store
+        :param ttl: seconds the entry stays valid
+        :return: True if the value was stored
+        """
+        with self._lock:
+            if self._get(key, count=False) is not None:
+                return False
+
+            self._set(key, value, ttl)
+            return True
+
+    def delete(self, *keys):
+        """
+        :param keys: cache keys to drop
+        """
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """
+        :return: dict of counters and the current size of the cache
+        """
+        with self._lock:
+            return {
+                'backend': 'memory',
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'size': len(self._data),
+                'max_entries': self.max_entries
+            }
+
+    def _get(self, key, count=True):
+        try:
+            value, expires = self._data.pop(key)
+        except KeyError:
+            self.misses += count
+            return None
+
+        if expires is not None and expires <= self.clock():
+            self.expirations += 1
+            self.misses += count
+            return None
+
+        # Re-insert to mark the entry as most recently used
+        self._data[key] = (value, expires)
+        self.hits += count
+        return value
+
+    def _set(self, key, value, ttl):
+        if ttl is None:
+            ttl = self.ttl
+
+        expires = None
+        if ttl is not None:
+            expires = self.clock() + ttl
+
+        self._data.pop(key, None)
+        self._data[key] = (value, expires)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+
+class RedisBackend(object):
+    """
+    Minimal Redis protocol client implementing the cache backend
+    interface.  Each thread gets its own connection.
+    """
+
+    def __init__(self, host='localhost', port=6379, db=0, ttl=None,
+                 socket_timeout=1.0):
+        """
+        :param host: redis server host
+        :param port: redis server port
+        :param db: database number to select after connecting
+        :param ttl: default seconds entries stay valid
+        :param socket_timeout: seconds to wait on the server
+        """
+        self.host = host
+        self.port = port
+        self.db = db
+        self.ttl = ttl
+        self.socket_timeout = socket_timeout
+        self._local = threading.local()
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        """
+        :param url: redis://host:port/db style url
+        :return: RedisBackend
+        """
+        parsed = urlparse(url)
+        db = parsed.path.strip('/')
+        return cls(host=parsed.hostname or 'localhost',
+                   port=parsed.port or 6379,
+                   db=int(db) if db else 0,
+                   **kwargs)
+
+    def get(self, key):
+        return self._command('GET', key)
+
+    def get_many(self, keys):
+        if not keys:
+            return []
+
+        return self._command('MGET', *keys)
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        if ttl is None:
+            self._command('SET', key, value)
+        else:
+            self._command('SET', key, value, 'EX', int(ttl))
+
+    def set_many(self, mapping, ttl=None):
+        if not mapping:
+            return
+
+        ttl = self.ttl if ttl is None else ttl
+        if ttl is None:
+            args = []
+            for key, value in mapping.items():
+                args.extend([key, value])
+            self._command('MSET', *args)
+        else:
+            for key, value in mapping.items():
+                self._command('SET', key, value, 'EX', int(ttl))
+
+    def add(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        if ttl is None:
+            return self._command('SET', key, value, 'NX') is not None
+
+        return self._command('SET', key, value, 'EX', int(ttl),
+                             'NX') is not None
+
+    def delete(self, *keys):
+        if keys:
+            self._command('DEL', *keys)
+
+    def stats(self):
+        return {
+            'backend': 'redis',
+            'host': self.host,
+            'port': self.port,
+            'db': self.db
+        }
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            sock = socket.create_connection((self.host, self.port),
+                                            self.socket_timeout)
+            conn = (sock, sock.makefile('rb'))
+            self._local.conn = conn
+            if self.db:
+                self._command('SELECT', self.db)
+
+        return conn
+
+    def _disconnect(self):
+        conn = getattr(self._local, 'conn', None)
+        self._local.conn = None
+        if conn is not None:
+            conn[1].close()
+            conn[0].close()
+
+    def _command(self, *args):
+        parts = ['*{}\r\n'.format(len(args)).encode('ascii')]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = u'{}'.format(arg).encode('utf-8')
+            parts.append('${}\r\n'.format(len(arg)).encode('ascii'))
+            parts.append(arg + b'\r\n')
+
+        try:
+            sock, reader = self._connection()
+            sock.sendall(b''.join(parts))
+            return self._read_reply(reader)
+        except (socket.error, EOFError) as e:
+            self._disconnect()
+            raise CacheError(str(e))
+
+    def _read_reply(self, reader):
+        line = reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise EOFError('connection closed by redis server')
+
+        kind, payload = line[:1], line[1:-2]
+        if kind == b'+':
+            return payload
+        if kind == b'-':
+            raise CacheError(payload.decode('utf-8'))
+        if kind == b':':
+            return int(payload)
+        if kind == b'$':
+            length = int(payload)
+            if length < 0:
+                return None
+            data = reader.read(length + 2)
+            return data[:-2]
+        if kind == b'*':
+            length = int(payload)
+            if length < 0:
+                return None
+            return [self._read_reply(reader) for _ in range(length)]
+
+        raise CacheError('unexpected reply from redis server')
+
+
+class VersionedCache(object):
+    """
+    Stores values under ``<namespace>:<id>:<version>`` keys next to a
+    ``v:<namespace>:<id>`` key holding the current version.
+
+    Readers fetch the version before they go to the database and store
+    what they read under that version, so a value read while a write
+    was in flight lands under an old version and is never served.
+    """
+
+    def __init__(self, backend):
+        """
+        :param backend: LRUCache, RedisBackend or anything with the same
+                        interface
+        """
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def lookup(self, namespace, id):
+        """
+        :param namespace: kind of entity, e.g. 'user' or 'group'
+        :param id: userid or groupid
+        :return: tuple of the cached value (or None) and a token to
+                 pass to store() after a miss
+        """
+        version_key = self._version_key(namespace, id)
+        try:
+            version = self.backend.get(version_key)
+            if version is None:
+                # Start at a random version so data stored under a
+                # version that was since evicted can't come back.
+                self.backend.add(version_key, self._new_version())
+                version = self.backend.get(version_key)
+
+            value = None
+            if version is not None:
+                value = self.backend.get(self._data_key(namespace, id,
+                                                        version))
+        except CacheError:
+            self.errors += 1
+            return None, None
+
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        return value, version
+
+    def store(self, namespace, id, token, value):
+        """
+        :param namespace: kind of entity
+        :param id: userid or groupid
+        :param token: version token returned by lookup()
+        :param value: value to cache
+        """
+        if token is None:
+            return
+
+        try:
+            self.backend.set(self._data_key(namespace, id, token), value)
+        except CacheError:
+            self.errors += 1
+
+    def invalidate(self, namespace, ids):
+        """
+        Moves every given entity to a new version.
+
+        :param namespace: kind of entity
+        :param ids: userids or groupids
+        """
+        mapping = dict((self._version_key(namespace, x), self._new_version())
+                       for x in ids)
+        try:
+            self.backend.set_many(mapping)
+        except CacheError:
+            self.errors += 1
+
+    def stats(self):
+        """
+        :return: dict of counters merged with the backend's own stats
+        """
+        stats = self.backend.stats()
+        stats.update(hits=self.hits, misses=self.misses, errors=self.errors)
+        return stats
+
+    def _version_key(self, namespace, id):
+        return u'v:{}:{}'.format(namespace, id)
+
+    def _data_key(self, namespace, id, version):
+        if isinstance(version, bytes):
+            version = version.decode('ascii')
+        return u'{}:{}:{}'.format(namespace, id, version)
+
+    def _new_version(self):
+        return binascii.hexlify(os.urandom(8)).decode('ascii')
@@ -0,0 +1,408 @@
+"""
+Engine setup for the app's database.
+
+Flask-SQLAlchemy creates the engine lazily from the app config.  The
+SQLAlchemy subclass here hooks into that to add a connection health
+check and, for SQLite, to turn on foreign keys and apply the PRAGMAs of
+the configured tuning profile to every new connection.
+
+With DB_REPLICA_URLS set it can also send a session's statements to a
+read replica, picked round robin from the ones that haven't failed
+recently, see use_replica().  Mutations always go to the primary.
+
+With DB_SHARD_URLS set users and their memberships are partitioned over
+several databases, each holding the whole schema, by a stable hash of
+the userid, see shard_for() and use_shard().
+"""
+import threading
+import time
+import weakref
+import zlib
+
+from flask import current_app
+from flask.ext.sqlalchemy import (
+    SQLAlchemy as BaseSQLAlchemy,
+    SignallingSession,
+    _EngineConnector,
+    get_state
+)
+from sqlalchemy import event, exc, select
+from sqlalchemy.pool import QueuePool
+
+# PRAGMAs applied to every new SQLite connection for each value of the
+# SQLITE_PROFILE setting.  The production profile switches to a write
+# ahead log so readers don't block on writers, only fsyncs at WAL
+# checkpoints, memory maps the database file and waits on locks
+# instead of failing with "database is locked".
+SQLITE_PROFILES = {
+    'default': [],
+    'production': [
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'NORMAL'),
+        ('mmap_size', 268435456),
+        ('busy_timeout', 5000),
+    ]
+}
+
+
+class SQLAlchemy(BaseSQLAlchemy):
+    """
+    Flask-SQLAlchemy extension that configures each engine it creates
+    from the DB_* and SQLITE_* config values.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._configured_engines = weakref.WeakSet()
+        # Functions called with (app, engine) for every new engine so
+        # other extensions can register their own engine events.
+        self.engine_hooks = []
+        self._replica_lock = threading.Lock()
+        super(SQLAlchemy, self).__init__(*args, **kwargs)
+
+    def init_app(self, app):
+        app.config.setdefault('DB_POOL_PRE_PING', False)
+        app.config.setdefault('SQLITE_PROFILE', 'default')
+        app.config.setdefault('SQLITE_BUSY_TIMEOUT', None)
+        app.config.setdefault('SQLITE_MMAP_SIZE', None)
+        app.config.setdefault('DB_REPLICA_URLS', [])
+        app.config.setdefault('DB_REPLICA_EJECT_SECONDS', 30)
+        app.config.setdefault('DB_SHARD_URLS', [])
+        super(SQLAlchemy, self).init_app(app)
+
+    def get_app(self, reference_app=None):
+        # The current app comes before the one the extension was bound
+        # to so every app built by create_app() uses its own config,
+        # the bound app only serves code running outside of any app.
+        if reference_app is not None:
+            return reference_app
+        if current_app:
+            return current_app._get_current_object()
+        return super(SQLAlchemy, self).get_app()
+
+    def dispose_engines(self, app=None):
+        """
+        Closes the pooled connections of every engine the app has
+        opened, e.g. before forking workers that each need their own.
+
+        :param app: flask app, the current one by default
+        """
+        state = get_state(self.get_app(app))
+        for connector in list(state.connectors.values()):
+            connector.get_engine().dispose()
+
+    def create_session(self, options):
+        return RoutingSession(self, **options)
+
+    def make_connector(self, app, bind=None):
+        if isinstance(bind, str) and bind.startswith(BIND_LISTS):
+            return ListBindConnector(self, app, bind)
+        return super(SQLAlchemy, self).make_connector(app, bind)
+
+    def _execute_for_all_tables(self, app, bind, operation,
+                                skip_tables=False):
+        super(SQLAlchemy, self)._execute_for_all_tables(
+            app, bind, operation, skip_tables)
+        if bind == '__all__':
+            # Every shard holds the whole schema
+            super(SQLAlchemy, self)._execute_for_all_tables(
+                app, self.get_shard_binds(app), operation, skip_tables=True)
+
+    def apply_driver_hacks(self, app, info, options):
+        super(SQLAlchemy, self).apply_driver_hacks(app, info, options)
+        # SQLAlchemy defaults file based SQLite databases to a NullPool
+        # which opens a new connection, and re-runs the PRAGMAs, for
+        # every checkout.  Use a real pool when a size is configured,
+        # the pool only hands a connection to one thread at a time so
+        # pysqlite's same thread check can be turned off.
+        if (info.drivername.startswith('sqlite') and
+                info.database not in (None, '', ':memory:') and
+                options.get('pool_size') and 'poolclass' not in options):
+            options['poolclass'] = QueuePool
+            options.setdefault('connect_args', {})['check_same_thread'] = False
+
+    def get_engine(self, app, bind=None):
+        engine = super(SQLAlchemy, self).get_engine(app, bind)
+        if engine not in self._configured_engines:
+            configure_engine(app, engine)
+            for hook in self.engine_hooks:
+                hook(app, engine)
+            self._configured_engines.add(engine)
+
+        return engine
+
+    def get_replica_pool(self, app=None):
+        """
+        :param app: flask app, the current one by default
+        :return: ReplicaPool or None when no replicas are configured
+        """
+        app = self.get_app(app)
+        urls = app.config['DB_REPLICA_URLS']
+        if not urls:
+            return None
+
+        pool = app.extensions.get('replica_pool')
+        if pool is None:
+            with self._replica_lock:
+                pool = app.extensions.get('replica_pool')
+                if pool is None:
+                    pool = ReplicaPool(
+                        [replica_bind(i) for i in range(len(urls))],
+                        app.config['DB_REPLICA_EJECT_SECONDS'])
+                    app.extensions['replica_pool'] = pool
+
+        return pool
+
+    def use_replica(self):
+        """
+        Sends the rest of the current session's statements to the next
+        healthy read replica, or to the primary if there isn't one.
+
+        :return: bind key of the replica or None
+        """
+        pool = self.get_replica_pool()
+        replica = pool.choose() if pool is not None else None
+        if replica is None:
+            self.session.info.pop('replica', None)
+        else:
+            self.session.info['replica'] = replica
+        return replica
+
+    def use_primary(self):
+        """
+        Sends the rest of the current session's statements to the
+        primary.
+
+        :return: bind key of the replica that was in use or None
+        """
+        return self.session.info.pop('replica', None)
+
+    def get_shard_binds(self, app=None):
+        """
+        :param app: flask app, the current one by default
+        :return: bind keys of the shards, empty when not sharded
+        """
+        app = self.get_app(app)
+        return [shard_bind(i)
+                for i in range(len(app.config['DB_SHARD_URLS']))]
+
+    def shard_for(self, userid, app=None):
+        """
+        :param userid: userid string
+        :param app: flask app, the current one by default
+        :return: bind key of the shard holding the user, None when not
+                 sharded
+        """
+        count = len(self.get_app(app).config['DB_SHARD_URLS'])
+        if not count:
+            return None
+        return shard_bind(shard_index(userid, count))
+
+    def use_shard(self, bind):
+        """
+        Sends the rest of the current session's statements to a shard,
+        ahead of any read replica.
+
+        :param bind: bind key of the shard, None leaves the session as
+                     it is
+        """
+        if bind is not None:
+            self.session.info['shard'] = bind
+
+
+# Replica and shard engines are kept by Flask-SQLAlchemy under bind keys
+# made of one of these prefixes and the position of the database's URI
+# in the config list named by the prefix.
+REPLICA_BIND_PREFIX = 'replica:'
+SHARD_BIND_PREFIX = 'shard:'
+BIND_LISTS = (REPLICA_BIND_PREFIX, SHARD_BIND_PREFIX)
+BIND_LIST_CONFIG = {
+    REPLICA_BIND_PREFIX: 'DB_REPLICA_URLS',
+    SHARD_BIND_PREFIX: 'DB_SHARD_URLS',
+}
+
+
+def replica_bind(index):
+    """
+    :param index: position of the replica in DB_REPLICA_URLS
+    :return: bind key of the replica's engine
+    """
+    return '{}{}'.format(REPLICA_BIND_PREFIX, index)
+
+
+def shard_bind(index):
+    """
+    :param index: position of the shard in DB_SHARD_URLS
+    :return: bind key of the shard's engine
+    """
+    return '{}{}'.format(SHARD_BIND_PREFIX, index)
+
+
+def shard_index(userid, count):
+    """
+    CRC32 rather than hash() so every process, and every Python
+    version, puts a userid on the same shard.
+
+    :param userid: userid string
+    :param count: number of shards
+    :return: position of the userid's shard
+    """
+    return (zlib.crc32(userid.encode('utf-8')) & 0xffffffff) % count
+
+
+class ListBindConnector(_EngineConnector):
+    """
+    Engine connector for a replica or shard bind, reads its URI from
+    DB_REPLICA_URLS or DB_SHARD_URLS instead of SQLALCHEMY_BINDS.
+    """
+
+    def get_uri(self):
+        prefix, index = self._bind.split(':')
+        config_name = BIND_LIST_CONFIG[prefix + ':']
+        return self._app.config[config_name][int(index)]
+
+
+class RoutingSession(SignallingSession):
+    """
+    Session that runs everything on the shard named by info['shard'] or
+    the replica named by info['replica'] when either is set and on the
+    usual binds otherwise.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        bind = self.info.get('shard') or self.info.get('replica')
+        if bind is not None:
+            return get_state(self.app).db.get_engine(self.app, bind=bind)
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+
+class ReplicaPool(object):
+    """
+    Round robin over an app's read replicas.  A replica that fails is
+    ejected and skipped for eject_seconds, then tried again.  Safe to
+    use from several threads.
+    """
+
+    def __init__(self, keys, eject_seconds=30):
+        """
+        :param keys: replica bind keys
+        :param eject_seconds: how long a failed replica is skipped
+        """
+        self.keys = list(keys)
+        self.eject_seconds = eject_seconds
+        self.ejections = 0
+        # bind key -> time it can be used again
+        self._ejected = {}
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def choose(self):
+        """
+        :return: bind key of the next healthy replica, None if every
+                 replica is ejected
+        """
+        now = time.time()
+        with self._lock:
+            for _ in range(len(self.keys)):
+                key = self.keys[self._next % len(self.keys)]
+                self._next += 1
+                if self._ejected.get(key, 0) <= now:
+                    self._ejected.pop(key, None)
+                    return key
+        return None
+
+    def eject(self, key):
+        """
+        :param key: bind key of the replica that failed
+        """
+        with self._lock:
+            self._ejected[key] = time.time() + self.eject_seconds
+            self.ejections += 1
+
+    def stats(self):
+        """
+        :return: dict of the number of replicas, the ones currently
+                 ejected and the number of ejections so far
+        """
+        now = time.time()
+        with self._lock:
+            return {
+                'replicas': len(self.keys),
+                'ejected': sorted(k for k, t in self._ejected.items()
+                                  if t > now),
+                'ejections': self.ejections
+            }
+
+
+def configure_engine(app, engine):
+    """
+    Registers the connection event hooks asked for by the app config
+    on a newly created engine.
+
+    :param app: flask app the engine belongs to
+    :param engine: sqlalchemy engine
+    """
+    if app.config['DB_POOL_PRE_PING']:
+        event.listen(engine, 'engine_connect', ping_connection)
+
+    if engine.dialect.name == 'sqlite':
+        pragmas = sqlite_pragmas(app.config)
+
+        def on_connect(dbapi_connection, connection_record):
+            set_sqlite_pragmas(dbapi_connection, pragmas)
+        event.listen(engine, 'connect', on_connect)
+
+
+def sqlite_pragmas(config):
+    """
+    :param config: app config
+    :return: list of (pragma, value) tuples for the configured profile
+    """
+    pragmas = dict(SQLITE_PROFILES[config['SQLITE_PROFILE']])
+    if config['SQLITE_BUSY_TIMEOUT'] is not None:
+        pragmas['busy_timeout'] = config['SQLITE_BUSY_TIMEOUT']
+    if config['SQLITE_MMAP_SIZE'] is not None:
+        pragmas['mmap_size'] = config['SQLITE_MMAP_SIZE']
+
+    # Needed for the ON DELETE CASCADE on usergroups, SQLite ignores
+    # foreign keys unless they're switched on for each connection.
+    pragmas['foreign_keys'] = 'ON'
+
+    # journal_mode has to be switched first, the others don't care
+    return sorted(pragmas.items(), key=lambda x: x[0] != 'journal_mode')
+
+
+def set_sqlite_pragmas(dbapi_connection, pragmas):
+    """
+    :param dbapi_connection: raw sqlite3 connection
+    :param pragmas: list of (pragma, value) tuples
+    """
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in pragmas:
+            cursor.execute('PRAGMA {}={}'.format(name, value))
+    finally:
+        cursor.close()
+
+
+def ping_connection(connection, branch):
+    """
+    Checks a connection is alive when it's checked out of the pool and
+    transparently reconnects if it isn't.
+    """
+    if branch:
+        # Sub-connections share the parent's DBAPI connection
+        return
+
+    save_should_close_with_result = connection.should_close_with_result
+    connection.should_close_with_result = False
+    try:
+        connection.scalar(select([1]))
+    except exc.DBAPIError as err:
+        # The pool invalidates itself when it sees a disconnect so
+        # running the ping again gets a fresh connection.
+        if err.connection_invalidated:
+            connection.scalar(select([1]))
+        else:
+            raise
+    finally:
+        connection.should_close_with_result = save_should_close_with_result
@@ -0,0 +1,182 @@
+"""
+Groups nested in groups.
+
+groupgroups holds the direct parent -> child edges and groupclosure
+every (ancestor, descendant, depth) reachable through them, so the
+effective groups of a user, or effective members of a group, are one
+indexed lookup instead of a walk of the hierarchy.  A group may have
+several parents, paths counts the distinct paths of each length
+between two groups so removing one edge only takes away the paths
+that went through it.  Groups aren't in the closure with themselves.
+
+Every function takes anything with an execute() method, a session or a
+connection, and leaves committing to the caller.
+"""
+from collections import defaultdict
+
+from sqlalchemy import and_, bindparam, column, select, table
+
+group_groups = table('groupgroups', column('parentid'), column('childid'))
+group_closure = table('groupclosure', column('ancestor'),
+                      column('descendant'), column('depth'), column('paths'))
+
+# SQLite limits the number of bound parameters in a statement
+CHUNK_SIZE = 500
+
+
+def would_cycle(conn, parent_id, child_id):
+    """
+    :param conn: session or connection
+    :param parent_id: groups.id of the parent
+    :param child_id: groups.id of the child
+    :return: True if the child is the parent or one of its ancestors
+    """
+    if parent_id == child_id:
+        return True
+
+    row = conn.execute(
+        select([group_closure.c.depth])
+        .where(and_(group_closure.c.ancestor == child_id,
+                    group_closure.c.descendant == parent_id))
+        .limit(1)).first()
+    return row is not None
+
+
+def add_edge(conn, parent_id, child_id):
+    """
+    Nests a group in another and adds every path through the new edge
+    to the closure.  The caller checks would_cycle() first.
+
+    :param conn: session or connection
+    :param parent_id: groups.id of the parent
+    :param child_id: groups.id of the child
+    """
+    conn.execute(group_groups.insert(),
+                 [{'parentid': parent_id, 'childid': child_id}])
+    _apply_paths(conn, parent_id, child_id, 1)
+
+
+def remove_edge(conn, parent_id, child_id):
+    """
+    Takes a group out of another and every path through that edge out
+    of the closure.
+
+    :param conn: session or connection
+    :param parent_id: groups.id of the parent
+    :param child_id: groups.id of the child
+    """
+    conn.execute(group_groups.delete().where(and_(
+        group_groups.c.parentid == parent_id,
+        group_groups.c.childid == child_id)))
+    _apply_paths(conn, parent_id, child_id, -1)
+
+
+def get_edges(conn, group_id):
+    """
+    :param conn: session or connection
+    :param group_id: groups.id
+    :return: tuple of lists of the groups.id of the group's direct
+             parents and direct children
+    """
+    parents = conn.execute(select([group_groups.c.parentid])
+                           .where(group_groups.c.childid == group_id))
+    children = conn.execute(select([group_groups.c.childid])
+                            .where(group_groups.c.parentid == group_id))
+    return [x[0] for x in parents], [x[0] for x in children]
+
+
+def rebuild(conn):
+    """
+    Recomputes the whole closure from the edges, for databases loaded
+    without going through add_edge().
+
+    :param conn: session or connection
+    :return: number of closure rows written
+    """
+    children = defaultdict(list)
+    for parent_id, child_id in conn.execute(
+            select([group_groups.c.parentid, group_groups.c.childid])):
+        children[parent_id].append(child_id)
+
+    conn.execute(group_closure.delete())
+    rows = []
+    for ancestor in list(children):
+        # Breadth first, one level of depth at a time, counting the
+        # paths that reach each group at that depth.
+        level = {ancestor: 1}
+        depth = 0
+        while level:
+            depth += 1
+            following = defaultdict(int)
+            for group_id, paths in level.items():
+                for child_id in children.get(group_id, ()):
+                    following[child_id] += paths
+            rows.extend({'ancestor': ancestor, 'descendant': x,
+                         'depth': depth, 'paths': n}
+                        for x, n in following.items())
+            level = following
+
+    for start in range(0, len(rows), CHUNK_SIZE):
+        conn.execute(group_closure.insert(), rows[start:start + CHUNK_SIZE])
+    return len(rows)
+
+
+def _apply_paths(conn, parent_id, child_id, sign):
+    # Every path through parent -> child is a path from an ancestor of
+    # the parent (or the parent) to the parent followed by one from
+    # the child (or the child) to a descendant of the child.
+    above = [(parent_id, 0, 1)] + conn.execute(
+        select([group_closure.c.ancestor, group_closure.c.depth,
+                group_closure.c.paths])
+        .where(group_closure.c.descendant == parent_id)).fetchall()
+    below = [(child_id, 0, 1)] + conn.execute(
+        select([group_closure.c.descendant, group_closure.c.depth,
+                group_closure.c.paths])
+        .where(group_closure.c.ancestor == child_id)).fetchall()
+
+    delta = defaultdict(int)
+    for ancestor, up, up_paths in above:
+        for descendant, down, down_paths in below:
+            delta[(ancestor, descendant, up + down + 1)] += \
+                sign * up_paths * down_paths
+
+    existing = {}
+    ancestors = list(set(x[0] for x in above))
+    descendants = list(set(x[0] for x in below))
+    for a_start in range(0, len(ancestors), CHUNK_SIZE):
+        for d_start in range(0, len(descendants), CHUNK_SIZE):
+            rows = conn.execute(
+                select([group_closure.c.ancestor,
+                        group_closure.c.descendant,
+                        group_closure.c.depth, group_closure.c.paths])
+                .where(and_(
+                    group_closure.c.ancestor.in_(
+                        ancestors[a_start:a_start + CHUNK_SIZE]),
+                    group_closure.c.descendant.in_(
+                        descendants[d_start:d_start + CHUNK_SIZE]))))
+            existing.update(((a, d, depth), paths)
+                            for a, d, depth, paths in rows)
+
+    inserts, updates, deletes = [], [], []
+    for key, change in delta.items():
+        paths = existing.get(key, 0) + change
+        values = {'a': key[0], 'd': key[1], 'n': key[2], 'p': paths}
+        if paths > 0 and key not in existing:
+            inserts.append({'ancestor': key[0], 'descendant': key[1],
+                            'depth': key[2], 'paths': paths})
+        elif paths > 0:
+            updates.append(values)
+        elif key in existing:
+            deletes.append(values)
+
+    # Bound parameters can't share a name with a column being updated
+    match = and_(group_closure.c.ancestor == bindparam('a'),
+                 group_closure.c.descendant == bindparam('d'),
+                 group_closure.c.depth == bindparam('n'))
+    if inserts:
+        conn.execute(group_closure.insert(), inserts)
+    if updates:
+        conn.execute(group_closure.update().where(match)
+                     .values(paths=bindparam('p')), updates)
+    if deletes:
+        conn.execute(group_closure.delete().where(match), deletes)
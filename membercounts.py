@@ -0,0 +1,49 @@
+"""
+Member counts of groups.
+
+groups.member_count is the number of the group's rows in usergroups.
+Every write that adds or removes memberships adjusts it in the same
+transaction, so counting a group's members, or listing groups by size,
+doesn't read usergroups.  recount() puts the counts right from
+usergroups, for databases loaded without going through adjust() or
+counts that have drifted.
+
+Every function takes anything with an execute() method, a session or a
+connection, and leaves committing to the caller.
+"""
+from sqlalchemy import bindparam, column, func, select, table
+
+groups = table('groups', column('id'), column('member_count'))
+user_groups = table('usergroups', column('userid'), column('groupid'))
+
+
+def adjust(conn, deltas):
+    """
+    :param conn: session or connection
+    :param deltas: dict of groups.id -> number of members added, less
+                   the number removed
+    """
+    params = [{'group_id': group_id, 'delta': delta}
+              for group_id, delta in deltas.items() if delta]
+    if params:
+        conn.execute(groups.update()
+                     .where(groups.c.id == bindparam('group_id'))
+                     .values(member_count=groups.c.member_count +
+                             bindparam('delta')),
+                     params)
+
+
+def recount(conn):
+    """
+    Recomputes the member count of every group.
+
+    :param conn: session or connection
+    :return: number of groups whose count was wrong
+    """
+    counted = (select([func.count()])
+               .where(user_groups.c.groupid == groups.c.id)
+               .as_scalar())
+    result = conn.execute(groups.update()
+                          .where(groups.c.member_count != counted)
+                          .values(member_count=counted))
+    return result.rowcount
@@ -0,0 +1,155 @@
+"""
+In-memory index of group memberships for answering "is user X in group
+Y?" without going to the database.
+
+Users and groups are keyed by their integer primary keys, each group
+holds a RoaringBitmap of its members' ids and each user a RoaringBitmap
+of its groups' ids.  userid and groupid strings are mapped to ids with
+plain dicts.
+"""
+import threading
+
+from bitmap import RoaringBitmap
+
+
+class MembershipIndex(object):
+    """
+    Membership index kept up to date by the app's write routes.  Every
+    method is safe to call from several threads.
+    """
+
+    def __init__(self):
+        self.user_ids = {}
+        self.group_ids = {}
+        self.userids = {}
+        self.groupids = {}
+        self.members = {}
+        self.memberships = {}
+        self._lock = threading.Lock()
+
+    def load(self, users, groups, rows):
+        """
+        Replaces the whole index.
+
+        :param users: iterable of (users.id, userid)
+        :param groups: iterable of (groups.id, groupid)
+        :param rows: iterable of (usergroups.userid, usergroups.groupid)
+        """
+        user_ids, userids = {}, {}
+        for user_id, userid in users:
+            user_ids[userid] = user_id
+            userids[user_id] = userid
+
+        group_ids, groupids = {}, {}
+        for group_id, groupid in groups:
+            group_ids[groupid] = group_id
+            groupids[group_id] = groupid
+
+        members = dict((x, RoaringBitmap()) for x in groupids)
+        memberships = dict((x, RoaringBitmap()) for x in userids)
+        for user_id, group_id in rows:
+            members[group_id].add(user_id)
+            memberships[user_id].add(group_id)
+
+        with self._lock:
+            self.user_ids, self.userids = user_ids, userids
+            self.group_ids, self.groupids = group_ids, groupids
+            self.members, self.memberships = members, memberships
+
+    def is_member(self, userid, groupid):
+        """
+        :param userid: userid string
+        :param groupid: groupid string
+        :return: True or False, None if the user or group doesn't exist
+        """
+        with self._lock:
+            user_id = self.user_ids.get(userid)
+            group_id = self.group_ids.get(groupid)
+            if user_id is None or group_id is None:
+                return None
+
+            return user_id in self.members[group_id]
+
+    def set_user(self, user_id, userid, groups):
+        """
+        Adds a user or replaces everything known about it.
+
+        :param user_id: users.id
+        :param userid: userid string, may have changed
+        :param groups: iterable of (groups.id, groupid) the user is in
+        """
+        with self._lock:
+            self._remove_user(user_id)
+            self.user_ids[userid] = user_id
+            self.userids[user_id] = userid
+            memberships = self.memberships[user_id] = RoaringBitmap()
+            for group_id, groupid in groups:
+                self._ensure_group(group_id, groupid)
+                self.members[group_id].add(user_id)
+                memberships.add(group_id)
+
+    def remove_user(self, user_id):
+        """
+        :param user_id: users.id
+        """
+        with self._lock:
+            self._remove_user(user_id)
+
+    def set_group(self, group_id, groupid, users):
+        """
+        Adds a group or replaces its members.
+
+        :param group_id: groups.id
+        :param groupid: groupid string
+        :param users: iterable of (users.id, userid) in the group
+        """
+        with self._lock:
+            for user_id in self.members.get(group_id, ()):
+                self.memberships[user_id].discard(group_id)
+
+            self._ensure_group(group_id, groupid)
+            members = self.members[group_id] = RoaringBitmap()
+            for user_id, userid in users:
+                if user_id not in self.memberships:
+                    self.user_ids[userid] = user_id
+                    self.userids[user_id] = userid
+                    self.memberships[user_id] = RoaringBitmap()
+                members.add(user_id)
+                self.memberships[user_id].add(group_id)
+
+    def remove_group(self, group_id):
+        """
+        :param group_id: groups.id
+        """
+        with self._lock:
+            for user_id in self.members.pop(group_id, ()):
+                self.memberships[user_id].discard(group_id)
+
+            groupid = self.groupids.pop(group_id, None)
+            if groupid is not None:
+                self.group_ids.pop(groupid, None)
+
+    def stats(self):
+        """
+        :return: dict of index sizes
+        """
+        with self._lock:
+            return {
+                'users': len(self.userids),
+                'groups': len(self.groupids),
+                'memberships': sum(len(x) for x in self.members.values())
+            }
+
+    def _ensure_group(self, group_id, groupid):
+        if group_id not in self.members:
+            self.members[group_id] = RoaringBitmap()
+            self.groupids[group_id] = groupid
+            self.group_ids[groupid] = group_id
+
+    def _remove_user(self, user_id):
+        for group_id in self.memberships.pop(user_id, ()):
+            self.members[group_id].discard(user_id)
+
+        userid = self.userids.pop(user_id, None)
+        if userid is not None:
+            self.user_ids.pop(userid, None)
@@ -0,0 +1,302 @@
+"""
+Per route request instrumentation rendered in the Prometheus text
+format.
+
+For every request it records the latency, the number of SQL statements
+and the time spent running them, the number of commits and the request
+and response body sizes, labelled by the endpoint and method.  Nothing
+is recorded unless METRICS_ENABLED is set, the SQL hooks only check for
+a flag on the current request.
+
+With METRICS_DEBUG_HEADER set a client can send ``X-Debug-Queries: 1``
+to get ``X-Query-Count`` and ``X-Query-Time`` headers back for that one
+request.
+
+Statements a request runs on other threads, such as the shard pool,
+are recorded in stats of their own handed out by worker_stats() and
+added to the request's by merge_stats() once the threads are done.
+
+Streamed responses are recorded when they are closed, so the latency,
+statements and bytes include sending the body.  Streams have to keep
+the request context, with stream_with_context, for their statements
+to be counted.
+"""
+import threading
+import time
+from flask import current_app, g, has_app_context, request
+from sqlalchemy import event
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+
+class Histogram(object):
+    """
+    Cumulative histogram with fixed bucket upper bounds.
+    """
+
+    def __init__(self, buckets):
+        """
+        :param buckets: sorted tuple of bucket upper bounds
+        """
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        """
+        :param value: observed value
+        """
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+class RequestMetrics(object):
+    """
+    Flask extension collecting request and SQL metrics.
+    """
+
+    def __init__(self, app=None, db=None):
+        self._lock = threading.Lock()
+        self.reset()
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db):
+        """
+        :param app: flask app
+        :param db: the app's SQLAlchemy extension from database.py
+        """
+        app.config.setdefault('METRICS_ENABLED', False)
+        app.config.setdefault('METRICS_DEBUG_HEADER', False)
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        if self._instrument_engine not in db.engine_hooks:
+            db.engine_hooks.append(self._instrument_engine)
+
+    def reset(self):
+        """
+        Drops everything recorded so far.
+        """
+        with self._lock:
+            self.requests = {}
+            self.latency = {}
+            self.statements = {}
+            self.counters = {}
+
+    def render(self, extra=None):
+        """
+        :param extra: optional list of (name, help, type, value) tuples
+                      for unlabelled metrics to include
+        :return: metrics in the Prometheus text exposition format
+        """
+        lines = []
+        with self._lock:
+            self._render_counter(
+                lines, 'http_requests_total', 'Requests handled.',
+                self.requests, ('endpoint', 'method', 'status'))
+            self._render_histogram(
+                lines, 'http_request_duration_seconds',
+                'Request latency in seconds.', self.latency)
+            self._render_histogram(
+                lines, 'http_request_sql_statements',
+                'SQL statements executed per request.', self.statements)
+            for name, help in (
+                    ('sql_duration_seconds_total',
+                     'Seconds spent executing SQL statements.'),
+                    ('db_commits_total', 'Transactions committed.'),
+                    ('http_request_bytes_total', 'Request body bytes.'),
+                    ('http_response_bytes_total', 'Response body bytes.')):
+                self._render_counter(
+                    lines, name, help,
+                    dict((k[1:], v) for k, v in self.counters.items()
+                         if k[0] == name),
+                    ('endpoint', 'method'))
+
+        for name, help, kind, value in extra or []:
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            lines.append('{} {}'.format(name, value))
+
+        return '\n'.join(lines) + '\n'
+
+    def worker_stats(self):
+        """
+        :return: stats for a thread working on the current request to
+                 pass to use_stats(), None when it isn't being measured
+        """
+        if self._current_stats() is None:
+            return None
+
+        return {'statements': 0, 'sql_time': 0.0, 'commits': 0}
+
+    def use_stats(self, stats):
+        """
+        Records the statements run in the current app context, on a
+        worker thread, in stats from worker_stats().
+
+        :param stats: dict from worker_stats() or None
+        """
+        if stats is not None:
+            g.request_stats = stats
+
+    def merge_stats(self, stats):
+        """
+        Adds what worker threads recorded to the current request's stats.
+
+        :param stats: list of dicts from worker_stats() or None
+        """
+        request_stats = self._current_stats()
+        if request_stats is None:
+            return
+
+        for worker in stats:
+            if worker is not None:
+                for name in ('statements', 'sql_time', 'commits'):
+                    request_stats[name] += worker[name]
+
+    def _enabled(self):
+        return (current_app.config['METRICS_ENABLED'] or
+                (current_app.config['METRICS_DEBUG_HEADER'] and
+                 request.headers.get('X-Debug-Queries')))
+
+    def _before_request(self):
+        if self._enabled():
+            g.request_stats = {'start': time.time(), 'statements': 0,
+                               'sql_time': 0.0, 'commits': 0}
+
+    def _after_request(self, response):
+        stats = getattr(g, 'request_stats', None)
+        if stats is None:
+            return response
+
+        latency = time.time() - stats['start']
+        if current_app.config['METRICS_DEBUG_HEADER'] and \
+                request.headers.get('X-Debug-Queries'):
+            response.headers['X-Query-Count'] = str(stats['statements'])
+            response.headers['X-Query-Time'] = '{:.6f}'.format(
+                stats['sql_time'])
+
+        if not current_app.config['METRICS_ENABLED']:
+            return response
+
+        # Labelled by the view's name, without its blueprint
+        endpoint = (request.endpoint or 'unknown').rpartition('.')[2]
+        key = (endpoint, request.method)
+        request_bytes = request.content_length or 0
+        if not response.is_streamed:
+            self._record(key, response.status_code, stats, latency,
+                         request_bytes,
+                         response.calculate_content_length() or 0)
+            return response
+
+        # A streamed body runs its statements and is sent after this,
+        # so the request is recorded once the response is closed.
+        sent = [0]
+
+        def count_bytes(chunks):
+            try:
+                for chunk in chunks:
+                    if not isinstance(chunk, bytes):
+                        chunk = chunk.encode(response.charset)
+                    sent[0] += len(chunk)
+                    yield chunk
+            finally:
+                if hasattr(chunks, 'close'):
+                    chunks.close()
+
+        def record():
+            self._record(key, response.status_code, stats,
+                         time.time() - stats['start'], request_bytes,
+                         sent[0])
+
+        response.response = count_bytes(response.response)
+        response.call_on_close(record)
+        return response
+
+    def _record(self, key, status, stats, latency, request_bytes,
+                response_bytes):
+        with self._lock:
+            status_key = key + (str(status),)
+            self.requests[status_key] = self.requests.get(status_key, 0) + 1
+            self.latency.setdefault(
+                key, Histogram(LATENCY_BUCKETS)).observe(latency)
+            self.statements.setdefault(
+                key, Histogram(STATEMENT_BUCKETS)).observe(stats['statements'])
+            for name, value in (
+                    ('sql_duration_seconds_total', stats['sql_time']),
+                    ('db_commits_total', stats['commits']),
+                    ('http_request_bytes_total', request_bytes),
+                    ('http_response_bytes_total', response_bytes)):
+                counter_key = (name,) + key
+                self.counters[counter_key] = (
+                    self.counters.get(counter_key, 0) + value)
+
+    def _instrument_engine(self, app, engine):
+        event.listen(engine, 'before_cursor_execute',
+                     self._before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute',
+                     self._after_cursor_execute)
+        event.listen(engine, 'commit', self._commit)
+
+    def _current_stats(self):
+        if not has_app_context():
+            return None
+
+        return getattr(g, 'request_stats', None)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters,
+                               context, executemany):
+        stats = self._current_stats()
+        if stats is not None:
+            stats['statements'] += 1
+            conn.info.setdefault('query_start', []).append(time.time())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters,
+                              context, executemany):
+        stats = self._current_stats()
+        if stats is not None and conn.info.get('query_start'):
+            stats['sql_time'] += time.time() - conn.info['query_start'].pop()
+
+    def _commit(self, conn):
+        stats = self._current_stats()
+        if stats is not None:
+            stats['commits'] += 1
+
+    def _render_counter(self, lines, name, help, values, label_names):
+        lines.append('# HELP {} {}'.format(name, help))
+        lines.append('# TYPE {} counter'.format(name))
+        for labels, value in sorted(values.items()):
+            lines.append('{}{{{}}} {}'.format(
+                name, format_labels(zip(label_names, labels)), value))
+
+    def _render_histogram(self, lines, name, help, histograms):
+        lines.append('# HELP {} {}'.format(name, help))
+        lines.append('# TYPE {} histogram'.format(name))
+        for (endpoint, method), histogram in sorted(histograms.items()):
+            labels = [('endpoint', endpoint), ('method', method)]
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                lines.append('{}_bucket{{{}}} {}'.format(
+                    name, format_labels(labels + [('le', bound)]), count))
+            lines.append('{}_bucket{{{}}} {}'.format(
+                name, format_labels(labels + [('le', '+Inf')]),
+                histogram.count))
+            lines.append('{}_sum{{{}}} {}'.format(
+                name, format_labels(labels), histogram.sum))
+            lines.append('{}_count{{{}}} {}'.format(
+                name, format_labels(labels), histogram.count))
+
+
+def format_labels(labels):
+    """
+    :param labels: iterable of (name, value) tuples
+    :return: labels formatted for the Prometheus text format
+    """
+    return ','.join('{}="{}"'.format(
+        name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in labels)
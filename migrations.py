@@ -0,0 +1,150 @@
+"""
+Schema migrations for databases created by older versions of the app.
+
+A fresh database is created straight from the models and stamped with
+the latest version.  An existing database gets every migration after
+the version recorded in its schema_version table applied in order.
+
+    python migrations.py
+"""
+from sqlalchemy import Column, Integer, MetaData, Table, func, inspect, select
+
+import membercounts
+import search
+
+metadata = MetaData()
+schema_version = Table('schema_version', metadata,
+    Column('version', Integer, primary_key=True)
+)
+
+
+def add_usergroups_cascade_and_index(conn):
+    """
+    Adds ON DELETE CASCADE to both usergroups foreign keys and an index
+    on (groupid, userid) for group -> users lookups.  SQLite can't alter
+    constraints so the table is rebuilt, dropping any memberships that
+    point at users or groups which no longer exist.
+    """
+    if conn.dialect.name != 'sqlite':
+        raise RuntimeError('usergroups can only be migrated automatically '
+                           'on SQLite, add the constraints by hand')
+
+    conn.execute('ALTER TABLE usergroups RENAME TO usergroups_old')
+    conn.execute('''
+        CREATE TABLE usergroups (
+            userid INTEGER NOT NULL,
+            groupid INTEGER NOT NULL,
+            PRIMARY KEY (userid, groupid),
+            FOREIGN KEY(userid) REFERENCES users (id) ON DELETE CASCADE,
+            FOREIGN KEY(groupid) REFERENCES groups (id) ON DELETE CASCADE
+        )''')
+    conn.execute('''
+        INSERT INTO usergroups (userid, groupid)
+        SELECT userid, groupid FROM usergroups_old
+        WHERE userid IN (SELECT id FROM users)
+        AND groupid IN (SELECT id FROM groups)''')
+    conn.execute('DROP TABLE usergroups_old')
+    conn.execute('CREATE INDEX ix_usergroups_groupid_userid '
+                 'ON usergroups (groupid, userid)')
+
+
+def add_version_columns(conn):
+    """
+    Adds the version counters the ETags of users and groups are built
+    from.  Existing rows start at version 1.
+    """
+    for table in ('users', 'groups'):
+        conn.execute('ALTER TABLE {} ADD COLUMN version INTEGER NOT NULL '
+                     'DEFAULT 1'.format(table))
+
+
+def add_user_search_terms(conn):
+    """
+    Adds the userterms table GET /users/_search looks words up in and
+    indexes every existing user.
+    """
+    conn.execute('''
+        CREATE TABLE userterms (
+            term VARCHAR(32) NOT NULL,
+            userid INTEGER NOT NULL,
+            field SMALLINT NOT NULL,
+            PRIMARY KEY (term, userid, field),
+            FOREIGN KEY(userid) REFERENCES users (id) ON DELETE CASCADE
+        )''')
+    conn.execute('CREATE INDEX ix_userterms_userid ON userterms (userid)')
+    search.rebuild(conn)
+
+
+def add_group_member_counts(conn):
+    """
+    Adds the member counts GET /groups lists groups with and counts
+    the members of every existing group.
+    """
+    conn.execute('ALTER TABLE groups ADD COLUMN member_count INTEGER '
+                 'NOT NULL DEFAULT 0')
+    membercounts.recount(conn)
+
+
+# Every migration in order, a database at version N has had the first
+# N of these applied.
+MIGRATIONS = [
+    add_usergroups_cascade_and_index,
+    add_version_columns,
+    add_user_search_terms,
+    add_group_member_counts,
+]
+
+
+def upgrade(db):
+    """
+    Creates or upgrades the schema of the app's database and, when it's
+    sharded, of every shard.
+
+    :param db: the app's SQLAlchemy extension
+    :return: list of the migrations that were applied, once for every
+             database they were applied to
+    """
+    applied = upgrade_engine(db, db.engine)
+    for bind in db.get_shard_binds():
+        applied.extend(upgrade_engine(db, db.get_engine(db.get_app(), bind)))
+    return applied
+
+
+def upgrade_engine(db, engine):
+    """
+    :param db: the app's SQLAlchemy extension
+    :param engine: engine of the database to upgrade
+    :return: list of the migrations that were applied
+    """
+    applied = []
+    with engine.begin() as conn:
+        tables = set(inspect(conn).get_table_names())
+        schema_version.create(conn, checkfirst=True)
+        current = conn.execute(
+            select([func.max(schema_version.c.version)])).scalar()
+        if current is None:
+            if 'usergroups' in tables:
+                # Created before migrations were tracked
+                current = 0
+            else:
+                db.Model.metadata.create_all(conn)
+                current = len(MIGRATIONS)
+                conn.execute(schema_version.insert(),
+                             [{'version': x + 1} for x in range(current)])
+
+        for version in range(current, len(MIGRATIONS)):
+            migration = MIGRATIONS[version]
+            migration(conn)
+            conn.execute(schema_version.insert(), version=version + 1)
+            applied.append(migration.__name__)
+
+        # Tables added to the models since the last migration
+        db.Model.metadata.create_all(conn)
+
+    return applied
+
+
+if __name__ == '__main__':
+    from app import db
+    for name in upgrade(db):
+        print('Applied {}'.format(name))
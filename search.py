@@ -0,0 +1,164 @@
+"""
+Type-ahead search over users.
+
+userterms holds every word of each user's userid, first and last name,
+lowercased, along with the field it came from.  The words of a query
+are matched as prefixes of those terms with a range scan of the
+primary key, a user has to match every word, and the matches are
+ranked by how good they are: an exact word beats a prefix and the
+userid beats the names, ties are broken by userid.
+
+Only the first max_candidates terms of the longest word's range are
+ranked, in term order, so a query matching a huge number of users, e.g.
+a single letter, costs no more than a specific one.  The longer the
+query, the more complete its results.
+
+Every function takes anything with an execute() method, a session or a
+connection, and leaves committing to the caller.
+"""
+import re
+
+from sqlalchemy import and_, column, select, table
+
+user_terms = table('userterms', column('term'), column('userid'),
+                   column('field'))
+users = table('users', column('id'), column('userid'), column('first_name'),
+              column('last_name'))
+
+USERID, FIRST_NAME, LAST_NAME = 0, 1, 2
+
+# Longest term stored, words are cut down to it
+MAX_TERM_LENGTH = 32
+
+# SQLite limits the number of bound parameters in a statement
+CHUNK_SIZE = 500
+
+_words = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    """
+    :param text: userid, name or query
+    :return: list of the distinct lowercased words, in order
+    """
+    words = []
+    for word in _words.findall((text or u'').lower()):
+        word = word[:MAX_TERM_LENGTH]
+        if word not in words:
+            words.append(word)
+    return words
+
+
+def index_users(conn, rows):
+    """
+    Replaces the terms of users with those of their current userid and
+    names.
+
+    :param conn: session or connection
+    :param rows: list of (users.id, userid, first_name, last_name)
+    """
+    user_ids = [x[0] for x in rows]
+    for start in range(0, len(user_ids), CHUNK_SIZE):
+        conn.execute(user_terms.delete().where(
+            user_terms.c.userid.in_(user_ids[start:start + CHUNK_SIZE])))
+
+    terms = [{'term': term, 'userid': row[0], 'field': field}
+             for row in rows
+             for field in (USERID, FIRST_NAME, LAST_NAME)
+             for term in tokenize(row[field + 1])]
+    if terms:
+        conn.execute(user_terms.insert(), terms)
+
+
+def rebuild(conn, batch_size=5000):
+    """
+    Recomputes every user's terms, for databases loaded without going
+    through index_users().
+
+    :param conn: session or connection
+    :param batch_size: users indexed per statement
+    :return: number of users indexed
+    """
+    conn.execute(user_terms.delete())
+    count, after_id = 0, 0
+    while True:
+        rows = conn.execute(select([users.c.id, users.c.userid,
+                                    users.c.first_name, users.c.last_name])
+                            .where(users.c.id > after_id)
+                            .order_by(users.c.id)
+                            .limit(batch_size)).fetchall()
+        if not rows:
+            return count
+        index_users(conn, rows)
+        count += len(rows)
+        after_id = rows[-1][0]
+
+
+def search(conn, query, limit, max_candidates=500):
+    """
+    :param conn: session or connection
+    :param query: words to look for
+    :param limit: most users returned
+    :param max_candidates: terms of the longest word ranked at most
+    :return: list of (score, userid, first_name, last_name) of the best
+             matching users, best first, lower scores are better
+    """
+    words = tokenize(query)
+    if not words:
+        return []
+
+    # Candidates come from the longest word, usually the most selective.
+    # With more than one word they're read back with all their terms to
+    # be matched against every word in the same round trip.
+    leading = max(words, key=len)
+    candidates = (select([user_terms.c.userid, user_terms.c.term,
+                          user_terms.c.field])
+                  .where(prefix_clause(leading))
+                  .order_by(user_terms.c.term)
+                  .limit(max_candidates)
+                  .alias('candidates'))
+    source = candidates.join(users, users.c.id == candidates.c.userid)
+    terms = candidates
+    if len(words) > 1:
+        terms = user_terms.alias('terms')
+        source = source.join(terms, terms.c.userid == users.c.id)
+    rows = conn.execute(
+        select([users.c.userid, users.c.first_name, users.c.last_name,
+                terms.c.term, terms.c.field])
+        .select_from(source))
+
+    found = {}
+    for userid, first_name, last_name, term, field in rows:
+        user = found.setdefault(userid, (first_name, last_name, {}))
+        best = user[2]
+        for word in words:
+            if term.startswith(word):
+                score = match_score(word, term, field)
+                best[word] = min(score, best.get(word, score))
+
+    ranked = sorted((sum(best.values()), userid, first_name, last_name)
+                    for userid, (first_name, last_name, best)
+                    in found.items() if len(best) == len(words))
+    return ranked[:limit]
+
+
+def match_score(word, term, field):
+    """
+    :param word: word of the query
+    :param term: term starting with the word
+    :param field: USERID, FIRST_NAME or LAST_NAME
+    :return: 0 for the exact userid, 1 an exact name, 2 a prefix of the
+             userid and 3 a prefix of a name
+    """
+    return (0 if term == word else 2) + (0 if field == USERID else 1)
+
+
+def prefix_clause(word):
+    """
+    :param word: lowercased word
+    :return: clause matching the terms starting with word, as a range
+             the primary key answers rather than a LIKE
+    """
+    upper = word[:-1] + unichr(ord(word[-1]) + 1)
+    return and_(user_terms.c.term >= word, user_terms.c.term < upper)
+
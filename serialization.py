@@ -0,0 +1,82 @@
+"""
+JSON encoding and decoding of request and response bodies.
+
+Every backend turns objects into compact JSON bytes and bytes back into
+objects.  orjson is used when it's installed since encoding large
+member lists is where most of a response's CPU time goes, otherwise the
+stdlib json module's C accelerated encoder is used.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class StdlibJSON(object):
+    """
+    Backend using the json module from the standard library.
+    """
+    name = 'json'
+
+    def __init__(self):
+        self._encoder = json.JSONEncoder(separators=(',', ':'))
+
+    def dumps(self, obj):
+        body = self._encoder.encode(obj)
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        return body
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class OrjsonJSON(object):
+    """
+    Backend using orjson, roughly an order of magnitude faster than the
+    stdlib at encoding.
+    """
+    name = 'orjson'
+
+    def __init__(self):
+        if orjson is None:
+            raise ImportError('the orjson JSON backend needs orjson, '
+                              'install it with: pip install orjson')
+
+    def dumps(self, obj):
+        return orjson.dumps(obj)
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+
+BACKENDS = {
+    'json': StdlibJSON,
+    'orjson': OrjsonJSON,
+}
+
+
+def get_backend(name='auto'):
+    """
+    :param name: 'json', 'orjson' or 'auto' for the fastest installed
+    :return: backend instance
+    """
+    if name == 'auto':
+        name = 'orjson' if orjson is not None else 'json'
+
+    if name not in BACKENDS:
+        raise ValueError('unknown JSON backend {!r}'.format(name))
+
+    return BACKENDS[name]()
+
+
+def available_backends():
+    """
+    :return: names of the backends that can be used here
+    """
+    names = ['json']
+    if orjson is not None:
+        names.append('orjson')
+    return names
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+"""
+Production entry point for the app.
+
+With ``--server gevent`` every connection is served by a greenlet on
+gevent's WSGI server instead of by an OS thread, so thousands of mostly
+idle client connections only cost a little memory each.  Routes,
+request validation and responses are exactly those of app.py.
+
+Database calls made through a C driver such as the sqlite3 module block
+the event loop while they run.  That is fine for short SQLite queries,
+for a network database use a driver gevent can patch (e.g. PyMySQL, or
+psycopg2 with psycogreen) so queries yield to other connections.
+
+    pip install gevent
+    python server.py --server gevent --port 5000 --max-connections 10000
+
+``--server threaded`` runs the thread per connection server that
+``./app.py`` uses, for comparison.
+
+The app is loaded, the schema created or upgraded and the per process
+caches built once, see app.prewarm(), before ``--workers`` processes
+are forked to serve requests on a shared socket.  Workers start warm
+and share the memory of everything loaded up to then.  Where the
+schema is set up by its own deploy step (``python migrations.py``)
+``--skip-upgrade`` leaves it alone.
+"""
+import argparse
+import errno
+import os
+import signal
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--server', choices=['gevent', 'threaded'],
+                        default='gevent')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--max-connections', type=int, default=10000,
+                        help='connections served at once by gevent')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='processes serving requests')
+    parser.add_argument('--skip-upgrade', action='store_true',
+                        help="don't create or upgrade the database schema")
+    parser.add_argument('--quiet', action='store_true',
+                        help="don't log every request")
+    args = parser.parse_args()
+
+    if args.server == 'gevent':
+        try:
+            from gevent import monkey
+        except ImportError:
+            raise SystemExit('--server gevent needs gevent, install it '
+                             'with: pip install gevent')
+
+        # Has to happen before anything imports socket or threading
+        monkey.patch_all()
+
+    import socket
+    import app
+    import migrations
+    if not args.skip_upgrade:
+        migrations.upgrade(app.db)
+    with app.app.app_context():
+        app.prewarm()
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((args.host, args.port))
+    listener.listen(1024)
+
+    if args.server == 'gevent':
+        from gevent.pool import Pool
+        from gevent.pywsgi import WSGIServer
+
+        def serve():
+            server = WSGIServer(listener, app.app,
+                                spawn=Pool(args.max_connections),
+                                log=None if args.quiet else 'default')
+            server.serve_forever()
+    else:
+        from werkzeug.serving import WSGIRequestHandler, make_server
+
+        class RequestHandler(WSGIRequestHandler):
+            def log_request(self, *a, **kw):
+                if not args.quiet:
+                    WSGIRequestHandler.log_request(self, *a, **kw)
+
+        def serve():
+            server = make_server(args.host, args.port, app.app,
+                                 threaded=True, request_handler=RequestHandler,
+                                 fd=listener.fileno())
+            server.serve_forever()
+
+    if args.workers > 1:
+        serve_forked(serve, args.workers)
+    else:
+        serve()
+
+
+def serve_forked(serve, workers):
+    """
+    Forks the workers, each calling serve(), and waits until they have
+    all exited.  SIGTERM or SIGINT is passed on to every worker.
+
+    :param serve: function serving requests until the process is stopped
+    :param workers: number of processes to fork
+    """
+    pids = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                serve()
+            finally:
+                os._exit(0)
+        pids.append(pid)
+
+    def stop(signum, frame):
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    while pids:
+        try:
+            pid, _ = os.waitpid(-1, 0)
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        if pid in pids:
+            pids.remove(pid)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,459 @@
+"""
+Snapshots of every user, group and membership.
+
+export_ndjson() and export_binary() stream a consistent snapshot read
+through server side cursors in fixed size batches, so memory use
+doesn't grow with the number of membership rows.  restore() loads
+either format into a database without users or groups.
+
+NDJSON snapshots are a header line followed by a line per group, a line
+per group nested in another and a line per user:
+
+    {"type": "snapshot", "format": 1, "change_seq": 42}
+    {"type": "group", "groupid": "admins"}
+    {"type": "subgroup", "groupid": "admins", "subgroupid": "root"}
+    {"type": "user", "userid": "spiderman", "first_name": "Peter",
+     "last_name": "Parker", "groups": ["admins"]}
+
+Binary snapshots are MAGIC followed by blocks, each a kind byte, the
+4 byte little endian length of its payload and the zlib compressed
+payload.  Integers are unsigned 32 bit little endian and a column of
+strings is its count, the UTF-8 byte length of every string (NULL_LENGTH
+for None) and then the bytes of every string.
+
+    H  change_seq
+    G  a column of groupids, the groups' positions across all G blocks
+       are their indexes in the string dictionary
+    E  the count of nested groups, then the dictionary indexes of the
+       parent and of the child of each
+    U  userid, first_name and last_name columns, the number of groups
+       of every user, then the count and the dictionary indexes of all
+       their groups
+
+Readers skip record types and block kinds they don't know.
+"""
+import json
+import struct
+import sys
+import zlib
+from array import array
+from contextlib import contextmanager
+
+from sqlalchemy import column, func, select, table
+
+import hierarchy
+import membercounts
+import search
+
+MAGIC = b'UGSNAP\x00\x01'
+FORMAT_VERSION = 1
+NULL_LENGTH = 0xFFFFFFFF
+
+# Rows fetched per round trip while exporting and written per
+# statement while restoring.
+BATCH_SIZE = 5000
+
+users = table('users', column('id'), column('userid'), column('first_name'),
+              column('last_name'))
+groups = table('groups', column('id'), column('groupid'))
+user_groups = table('usergroups', column('userid'), column('groupid'))
+changes = table('changes', column('seq'))
+group_groups = hierarchy.group_groups
+
+_uint = struct.Struct('<I')
+_block = struct.Struct('<cI')
+
+
+class SnapshotError(Exception):
+    pass
+
+
+@contextmanager
+def snapshot_connection(engine):
+    """
+    Opens a connection whose queries all see the database as it was
+    when the first of them ran.
+
+    pysqlite only begins transactions for writes so one is begun by
+    hand.  With WAL that is a snapshot that doesn't block writers,
+    otherwise writers wait until the export is done.
+
+    :param engine: SQLAlchemy engine
+    :return: connection
+    """
+    conn = engine.connect()
+    sqlite = conn.dialect.name == 'sqlite'
+    try:
+        if sqlite:
+            conn.execute('BEGIN')
+        else:
+            conn = conn.execution_options(isolation_level='REPEATABLE READ')
+            trans = conn.begin()
+
+        yield conn.execution_options(stream_results=True)
+    finally:
+        if sqlite:
+            # pysqlite would commit before running a ROLLBACK statement,
+            # its own rollback() ends the transaction begun above.
+            conn.connection.rollback()
+        else:
+            trans.rollback()
+        conn.close()
+
+
+def iter_groups(conn, batch_size=BATCH_SIZE):
+    """
+    :param conn: connection from snapshot_connection()
+    :param batch_size: rows fetched per round trip
+    :return: generator of lists of (groups.id, groupid)
+    """
+    rows = conn.execute(select([groups.c.id, groups.c.groupid])
+                        .order_by(groups.c.id))
+    while True:
+        batch = rows.fetchmany(batch_size)
+        if not batch:
+            break
+        yield batch
+
+
+def iter_users(conn, batch_size=BATCH_SIZE):
+    """
+    Reads users joined with their memberships in users.id order.
+
+    :param conn: connection from snapshot_connection()
+    :param batch_size: rows fetched per round trip
+    :return: generator of lists of (userid, first_name, last_name,
+             list of groups.id)
+    """
+    rows = conn.execute(
+        select([users.c.id, users.c.userid, users.c.first_name,
+                users.c.last_name, user_groups.c.groupid])
+        .select_from(users.outerjoin(
+            user_groups, user_groups.c.userid == users.c.id))
+        .order_by(users.c.id, user_groups.c.groupid))
+    current_id, current = None, None
+    while True:
+        batch = rows.fetchmany(batch_size)
+        if not batch:
+            break
+
+        done = []
+        for user_id, userid, first_name, last_name, group_id in batch:
+            if user_id != current_id:
+                if current is not None:
+                    done.append(current)
+                current_id = user_id
+                current = (userid, first_name, last_name, [])
+            if group_id is not None:
+                current[3].append(group_id)
+
+        if done:
+            yield done
+
+    if current is not None:
+        yield [current]
+
+
+def iter_subgroups(conn, batch_size=BATCH_SIZE):
+    """
+    :param conn: connection from snapshot_connection()
+    :param batch_size: rows fetched per round trip
+    :return: generator of lists of (parent groups.id, child groups.id)
+    """
+    rows = conn.execute(select([group_groups.c.parentid,
+                                group_groups.c.childid])
+                        .order_by(group_groups.c.parentid,
+                                  group_groups.c.childid))
+    while True:
+        batch = rows.fetchmany(batch_size)
+        if not batch:
+            break
+        yield batch
+
+
+def change_seq(conn):
+    """
+    :param conn: connection from snapshot_connection()
+    :return: seq of the last change in the change log, 0 if none
+    """
+    return conn.execute(select([func.max(changes.c.seq)])).scalar() or 0
+
+
+def export_ndjson(engine, dumps=json.dumps, batch_size=BATCH_SIZE):
+    """
+    :param engine: SQLAlchemy engine
+    :param dumps: function encoding an object as json
+    :param batch_size: rows fetched per round trip
+    :return: generator of byte chunks, one per batch of rows
+    """
+    def line(obj):
+        data = dumps(obj)
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        return data + b'\n'
+
+    with snapshot_connection(engine) as conn:
+        yield line({'type': 'snapshot', 'format': FORMAT_VERSION,
+                    'change_seq': change_seq(conn)})
+
+        groupids = {}
+        for batch in iter_groups(conn, batch_size):
+            groupids.update(batch)
+            yield b''.join(line({'type': 'group', 'groupid': groupid})
+                           for _, groupid in batch)
+
+        for batch in iter_subgroups(conn, batch_size):
+            yield b''.join(line({'type': 'subgroup',
+                                 'groupid': groupids[parent_id],
+                                 'subgroupid': groupids[child_id]})
+                           for parent_id, child_id in batch)
+
+        for batch in iter_users(conn, batch_size):
+            yield b''.join(
+                line({'type': 'user', 'userid': userid,
+                      'first_name': first_name, 'last_name': last_name,
+                      'groups': [groupids[x] for x in group_ids]})
+                for userid, first_name, last_name, group_ids in batch)
+
+
+def export_binary(engine, batch_size=BATCH_SIZE):
+    """
+    :param engine: SQLAlchemy engine
+    :param batch_size: rows fetched per round trip
+    :return: generator of byte chunks, one block each
+    """
+    with snapshot_connection(engine) as conn:
+        yield MAGIC
+        yield _pack_block(b'H', _uint.pack(change_seq(conn)))
+
+        # groups.id -> position in the string dictionary
+        indexes = {}
+        for batch in iter_groups(conn, batch_size):
+            for group_id, _ in batch:
+                indexes[group_id] = len(indexes)
+            yield _pack_block(b'G', _pack_strings([x[1] for x in batch]))
+
+        for batch in iter_subgroups(conn, batch_size):
+            yield _pack_block(b'E', b''.join([
+                _uint.pack(len(batch)),
+                _array_bytes(_uints(indexes[x[0]] for x in batch)),
+                _array_bytes(_uints(indexes[x[1]] for x in batch))
+            ]))
+
+        for batch in iter_users(conn, batch_size):
+            counts = _uints(len(x[3]) for x in batch)
+            members = _uints(indexes[x] for user in batch for x in user[3])
+            yield _pack_block(b'U', b''.join([
+                _pack_strings([x[0] for x in batch]),
+                _pack_strings([x[1] for x in batch]),
+                _pack_strings([x[2] for x in batch]),
+                _array_bytes(counts),
+                _uint.pack(len(members)),
+                _array_bytes(members)
+            ]))
+
+
+def read_snapshot(stream):
+    """
+    Decodes either snapshot format.
+
+    :param stream: file object opened in binary mode
+    :return: generator of ('group', groupid), ('subgroup', (groupid,
+             subgroupid)) and ('user', (userid, first_name, last_name,
+             list of groupids)) tuples
+    """
+    head = stream.read(len(MAGIC))
+    if head == MAGIC:
+        return _read_binary(stream)
+
+    return _read_ndjson(head, stream)
+
+
+def restore(engine, stream, batch_size=BATCH_SIZE):
+    """
+    Loads a snapshot into a database that has the app's schema but no
+    users or groups, in one transaction.  Rows are written with ids
+    assigned here so nothing has to be read back while loading, and the
+    closure of nested groups and the search terms of users are computed
+    once everything is in.
+
+    :param engine: SQLAlchemy engine
+    :param stream: file object opened in binary mode
+    :param batch_size: rows written per statement
+    :return: dict of the number of users, groups, subgroups and
+             memberships loaded
+    """
+    counts = {'users': 0, 'groups': 0, 'subgroups': 0, 'memberships': 0}
+    with engine.begin() as conn:
+        for name, tbl in (('users', users), ('groups', groups)):
+            if conn.execute(select([func.count()]).select_from(tbl)).scalar():
+                raise SnapshotError('can only restore into a database '
+                                    'without {}'.format(name))
+
+        group_ids = {}
+        pending = {'groups': [], 'users': [], 'subgroups': [],
+                   'memberships': []}
+
+        def flush():
+            # Groups and users first so memberships never point at rows
+            # that haven't been written yet.
+            for name, tbl in (('groups', groups), ('users', users),
+                              ('subgroups', group_groups),
+                              ('memberships', user_groups)):
+                if pending[name]:
+                    conn.execute(tbl.insert(), pending[name])
+                    counts[name] += len(pending[name])
+                    pending[name] = []
+
+        def add_group(groupid):
+            group_ids[groupid] = len(group_ids) + 1
+            pending['groups'].append({'id': group_ids[groupid],
+                                      'groupid': groupid})
+
+        for kind, value in read_snapshot(stream):
+            if kind == 'group':
+                if value not in group_ids:
+                    add_group(value)
+            elif kind == 'subgroup':
+                for groupid in value:
+                    if groupid not in group_ids:
+                        add_group(groupid)
+                pending['subgroups'].append(
+                    {'parentid': group_ids[value[0]],
+                     'childid': group_ids[value[1]]})
+            else:
+                userid, first_name, last_name, groupids = value
+                user_id = counts['users'] + len(pending['users']) + 1
+                pending['users'].append({'id': user_id, 'userid': userid,
+                                         'first_name': first_name,
+                                         'last_name': last_name})
+                for groupid in set(groupids):
+                    if groupid not in group_ids:
+                        add_group(groupid)
+                    pending['memberships'].append(
+                        {'userid': user_id, 'groupid': group_ids[groupid]})
+
+            if max(len(x) for x in pending.values()) >= batch_size:
+                flush()
+
+        flush()
+        hierarchy.rebuild(conn)
+        membercounts.recount(conn)
+        search.rebuild(conn)
+
+    return counts
+
+
+def _read_ndjson(head, stream):
+    lines = iter(stream)
+    first = head + next(lines, b'')
+    header = json.loads(first.decode('utf-8'))
+    if header.get('type') != 'snapshot':
+        raise SnapshotError('not a snapshot')
+
+    for line in lines:
+        if not line.strip():
+            continue
+
+        record = json.loads(line.decode('utf-8'))
+        if record['type'] == 'group':
+            yield 'group', record['groupid']
+        elif record['type'] == 'subgroup':
+            yield 'subgroup', (record['groupid'], record['subgroupid'])
+        elif record['type'] == 'user':
+            yield 'user', (record['userid'], record['first_name'],
+                           record['last_name'], record['groups'])
+
+
+def _read_binary(stream):
+    dictionary = []
+    while True:
+        head = stream.read(_block.size)
+        if not head:
+            break
+        if len(head) != _block.size:
+            raise SnapshotError('truncated snapshot')
+
+        kind, length = _block.unpack(head)
+        data = stream.read(length)
+        if len(data) != length:
+            raise SnapshotError('truncated snapshot')
+
+        payload = zlib.decompress(data)
+        if kind == b'G':
+            groupids, _ = _unpack_strings(payload, 0)
+            dictionary.extend(groupids)
+            for groupid in groupids:
+                yield 'group', groupid
+        elif kind == b'E':
+            count, = _uint.unpack_from(payload, 0)
+            parents, offset = _unpack_uints(payload, _uint.size, count)
+            children, _ = _unpack_uints(payload, offset, count)
+            for parent, child in zip(parents, children):
+                yield 'subgroup', (dictionary[parent], dictionary[child])
+        elif kind == b'U':
+            userids, offset = _unpack_strings(payload, 0)
+            first_names, offset = _unpack_strings(payload, offset)
+            last_names, offset = _unpack_strings(payload, offset)
+            counts, offset = _unpack_uints(payload, offset, len(userids))
+            total, = _uint.unpack_from(payload, offset)
+            members, offset = _unpack_uints(payload, offset + _uint.size,
+                                            total)
+            start = 0
+            for i, userid in enumerate(userids):
+                end = start + counts[i]
+                yield 'user', (userid, first_names[i], last_names[i],
+                               [dictionary[x] for x in members[start:end]])
+                start = end
+
+
+def _pack_block(kind, payload):
+    data = zlib.compress(payload, 1)
+    return _block.pack(kind, len(data)) + data
+
+
+def _uints(values):
+    return array('I', values)
+
+
+def _array_bytes(values):
+    if sys.byteorder != 'little':
+        values = array('I', values)
+        values.byteswap()
+    if hasattr(values, 'tobytes'):
+        return values.tobytes()
+    return values.tostring()
+
+
+def _unpack_uints(payload, offset, count):
+    end = offset + count * 4
+    values = array('I')
+    if hasattr(values, 'frombytes'):
+        values.frombytes(payload[offset:end])
+    else:
+        values.fromstring(payload[offset:end])
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values, end
+
+
+def _pack_strings(values):
+    encoded = [x.encode('utf-8') if x is not None else None for x in values]
+    lengths = _uints(len(x) if x is not None else NULL_LENGTH
+                     for x in encoded)
+    return b''.join([_uint.pack(len(encoded)), _array_bytes(lengths),
+                     b''.join(x for x in encoded if x is not None)])
+
+
+def _unpack_strings(payload, offset):
+    count, = _uint.unpack_from(payload, offset)
+    lengths, offset = _unpack_uints(payload, offset + _uint.size, count)
+    values = []
+    for length in lengths:
+        if length == NULL_LENGTH:
+            values.append(None)
+            continue
+
+        values.append(payload[offset:offset + length].decode('utf-8'))
+        offset += length
+    return values, offset
@@ -0,0 +1,81 @@
+import app
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import migrations
+from app import db
+
+
+class CreateAppTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'test.db')
+        self.config = {'TESTING': True,
+                       'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + self.path}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        os.environ.pop('DATABASE_URL', None)
+
+    def test_config(self):
+        """
+        Tests that config passed to create_app wins over the environment and defaults
+        """
+        os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(
+            self.tmpdir, 'env.db')
+        assert app.create_app().config['SQLALCHEMY_DATABASE_URI'] == \
+            os.environ['DATABASE_URL']
+
+        flask_app = app.create_app(dict(self.config, CACHE_TTL=5))
+        assert flask_app.config['SQLALCHEMY_DATABASE_URI'] == \
+            self.config['SQLALCHEMY_DATABASE_URI']
+        assert flask_app.config['CACHE_TTL'] == 5
+        assert flask_app.config['CACHE_ENABLED'] is False
+        assert flask_app.config['DB_REPLICA_URLS'] == []
+
+    def test_separate_databases(self):
+        """
+        Tests that apps built by create_app each use their own database
+        """
+        flask_app = app.create_app(self.config)
+        # Building the app leaves the schema alone
+        assert not os.path.exists(self.path)
+
+        with flask_app.app_context():
+            migrations.upgrade(db)
+        body = {'userid': 'spiderman', 'first_name': 'Peter',
+                'last_name': 'Parker', 'groups': ['admins']}
+        client = flask_app.test_client()
+        resp = client.post('/users', data=json.dumps(body))
+        assert resp.status_code == 200
+        assert client.get('/users/spiderman').status_code == 200
+
+        db.create_all()
+        try:
+            resp = app.app.test_client().get('/users/spiderman')
+            assert resp.status_code == 404
+        finally:
+            db.session.remove()
+            db.drop_all()
+
+    def test_prewarm(self):
+        """
+        Tests that prewarm builds the per process caches and closes its connections
+        """
+        flask_app = app.create_app(dict(self.config, CACHE_ENABLED=True,
+                                        MEMBERSHIP_INDEX_ENABLED=True,
+                                        SQLALCHEMY_POOL_SIZE=2))
+        with flask_app.app_context():
+            migrations.upgrade(db)
+            app.prewarm()
+            assert db.engine.pool.checkedin() == 0
+
+        for name in ('json_backend', 'user_group_cache', 'membership_index'):
+            assert name in flask_app.extensions
+        assert 'membership_index' not in app.app.extensions
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,298 @@
+import app
+import json
+import threading
+import time
+import unittest
+import test_users
+from cache import CacheError, LRUCache, RedisBackend, VersionedCache
+
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+
+
+class FakeRedisHandler(socketserver.StreamRequestHandler):
+    """
+    Speaks just enough of the Redis protocol to serve the commands
+    RedisBackend sends.
+    """
+    def handle(self):
+        while True:
+            try:
+                args = self.read_command()
+            except EOFError:
+                return
+
+            self.wfile.write(self.server.run(args))
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            raise EOFError()
+
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+
+class FakeRedisServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        socketserver.TCPServer.__init__(self, ('127.0.0.1', 0),
+                                        FakeRedisHandler)
+        self.data = {}
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever,
+                                       args=(0.01,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def run(self, args):
+        command = args[0].upper()
+        with self.lock:
+            if command in (b'PING', b'SELECT'):
+                return b'+OK\r\n'
+            if command == b'GET':
+                return self.bulk(self.get(args[1]))
+            if command == b'MGET':
+                values = [self.bulk(self.get(x)) for x in args[1:]]
+                return b'*' + str(len(values)).encode() + b'\r\n' + b''.join(values)
+            if command == b'SET':
+                options = [x.upper() for x in args[3:]]
+                if b'NX' in options and self.get(args[1]) is not None:
+                    return b'$-1\r\n'
+                expires = None
+                if b'EX' in options:
+                    expires = time.time() + int(args[3 + options.index(b'EX') + 1])
+                self.data[args[1]] = (args[2], expires)
+                return b'+OK\r\n'
+            if command == b'MSET':
+                for i in range(1, len(args), 2):
+                    self.data[args[i]] = (args[i + 1], None)
+                return b'+OK\r\n'
+            if command == b'DEL':
+                count = len([self.data.pop(x) for x in args[1:] if x in self.data])
+                return b':' + str(count).encode() + b'\r\n'
+        return b'-ERR unknown command\r\n'
+
+    def get(self, key):
+        value, expires = self.data.get(key, (None, None))
+        if expires is not None and expires <= time.time():
+            return None
+        return value
+
+    def bulk(self, value):
+        if value is None:
+            return b'$-1\r\n'
+        return b'$' + str(len(value)).encode() + b'\r\n' + value + b'\r\n'
+
+
+class LRUCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.cache = LRUCache(max_entries=2, ttl=10, clock=lambda: self.now)
+
+    def test_get_set(self):
+        """
+        Tests that values can be stored and fetched and that counters are kept
+        """
+        assert self.cache.get('a') is None
+        self.cache.set('a', 1)
+        assert self.cache.get('a') == 1
+
+        stats = self.cache.stats()
+        assert stats['hits'] == 1
+        assert stats['misses'] == 1
+        assert stats['size'] == 1
+
+    def test_eviction(self):
+        """
+        Tests that the least recently used entry is evicted when the cache is full
+        """
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        # Touch a so b becomes the least recently used entry
+        assert self.cache.get('a') == 1
+        self.cache.set('c', 3)
+
+        assert self.cache.get('b') is None
+        assert self.cache.get('a') == 1
+        assert self.cache.get('c') == 3
+        assert self.cache.stats()['evictions'] == 1
+
+    def test_expiration(self):
+        """
+        Tests that entries expire once their ttl has passed
+        """
+        self.cache.set('a', 1)
+        self.now = 10
+        assert self.cache.get('a') is None
+        assert self.cache.stats()['expirations'] == 1
+
+    def test_delete(self):
+        """
+        Tests that deleted entries are gone
+        """
+        self.cache.set('a', 1)
+        self.cache.delete('a', 'missing')
+        assert self.cache.get('a') is None
+
+
+class RedisBackendTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeRedisServer()
+        self.url = 'redis://127.0.0.1:{}/0'.format(self.server.server_address[1])
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_commands(self):
+        """
+        Tests the backend interface against the fake redis server
+        """
+        backend = RedisBackend.from_url(self.url, ttl=60)
+        assert backend.get('a') is None
+        backend.set('a', 'one')
+        assert backend.get('a') == b'one'
+        assert backend.add('a', 'two') is False
+        assert backend.add('b', 'two') is True
+        assert backend.get_many(['a', 'b', 'c']) == [b'one', b'two', None]
+        backend.delete('a', 'b')
+        assert backend.get('a') is None
+
+    def test_versioned_keys_across_workers(self):
+        """
+        Tests that a write in one worker is seen by another without telling it
+        """
+        worker1 = VersionedCache(RedisBackend.from_url(self.url))
+        worker2 = VersionedCache(RedisBackend.from_url(self.url))
+
+        value, version = worker1.lookup('user', u'spiderman')
+        assert value is None
+        worker1.store('user', u'spiderman', version, '{"old": true}')
+
+        value, _ = worker2.lookup('user', u'spiderman')
+        assert value == b'{"old": true}'
+
+        worker1.invalidate('user', [u'spiderman'])
+        value, _ = worker2.lookup('user', u'spiderman')
+        assert value is None
+
+    def test_stale_store_is_ignored(self):
+        """
+        Tests that a value read before a write finished is never served
+        """
+        cache = VersionedCache(LRUCache())
+        value, version = cache.lookup('group', u'admins')
+        cache.invalidate('group', [u'admins'])
+        cache.store('group', u'admins', version, '["stale"]')
+
+        value, _ = cache.lookup('group', u'admins')
+        assert value is None
+
+    def test_server_down(self):
+        """
+        Tests that an unreachable server is treated as a miss
+        """
+        self.server.stop()
+        backend = RedisBackend.from_url(self.url)
+        self.assertRaises(CacheError, backend.get, 'a')
+
+        cache = VersionedCache(backend)
+        assert cache.lookup('user', u'spiderman') == (None, None)
+        assert cache.stats()['errors'] == 1
+
+        # Keep tearDown happy
+        self.server = FakeRedisServer()
+
+
+class CachedUserTestCase(test_users.UserTestCase):
+    """
+    Runs the whole api test suite again with caching turned on so any
+    missing invalidation shows up as a stale read.
+    """
+    def setUp(self):
+        super(CachedUserTestCase, self).setUp()
+        app.app.config['CACHE_ENABLED'] = True
+
+    def tearDown(self):
+        app.app.config['CACHE_ENABLED'] = False
+        app.app.extensions.pop('user_group_cache', None)
+        super(CachedUserTestCase, self).tearDown()
+
+    def test_cache_stats(self):
+        """
+        Tests that repeated reads are served from the cache
+        """
+        resp = self.app.post('/users', data=json.dumps(self.test_user1_data))
+        assert resp.status_code == 200
+
+        for _ in range(3):
+            resp = self.app.get('/users/{}'.format(self.test_user1_userid))
+            assert resp.status_code == 200
+
+        resp = self.app.get('/_cache/stats')
+        assert resp.status_code == 200
+
+        data = json.loads(resp.data)
+        assert data['misses'] == 1
+        assert data['hits'] == 2
+
+    def test_cache_invalidation(self):
+        """
+        Tests that cached reads are dropped when a group changes underneath them
+        """
+        resp = self.app.post('/users', data=json.dumps(self.test_user1_data))
+        assert resp.status_code == 200
+
+        resp = self.app.post('/users', data=json.dumps(self.test_user2_data))
+        assert resp.status_code == 200
+
+        # Prime the cache
+        resp = self.app.get('/users/{}'.format(self.test_user2_userid))
+        assert self.test_group1_groupid not in json.loads(resp.data)['groups']
+        resp = self.app.get('/groups/{}'.format(self.test_group1_groupid))
+        assert json.loads(resp.data) == [self.test_user1_userid]
+
+        resp = self.app.put('/groups/{}'.format(self.test_group1_groupid),
+                            data=json.dumps(self.test_group1_modify))
+        assert resp.status_code == 200
+
+        resp = self.app.get('/users/{}'.format(self.test_user2_userid))
+        assert self.test_group1_groupid in json.loads(resp.data)['groups']
+        resp = self.app.get('/groups/{}'.format(self.test_group1_groupid))
+        assert sorted(json.loads(resp.data)) == sorted(self.test_group1_modify)
+
+        # Deleting the group drops it from the cached user as well
+        resp = self.app.delete('/groups/{}'.format(self.test_group1_groupid))
+        assert resp.status_code == 200
+        resp = self.app.get('/users/{}'.format(self.test_user2_userid))
+        assert self.test_group1_groupid not in json.loads(resp.data)['groups']
+        resp = self.app.get('/groups/{}'.format(self.test_group1_groupid))
+        assert resp.status_code == 404
+
+
+class RedisCachedUserTestCase(CachedUserTestCase):
+    """
+    Same as CachedUserTestCase but with the shared redis backend.
+    """
+    def setUp(self):
+        super(RedisCachedUserTestCase, self).setUp()
+        self.server = FakeRedisServer()
+        app.app.config['CACHE_BACKEND'] = 'redis'
+        app.app.config['CACHE_REDIS_URL'] = 'redis://127.0.0.1:{}/0'.format(
+            self.server.server_address[1])
+
+    def tearDown(self):
+        app.app.config['CACHE_BACKEND'] = 'memory'
+        super(RedisCachedUserTestCase, self).tearDown()
+        self.server.stop()
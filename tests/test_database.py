@@ -0,0 +1,62 @@
+import os
+import shutil
+import tempfile
+import unittest
+from flask import Flask
+from database import SQLAlchemy, sqlite_pragmas
+
+
+class DatabaseTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.app = Flask('database_test')
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(
+            self.tmpdir, 'test.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def pragma(self, db, name):
+        return db.engine.execute('PRAGMA {}'.format(name)).scalar()
+
+    def test_default_profile(self):
+        """
+        Tests that the default profile leaves sqlite's settings alone
+        """
+        db = SQLAlchemy(self.app)
+        assert self.pragma(db, 'journal_mode') == 'delete'
+
+    def test_production_profile(self):
+        """
+        Tests that the production profile's pragmas are applied to new connections
+        """
+        self.app.config['SQLITE_PROFILE'] = 'production'
+        self.app.config['SQLALCHEMY_POOL_SIZE'] = 2
+        self.app.config['SQLITE_BUSY_TIMEOUT'] = 1234
+        db = SQLAlchemy(self.app)
+        assert self.pragma(db, 'journal_mode') == 'wal'
+        # NORMAL
+        assert self.pragma(db, 'synchronous') == 1
+        assert self.pragma(db, 'busy_timeout') == 1234
+        assert db.engine.pool.size() == 2
+
+    def test_pragma_order(self):
+        """
+        Tests that journal_mode is always set before the other pragmas
+        """
+        config = {
+            'SQLITE_PROFILE': 'production',
+            'SQLITE_BUSY_TIMEOUT': None,
+            'SQLITE_MMAP_SIZE': 0
+        }
+        pragmas = sqlite_pragmas(config)
+        assert pragmas[0] == ('journal_mode', 'WAL')
+        assert ('mmap_size', 0) in pragmas
+
+    def test_pre_ping(self):
+        """
+        Tests that connections still work with the pre-ping check enabled
+        """
+        self.app.config['DB_POOL_PRE_PING'] = True
+        db = SQLAlchemy(self.app)
+        assert db.engine.execute('SELECT 2').scalar() == 2
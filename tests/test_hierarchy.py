@@ -0,0 +1,154 @@
+import app
+import json
+import random
+import unittest
+import hierarchy
+from app import db
+
+
+class HierarchyTestCase(unittest.TestCase):
+    def setUp(self):
+        app.app.config['TESTING'] = True
+        self.app = app.app.test_client()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def add_user(self, userid, groups):
+        body = {'userid': userid, 'first_name': 'First', 'last_name': 'Last',
+                'groups': groups}
+        resp = self.app.post('/users', data=json.dumps(body))
+        assert resp.status_code == 200
+
+    def add_group(self, groupid):
+        resp = self.app.post('/groups', data=json.dumps({'name': groupid}))
+        assert resp.status_code == 200
+
+    def nest(self, groupid, subgroupids):
+        return self.app.put('/groups/{}/groups'.format(groupid),
+                            data=json.dumps(subgroupids))
+
+    def get_list(self, path):
+        resp = self.app.get(path)
+        assert resp.status_code == 200
+        return json.loads(resp.data)
+
+    def closure(self):
+        table = app.group_closure
+        return sorted(tuple(x) for x in db.session.execute(
+            db.select([table.c.ancestor, table.c.descendant, table.c.depth,
+                       table.c.paths])))
+
+    def test_effective_membership(self):
+        """
+        Tests that users and groups see memberships through nested groups
+        """
+        self.add_user('oncall-person', ['eng-platform-oncall'])
+        self.add_user('platform-person', ['eng-platform'])
+        self.add_group('eng')
+        assert self.nest('eng', ['eng-platform']).status_code == 200
+        resp = self.nest('eng-platform', ['eng-platform-oncall', 'nogroup'])
+        assert resp.status_code == 200
+        assert json.loads(resp.data) == ['eng-platform-oncall']
+        assert json.loads(resp.headers['X-Unknown-Groupids']) == ['nogroup']
+
+        assert self.get_list('/groups/eng/groups') == ['eng-platform']
+        assert self.get_list('/users/oncall-person/groups') == \
+            ['eng', 'eng-platform', 'eng-platform-oncall']
+        assert self.get_list('/users/oncall-person/groups?max_depth=1') == \
+            ['eng-platform', 'eng-platform-oncall']
+        assert self.get_list('/groups/eng/members') == \
+            ['oncall-person', 'platform-person']
+        assert self.get_list('/groups/eng/members?max_depth=1') == \
+            ['platform-person']
+        assert self.get_list('/groups/eng-platform/members?max_depth=0') == \
+            ['platform-person']
+
+        # Direct member lists are unchanged
+        assert self.get_list('/groups/eng') == []
+
+        resp = self.app.get('/groups/eng/members?max_depth=-1')
+        assert resp.status_code == 400
+        assert json.loads(resp.data) == {'errors': [
+            {'field': 'max_depth', 'message': 'must be at least 0'}]}
+        assert self.app.get('/groups/nogroup/members').status_code == 404
+        assert self.app.get('/users/nobody/groups').status_code == 404
+
+    def test_cycle(self):
+        """
+        Tests that a group can't end up nested in itself
+        """
+        for groupid in ['a', 'b', 'c']:
+            self.add_group(groupid)
+        assert self.nest('a', ['b']).status_code == 200
+        assert self.nest('b', ['c']).status_code == 200
+
+        resp = self.nest('c', ['a'])
+        assert resp.status_code == 409
+        assert json.loads(resp.data)['errors'][0]['field'] == '0'
+        assert self.nest('a', ['a']).status_code == 409
+        assert self.get_list('/groups/c/groups') == []
+
+        # Replacing b's subgroups drops the path from a to c
+        assert self.nest('b', []).status_code == 200
+        assert self.nest('c', ['a']).status_code == 200
+
+    def test_diamond(self):
+        """
+        Tests that removing one of two paths between groups keeps the other
+        """
+        self.add_user('spiderman', ['d'])
+        for groupid in ['a', 'b', 'c']:
+            self.add_group(groupid)
+        assert self.nest('a', ['b', 'c']).status_code == 200
+        assert self.nest('b', ['d']).status_code == 200
+        assert self.nest('c', ['d']).status_code == 200
+        assert self.get_list('/users/spiderman/groups') == ['a', 'b', 'c', 'd']
+
+        # a still reaches d through c
+        assert self.nest('a', ['c']).status_code == 200
+        assert self.get_list('/users/spiderman/groups') == ['a', 'b', 'c', 'd']
+        assert self.get_list('/groups/a/members') == ['spiderman']
+
+        resp = self.app.delete('/groups/c')
+        assert resp.status_code == 200
+        assert self.get_list('/users/spiderman/groups') == ['b', 'd']
+        assert self.get_list('/groups/a/members') == []
+
+    def test_effective_query_plans(self):
+        """
+        Tests that effective memberships are answered from the closure and usergroups indexes
+        """
+        for query in [app.effective_groups_query(1),
+                      app.effective_members_query(1, max_depth=2)]:
+            sql = str(query.compile(compile_kwargs={'literal_binds': True}))
+            plan = db.session.execute('EXPLAIN QUERY PLAN ' + sql).fetchall()
+            plan = ' '.join(str(tuple(x)[-1]) for x in plan)
+            assert 'groupclosure' in plan
+            assert 'SCAN ' not in plan
+
+    def test_incremental_matches_rebuild(self):
+        """
+        Tests that edge by edge updates leave the same closure as a rebuild
+        """
+        rng = random.Random(1)
+        groupids = ['g{}'.format(i) for i in range(8)]
+        for groupid in groupids:
+            self.add_group(groupid)
+
+        for _ in range(60):
+            groupid = rng.choice(groupids)
+            subgroupids = rng.sample(groupids, rng.randint(0, 3))
+            resp = self.nest(groupid, subgroupids)
+            assert resp.status_code in (200, 409)
+
+            incremental = self.closure()
+            hierarchy.rebuild(db.session)
+            assert self.closure() == incremental
+            db.session.rollback()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import app
+import json
+import unittest
+import membercounts
+from app import db
+
+
+class MemberCountsTestCase(unittest.TestCase):
+    def setUp(self):
+        app.app.config['TESTING'] = True
+        self.app = app.app.test_client()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def counts(self):
+        table = app.Group.__table__
+        return dict(tuple(x) for x in db.session.execute(
+            db.select([table.c.groupid, table.c.member_count])))
+
+    def test_adjust(self):
+        """
+        Tests that deltas are added to the counts of their groups only
+        """
+        resp = self.app.post('/users', data=json.dumps(
+            {'userid': 'spiderman', 'first_name': 'Peter',
+             'last_name': 'Parker', 'groups': ['admins', 'users']}))
+        assert resp.status_code == 200
+        group_ids = app.lookup_group_ids(['admins', 'users'])
+
+        membercounts.adjust(db.session, {group_ids['admins']: 2,
+                                         group_ids['users']: 0})
+        membercounts.adjust(db.session, {})
+        assert self.counts() == {'admins': 3, 'users': 1}
+
+    def test_recount(self):
+        """
+        Tests that recount repairs drifted counts and leaves right ones alone
+        """
+        records = [{'userid': 'user{}'.format(i), 'first_name': 'Mary',
+                    'last_name': 'Jane', 'groups': ['readers', 'writers']}
+                   for i in range(5)]
+        resp = self.app.post('/users/_bulk', data=json.dumps(records))
+        assert resp.status_code == 200
+        resp = self.app.post('/groups', data=json.dumps({'name': 'empty'}))
+        assert resp.status_code == 200
+        resp = self.app.delete('/users/user0')
+        assert resp.status_code == 200
+
+        # The writes kept every count right
+        assert membercounts.recount(db.session) == 0
+        counts = self.counts()
+        assert counts == {'readers': 4, 'writers': 4, 'empty': 0}
+
+        db.session.execute('UPDATE groups SET member_count = 7 '
+                           "WHERE groupid IN ('readers', 'empty')")
+        assert membercounts.recount(db.session) == 2
+        assert self.counts() == counts
+
+
+if __name__ == '__main__':
+    unittest.main()
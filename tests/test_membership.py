@@ -0,0 +1,200 @@
+import app
+import json
+import threading
+import time
+import unittest
+import test_users
+from bitmap import ARRAY_MAX, RoaringBitmap
+from membership import MembershipIndex
+
+
+class RoaringBitmapTestCase(unittest.TestCase):
+    def test_add_discard(self):
+        """
+        Tests basic set operations across chunk boundaries
+        """
+        bitmap = RoaringBitmap([5, 1, 70000, 5])
+        assert len(bitmap) == 3
+        assert 5 in bitmap
+        assert 70000 in bitmap
+        assert 6 not in bitmap
+        assert list(bitmap) == [1, 5, 70000]
+
+        bitmap.discard(5)
+        bitmap.discard(12345)
+        assert list(bitmap) == [1, 70000]
+
+    def test_dense_chunk(self):
+        """
+        Tests that a chunk switches to a bitmap when it fills up and back when it empties
+        """
+        values = range(0, (ARRAY_MAX + 10) * 3, 3)
+        bitmap = RoaringBitmap(values)
+        assert len(bitmap) == len(values)
+        assert all(x in bitmap for x in values)
+        assert 1 not in bitmap
+        assert list(bitmap) == list(values)
+
+        for value in values[:20]:
+            bitmap.discard(value)
+        assert len(bitmap) == len(values) - 20
+        assert list(bitmap) == list(values[20:])
+
+
+class MembershipIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.index = MembershipIndex()
+        self.index.load([(1, u'spiderman'), (2, u'deadpool')],
+                        [(1, u'admins'), (2, u'users')],
+                        [(1, 1), (1, 2), (2, 2)])
+
+    def test_is_member(self):
+        """
+        Tests lookups against a loaded index
+        """
+        assert self.index.is_member(u'spiderman', u'admins') is True
+        assert self.index.is_member(u'deadpool', u'admins') is False
+        assert self.index.is_member(u'nobody', u'admins') is None
+        assert self.index.is_member(u'deadpool', u'nogroup') is None
+
+    def test_updates(self):
+        """
+        Tests that users and groups can be replaced and removed
+        """
+        # Rename a user and move it between groups
+        self.index.set_user(2, u'venom', [(1, u'admins'), (3, u'villains')])
+        assert self.index.is_member(u'deadpool', u'users') is None
+        assert self.index.is_member(u'venom', u'admins') is True
+        assert self.index.is_member(u'venom', u'villains') is True
+        assert self.index.is_member(u'venom', u'users') is False
+
+        self.index.set_group(1, u'admins', [(1, u'spiderman')])
+        assert self.index.is_member(u'venom', u'admins') is False
+
+        self.index.remove_group(2)
+        assert self.index.is_member(u'spiderman', u'users') is None
+
+        self.index.remove_user(1)
+        assert self.index.is_member(u'spiderman', u'admins') is None
+        assert self.index.stats() == {'users': 1, 'groups': 2,
+                                      'memberships': 1}
+
+
+class MembershipCheckTestCase(test_users.UserTestCase):
+    """
+    Runs the api test suite with the membership index turned on and
+    checks the index still matches the database after every test.
+    """
+    def setUp(self):
+        super(MembershipCheckTestCase, self).setUp()
+        app.app.config['MEMBERSHIP_INDEX_ENABLED'] = True
+
+    def tearDown(self):
+        index = app.app.extensions.pop('membership_index', None)
+        if index is not None:
+            with app.app.app_context():
+                fresh = app.load_membership_index()
+                app.db.session.remove()
+            assert index.user_ids == fresh.user_ids
+            assert index.group_ids == fresh.group_ids
+            assert dict((k, list(v)) for k, v in index.members.items()) == \
+                dict((k, list(v)) for k, v in fresh.members.items())
+        app.app.config['MEMBERSHIP_INDEX_ENABLED'] = False
+        super(MembershipCheckTestCase, self).tearDown()
+
+    def test_update_while_loading(self):
+        """
+        Tests that a write committed while the index loads isn't lost
+        """
+        resp = self.app.post('/users', data=json.dumps(self.test_user1_data))
+        assert resp.status_code == 200
+
+        load = app.load_membership_index
+        writers = []
+
+        def load_then_write():
+            index = load()
+            # The write commits after the load read the database, its
+            # update of the index has to wait for the load to finish.
+            writer = threading.Thread(
+                target=lambda: app.app.test_client().post(
+                    '/users', data=json.dumps(self.test_user2_data)))
+            writer.start()
+            writers.append(writer)
+            deadline = time.time() + 5
+            while time.time() < deadline and not app.db.engine.execute(
+                    "SELECT count(*) FROM users WHERE userid = 'deadpool'"
+            ).scalar():
+                time.sleep(0.01)
+            return index
+
+        app.load_membership_index = load_then_write
+        try:
+            resp = self.app.get('/groups/{}/members/{}'.format(
+                self.test_group2_groupid, self.test_user1_userid))
+            assert json.loads(resp.data)['member'] is True
+        finally:
+            app.load_membership_index = load
+            for writer in writers:
+                writer.join()
+
+        resp = self.app.get('/groups/{}/members/{}'.format(
+            self.test_group2_groupid, self.test_user2_userid))
+        assert resp.status_code == 200
+        assert json.loads(resp.data)['member'] is True
+
+    def check_memberships(self):
+        resp = self.app.post('/users', data=json.dumps(self.test_user1_data))
+        assert resp.status_code == 200
+
+        resp = self.app.post('/users', data=json.dumps(self.test_user2_data))
+        assert resp.status_code == 200
+
+        resp = self.app.get('/groups/{}/members/{}'.format(
+            self.test_group1_groupid, self.test_user1_userid))
+        assert resp.status_code == 200
+        assert json.loads(resp.data)['member'] is True
+
+        resp = self.app.get('/groups/{}/members/{}'.format(
+            self.test_group1_groupid, self.test_user2_userid))
+        assert resp.status_code == 200
+        assert json.loads(resp.data)['member'] is False
+
+        resp = self.app.get('/groups/{}/members/nobody'.format(
+            self.test_group1_groupid))
+        assert resp.status_code == 404
+
+        # Membership changes are seen straight away
+        resp = self.app.put('/groups/{}'.format(self.test_group1_groupid),
+                            data=json.dumps(self.test_group1_modify))
+        assert resp.status_code == 200
+
+        pairs = [{'userid': self.test_user2_userid,
+                  'groupid': self.test_group1_groupid},
+                 {'userid': self.test_user1_userid, 'groupid': u'nogroup'}]
+        resp = self.app.post('/memberships/_check', data=json.dumps(pairs))
+        assert resp.status_code == 200
+        assert [x['member'] for x in json.loads(resp.data)] == [True, None]
+
+        resp = self.app.delete('/users/{}'.format(self.test_user2_userid))
+        assert resp.status_code == 200
+        resp = self.app.post('/memberships/_check', data=json.dumps(pairs))
+        assert [x['member'] for x in json.loads(resp.data)] == [None, None]
+
+        resp = self.app.post('/memberships/_check',
+                             data=json.dumps([[self.test_user1_userid,
+                                               self.test_group1_groupid]]))
+        assert resp.status_code == 400
+
+    def test_check_membership(self):
+        """
+        Tests the membership check endpoints answered from the index
+        """
+        self.check_memberships()
+
+    def test_check_membership_database(self):
+        """
+        Tests the membership check endpoints answered from the database
+        """
+        app.app.config['MEMBERSHIP_INDEX_ENABLED'] = False
+        self.check_memberships()
@@ -0,0 +1,140 @@
+import app
+import json
+import unittest
+from app import db
+from metrics import Histogram
+
+
+class MetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        app.app.config['TESTING'] = True
+        self.app = app.app.test_client()
+        self.user_data = {
+            'first_name': 'Peter',
+            'last_name': 'Parker',
+            'userid': 'spiderman',
+            'groups': ['admins', 'users']
+        }
+        db.create_all()
+
+    def tearDown(self):
+        app.app.config['METRICS_ENABLED'] = False
+        app.app.config['METRICS_DEBUG_HEADER'] = False
+        app.metrics.reset()
+        db.drop_all()
+
+    def test_histogram(self):
+        """
+        Tests that observations are counted in every bucket they fit in
+        """
+        histogram = Histogram((1, 5, 10))
+        for value in (0, 3, 7, 20):
+            histogram.observe(value)
+        assert histogram.counts == [1, 2, 3]
+        assert histogram.count == 4
+        assert histogram.sum == 30
+
+    def test_metrics_disabled(self):
+        """
+        Tests that nothing is recorded or served while metrics are off
+        """
+        resp = self.app.post('/users', data=json.dumps(self.user_data))
+        assert resp.status_code == 200
+        assert app.metrics.requests == {}
+
+        resp = self.app.get('/metrics')
+        assert resp.status_code == 404
+
+    def test_metrics(self):
+        """
+        Tests that requests, sql statements and commits show up in /metrics
+        """
+        app.app.config['METRICS_ENABLED'] = True
+        resp = self.app.post('/users', data=json.dumps(self.user_data))
+        assert resp.status_code == 200
+
+        resp = self.app.get('/users/spiderman')
+        assert resp.status_code == 200
+
+        resp = self.app.get('/metrics')
+        assert resp.status_code == 200
+
+        text = resp.data.decode('utf-8')
+        assert 'http_requests_total{endpoint="find_user",method="GET",status="200"} 1' in text
+        assert 'http_request_duration_seconds_count{endpoint="new_user",method="POST"} 1' in text
+        assert 'http_request_sql_statements_sum{endpoint="find_user",method="GET"} 1' in text
+        assert 'db_commits_total{endpoint="new_user",method="POST"}' in text
+        assert 'db_commits_total{endpoint="find_user",method="GET"} 0' in text
+        assert 'http_request_bytes_total{endpoint="new_user",method="POST"} %d' % (
+            len(json.dumps(self.user_data))) in text
+
+    def test_streamed_metrics(self):
+        """
+        Tests that streamed responses are recorded with the statements run and bytes sent while streaming
+        """
+        app.app.config['METRICS_ENABLED'] = True
+        resp = self.app.post('/users', data=json.dumps(self.user_data))
+        assert resp.status_code == 200
+
+        for path, endpoint in (('/groups/admins?stream=1', 'list_group'),
+                               ('/export', 'export')):
+            resp = self.app.get(path)
+            assert resp.status_code == 200
+            size = len(resp.data)
+            assert size
+            resp.close()
+
+            key = (endpoint, 'GET')
+            assert app.metrics.requests[key + ('200',)] == 1
+            assert app.metrics.statements[key].sum > 0
+            assert app.metrics.counters[
+                ('http_response_bytes_total',) + key] == size
+
+    def test_debug_header(self):
+        """
+        Tests that the query count header is only sent when asked for
+        """
+        app.app.config['METRICS_DEBUG_HEADER'] = True
+        resp = self.app.post('/users', data=json.dumps(self.user_data))
+        assert 'X-Query-Count' not in resp.headers
+
+        resp = self.app.get('/users/spiderman',
+                            headers={'X-Debug-Queries': '1'})
+        assert resp.status_code == 200
+        assert resp.headers['X-Query-Count'] == '1'
+        assert float(resp.headers['X-Query-Time']) >= 0
+
+        # Nothing is kept between requests unless metrics are on
+        assert app.metrics.requests == {}
+
+    def test_not_modified_query_count(self):
+        """
+        Tests that a conditional GET answered with 304 runs a single query
+        """
+        app.app.config['METRICS_DEBUG_HEADER'] = True
+        resp = self.app.post('/users', data=json.dumps(self.user_data))
+        etag = resp.headers['ETag']
+
+        resp = self.app.get('/users/spiderman',
+                            headers={'X-Debug-Queries': '1',
+                                     'If-None-Match': etag})
+        assert resp.status_code == 304
+        assert resp.headers['X-Query-Count'] == '1'
+
+    def test_get_users_query_count(self):
+        """
+        Tests that fetching many users runs one query for them and one for their groups
+        """
+        app.app.config['METRICS_DEBUG_HEADER'] = True
+        userids = []
+        for i in range(20):
+            userids.append('user{}'.format(i))
+            data = dict(self.user_data, userid=userids[-1])
+            resp = self.app.post('/users', data=json.dumps(data))
+            assert resp.status_code == 200
+
+        resp = self.app.post('/users/_mget', data=json.dumps(userids),
+                             headers={'X-Debug-Queries': '1'})
+        assert resp.status_code == 200
+        assert resp.headers['X-Query-Count'] == '2'
+        assert len(json.loads(resp.data)) == 20
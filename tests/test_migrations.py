@@ -0,0 +1,85 @@
+import os
+import shutil
+import tempfile
+import unittest
+import app
+import migrations
+from app import db
+
+# The schema as created by the first release of the app
+OLD_SCHEMA = [
+    'CREATE TABLE users (id INTEGER NOT NULL, first_name VARCHAR(32), '
+    'last_name VARCHAR(32), userid VARCHAR(32), PRIMARY KEY (id), UNIQUE (userid))',
+    'CREATE TABLE groups (id INTEGER NOT NULL, groupid VARCHAR(32), '
+    'PRIMARY KEY (id), UNIQUE (groupid))',
+    'CREATE TABLE usergroups (userid INTEGER, groupid INTEGER, '
+    'PRIMARY KEY (userid, groupid), FOREIGN KEY(userid) REFERENCES users (id), '
+    'FOREIGN KEY(groupid) REFERENCES groups (id))',
+]
+
+
+class MigrationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.old_uri = app.app.config['SQLALCHEMY_DATABASE_URI']
+        app.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(
+            self.tmpdir, 'test.db')
+
+    def tearDown(self):
+        db.session.remove()
+        db.engine.dispose()
+        app.app.config['SQLALCHEMY_DATABASE_URI'] = self.old_uri
+        shutil.rmtree(self.tmpdir)
+
+    def test_fresh_database(self):
+        """
+        Tests that a new database is created at the latest version
+        """
+        assert migrations.upgrade(db) == []
+        version = db.engine.execute('SELECT max(version) FROM schema_version').scalar()
+        assert version == len(migrations.MIGRATIONS)
+
+        # Running it again is a no-op
+        assert migrations.upgrade(db) == []
+
+    def test_upgrade_old_database(self):
+        """
+        Tests that a database from the first release gets every migration
+        """
+        conn = db.engine.connect()
+        # The old app never turned foreign keys on
+        conn.execute('PRAGMA foreign_keys=OFF')
+        for statement in OLD_SCHEMA:
+            conn.execute(statement)
+        conn.execute("INSERT INTO users VALUES (1, 'Peter', 'Parker', 'spiderman')")
+        conn.execute("INSERT INTO groups VALUES (1, 'admins')")
+        conn.execute('INSERT INTO usergroups VALUES (1, 1)')
+        # A dangling membership the old schema let through
+        conn.execute('INSERT INTO usergroups VALUES (2, 1)')
+        conn.close()
+
+        applied = migrations.upgrade(db)
+        assert applied == ['add_usergroups_cascade_and_index',
+                           'add_version_columns',
+                           'add_user_search_terms',
+                           'add_group_member_counts']
+
+        indexes = db.engine.execute('PRAGMA index_list(usergroups)').fetchall()
+        assert 'ix_usergroups_groupid_userid' in [x[1] for x in indexes]
+        assert db.engine.execute('SELECT * FROM usergroups').fetchall() == [(1, 1)]
+
+        # Existing rows start at version 1
+        assert db.engine.execute('SELECT version FROM users').scalar() == 1
+        assert db.engine.execute('SELECT version FROM groups').scalar() == 1
+
+        # Existing users are searchable
+        terms = db.engine.execute('SELECT term FROM userterms ORDER BY term')
+        assert [x[0] for x in terms] == ['parker', 'peter', 'spiderman']
+
+        # Existing groups are counted, without the dangling membership
+        assert db.engine.execute('SELECT member_count FROM groups').scalar() == 1
+
+        # Deleting the user now removes its memberships and terms
+        db.engine.execute('DELETE FROM users WHERE id = 1')
+        assert db.engine.execute('SELECT count(*) FROM usergroups').scalar() == 0
+        assert db.engine.execute('SELECT count(*) FROM userterms').scalar() == 0
@@ -0,0 +1,181 @@
+import app
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from app import db
+from database import ReplicaPool
+
+
+class ReplicaPoolTestCase(unittest.TestCase):
+    def test_round_robin(self):
+        """
+        Tests that replicas are handed out in turn
+        """
+        pool = ReplicaPool(['a', 'b', 'c'])
+        assert [pool.choose() for _ in range(6)] == ['a', 'b', 'c'] * 2
+
+    def test_eject(self):
+        """
+        Tests that an ejected replica is skipped until its time is up
+        """
+        pool = ReplicaPool(['a', 'b'], eject_seconds=0.05)
+        pool.eject('a')
+        assert [pool.choose() for _ in range(3)] == ['b', 'b', 'b']
+        assert pool.stats() == {'replicas': 2, 'ejected': ['a'],
+                                'ejections': 1}
+
+        pool.eject('b')
+        assert pool.choose() is None
+
+        time.sleep(0.1)
+        assert sorted([pool.choose(), pool.choose()]) == ['a', 'b']
+        assert pool.stats()['ejected'] == []
+
+
+class ReplicaTestCase(unittest.TestCase):
+    """
+    Serves reads from a replica that is a copy of the primary's SQLite
+    file, only brought up to date when a test calls sync().
+    """
+    def setUp(self):
+        app.app.config['TESTING'] = True
+        self.tmpdir = tempfile.mkdtemp()
+        self.replica_path = os.path.join(self.tmpdir, 'replica.db')
+        app.app.config['DB_REPLICA_URLS'] = ['sqlite:///' + self.replica_path]
+        self.app = app.app.test_client()
+        self.user_data = {
+            'first_name': 'Peter',
+            'last_name': 'Parker',
+            'userid': 'spiderman',
+            'groups': ['admins']
+        }
+        db.create_all()
+        self.sync()
+
+    def tearDown(self):
+        db.drop_all()
+        app.app.config['DB_REPLICA_URLS'] = []
+        app.app.extensions.pop('replica_pool', None)
+        shutil.rmtree(self.tmpdir)
+
+    def sync(self):
+        db.session.remove()
+        shutil.copyfile(db.engine.url.database, self.replica_path)
+
+    def replica_count(self, table):
+        engine = db.get_engine(app.app, bind='replica:0')
+        return engine.execute('SELECT count(*) FROM {}'.format(table)).scalar()
+
+    def test_reads_use_replica(self):
+        """
+        Tests that other clients read from the replica until it's synced
+        """
+        resp = self.app.post('/users', data=json.dumps(self.user_data))
+        assert resp.status_code == 200
+
+        other = app.app.test_client()
+        resp = other.get('/users/spiderman')
+        assert resp.status_code == 404
+
+        self.sync()
+        resp = other.get('/users/spiderman')
+        assert resp.status_code == 200
+        assert json.loads(resp.data)['groups'] == ['admins']
+
+    def test_writes_use_primary(self):
+        """
+        Tests that writes never touch the replica
+        """
+        resp = self.app.post('/users', data=json.dumps(self.user_data))
+        assert resp.status_code == 200
+        resp = self.app.put('/groups/admins', data=json.dumps([]))
+        assert resp.status_code == 200
+
+        assert self.replica_count('users') == 0
+        assert self.replica_count('groups') == 0
+
+    def test_read_your_writes(self):
+        """
+        Tests that a client reads its own writes before the replica has them
+        """
+        resp = self.app.post('/users', data=json.dumps(self.user_data))
+        assert resp.status_code == 200
+        assert app.READ_PRIMARY_COOKIE in resp.headers['Set-Cookie']
+
+        resp = self.app.get('/users/spiderman')
+        assert resp.status_code == 200
+
+        other = app.app.test_client()
+        resp = other.get('/users/spiderman',
+                         headers={'X-Read-Primary': '1'})
+        assert resp.status_code == 200
+
+    def test_read_your_writes_expires(self):
+        """
+        Tests that a client goes back to the replica once its window passes
+        """
+        app.app.config['DB_READ_YOUR_WRITES_SECONDS'] = 0
+        try:
+            resp = self.app.post('/users', data=json.dumps(self.user_data))
+            assert resp.status_code == 200
+            resp = self.app.get('/users/spiderman')
+            assert resp.status_code == 404
+        finally:
+            app.app.config['DB_READ_YOUR_WRITES_SECONDS'] = 5
+
+    def test_replica_reads_not_cached(self):
+        """
+        Tests that a lagging replica's documents don't end up in the cache
+        """
+        app.app.config['CACHE_ENABLED'] = True
+        try:
+            resp = self.app.post('/users', data=json.dumps(self.user_data))
+            assert resp.status_code == 200
+            self.sync()
+
+            resp = self.app.put('/users/spiderman', data=json.dumps(
+                dict(self.user_data, first_name='Miles')))
+            assert resp.status_code == 200
+
+            other = app.app.test_client()
+            resp = other.get('/users/spiderman')
+            assert json.loads(resp.data)['first_name'] == 'Peter'
+            resp = other.get('/users/spiderman',
+                             headers={'X-Read-Primary': '1'})
+            assert json.loads(resp.data)['first_name'] == 'Miles'
+            resp = self.app.get('/users/spiderman')
+            assert json.loads(resp.data)['first_name'] == 'Miles'
+
+            self.sync()
+            resp = other.get('/users/spiderman')
+            assert json.loads(resp.data)['first_name'] == 'Miles'
+        finally:
+            app.app.config['CACHE_ENABLED'] = False
+            app.app.extensions.pop('user_group_cache', None)
+
+    def test_failed_replica_ejected(self):
+        """
+        Tests that a replica that can't be reached is ejected and the read retried
+        """
+        missing = os.path.join(self.tmpdir, 'missing', 'replica.db')
+        app.app.config['DB_REPLICA_URLS'] = ['sqlite:///' + missing,
+                                             'sqlite:///' + self.replica_path]
+        resp = self.app.post('/users', data=json.dumps(self.user_data))
+        assert resp.status_code == 200
+        self.sync()
+
+        other = app.app.test_client()
+        for _ in range(3):
+            resp = other.get('/users/spiderman')
+            assert resp.status_code == 200
+
+        stats = app.app.extensions['replica_pool'].stats()
+        assert stats['ejected'] == ['replica:0']
+        assert stats['ejections'] == 1
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+import app
+import json
+import unittest
+import search
+from app import db
+
+
+class SearchTestCase(unittest.TestCase):
+    def setUp(self):
+        app.app.config['TESTING'] = True
+        self.app = app.app.test_client()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def add_users(self, count, prefix):
+        records = [{'userid': u'{}{}'.format(prefix, i),
+                    'first_name': u'Mary Jane', 'last_name': u'Watson-Parker',
+                    'groups': ['readers']} for i in range(count)]
+        resp = self.app.post('/users/_bulk', data=json.dumps(records))
+        assert resp.status_code == 200
+
+    def terms(self):
+        table = app.user_terms
+        return sorted(tuple(x) for x in db.session.execute(
+            db.select([table.c.term, table.c.userid, table.c.field])))
+
+    def test_tokenize(self):
+        """
+        Tests that text is split into distinct lowercased words
+        """
+        assert search.tokenize(u'Mary-Jane  WATSON mary') == \
+            [u'mary', u'jane', u'watson']
+        assert search.tokenize(u'x' * 40) == [u'x' * search.MAX_TERM_LENGTH]
+        assert search.tokenize(u' .- ') == []
+        assert search.tokenize(None) == []
+
+    def test_query_plan(self):
+        """
+        Tests that searches are answered from the userterms and users indexes
+        """
+        statements = []
+
+        class Recorder(object):
+            def execute(self, statement):
+                statements.append(statement)
+                return []
+
+        search.search(Recorder(), u'peter par', 10)
+        sql = str(statements[0].compile(
+            compile_kwargs={'literal_binds': True}))
+        plan = [str(tuple(x)[-1]) for x in
+                db.session.execute('EXPLAIN QUERY PLAN ' + sql)]
+        assert 'userterms' in ' '.join(plan)
+        # Only the handful of candidates is scanned
+        assert [x for x in plan if x.startswith('SCAN ')] == \
+            ['SCAN candidates']
+
+    def test_incremental_matches_rebuild(self):
+        """
+        Tests that terms kept up to date by writes match a rebuild
+        """
+        self.add_users(20, u'mj')
+        resp = self.app.put('/users/mj3', data=json.dumps(
+            {'userid': 'mj3', 'first_name': 'Gwen', 'last_name': 'Stacy',
+             'groups': ['readers']}))
+        assert resp.status_code == 200
+        assert self.app.delete('/users/mj4').status_code == 200
+
+        incremental = self.terms()
+        assert search.rebuild(db.session) == 19
+        assert self.terms() == incremental
+
+    def test_max_candidates(self):
+        """
+        Tests that only the first candidates of a broad prefix are ranked
+        """
+        self.add_users(30, u'mj')
+        found = search.search(db.session, u'mar', 100, max_candidates=10)
+        assert len(found) == 10
+
+        # The longest word picks the candidates
+        found = search.search(db.session, u'mar mj29', 100,
+                              max_candidates=10)
+        assert [x[1] for x in found] == [u'mj29']
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import app
+import snapshot
+from app import db
+
+
+class SnapshotTestCase(unittest.TestCase):
+    def setUp(self):
+        app.app.config['TESTING'] = True
+        self.tmpdir = tempfile.mkdtemp()
+        self.old_uri = app.app.config['SQLALCHEMY_DATABASE_URI']
+        self.use_database('source.db')
+        self.app = app.app.test_client()
+
+        users = [
+            (u'spiderman', [u'admins', u'users']),
+            (u'deadpool', [u'users']),
+            (u'venom', [u'villains', u'users', u'admins']),
+            (u'n\xf8body', [u'\xfcsers']),
+        ]
+        for userid, groups in users:
+            body = {'userid': userid, 'first_name': u'First',
+                    'last_name': u'Last', 'groups': groups}
+            resp = self.app.post('/users', data=json.dumps(body))
+            assert resp.status_code == 200
+
+        resp = self.app.post('/groups', data=json.dumps({'name': u'empty'}))
+        assert resp.status_code == 200
+
+        # admins > users > villains
+        for groupid, subgroupid in [(u'admins', u'users'),
+                                    (u'users', u'villains')]:
+            resp = self.app.put(u'/groups/{}/groups'.format(groupid),
+                                data=json.dumps([subgroupid]))
+            assert resp.status_code == 200
+        self.state = self.database_state()
+        assert self.state[2] == [(u'admins', u'users', 1, 1),
+                                 (u'admins', u'villains', 2, 1),
+                                 (u'users', u'villains', 1, 1)]
+
+    def tearDown(self):
+        db.session.remove()
+        db.engine.dispose()
+        app.app.config['SQLALCHEMY_DATABASE_URI'] = self.old_uri
+        shutil.rmtree(self.tmpdir)
+
+    def use_database(self, name):
+        db.session.remove()
+        app.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(
+            self.tmpdir, name)
+        db.create_all()
+
+    def database_state(self):
+        users = {}
+        for user in app.User.query.all():
+            users[user.userid] = (user.first_name, user.last_name,
+                                  sorted(x.groupid for x in user.groups))
+        groups = sorted(x.groupid for x in app.Group.query.all())
+        closure_table = app.group_closure
+        ancestor = app.Group.__table__.alias()
+        descendant = app.Group.__table__.alias()
+        closure = sorted(tuple(x) for x in db.session.execute(
+            db.select([ancestor.c.groupid, descendant.c.groupid,
+                       closure_table.c.depth, closure_table.c.paths])
+            .where(ancestor.c.id == closure_table.c.ancestor)
+            .where(descendant.c.id == closure_table.c.descendant)))
+        return users, groups, closure
+
+    def check_restore(self, data):
+        self.use_database('restored.db')
+        counts = snapshot.restore(db.engine, io.BytesIO(data))
+        assert counts == {'users': 4, 'groups': 5, 'subgroups': 2,
+                          'memberships': 7}
+        assert self.database_state() == self.state
+
+        # The restored database works like any other
+        resp = self.app.get('/groups/users')
+        assert resp.status_code == 200
+        assert len(json.loads(resp.data)) == 3
+        resp = self.app.get('/users/_search?q=spider')
+        assert [x['userid'] for x in json.loads(resp.data)] == [u'spiderman']
+        resp = self.app.get('/groups/users/stats')
+        assert json.loads(resp.data)['member_count'] == 3
+
+    def test_export_ndjson(self):
+        """
+        Tests exporting a snapshot as NDJSON and restoring it
+        """
+        resp = self.app.get('/export')
+        assert resp.status_code == 200
+        assert resp.mimetype == 'application/x-ndjson'
+        lines = [json.loads(x) for x in resp.data.splitlines()]
+        assert lines[0]['type'] == 'snapshot'
+        assert lines[0]['change_seq'] > 0
+        assert [x['type'] for x in lines[1:]] == \
+            ['group'] * 5 + ['subgroup'] * 2 + ['user'] * 4
+        assert lines[6] == {'type': 'subgroup', 'groupid': u'admins',
+                            'subgroupid': u'users'}
+        assert lines[8] == {'type': 'user', 'userid': u'spiderman',
+                            'first_name': u'First', 'last_name': u'Last',
+                            'groups': [u'admins', u'users']}
+
+        self.check_restore(resp.data)
+
+    def test_export_binary(self):
+        """
+        Tests exporting a snapshot in the binary format and restoring it
+        """
+        resp = self.app.get('/export?format=binary')
+        assert resp.status_code == 200
+        assert resp.data.startswith(snapshot.MAGIC)
+        self.check_restore(resp.data)
+
+        resp = self.app.get('/export?format=xml')
+        assert resp.status_code == 400
+        assert json.loads(resp.data)['errors'][0]['field'] == 'format'
+
+    def test_small_batches(self):
+        """
+        Tests that users split across fetch batches come out whole
+        """
+        for export in (snapshot.export_ndjson, snapshot.export_binary):
+            data = b''.join(export(db.engine, batch_size=2))
+            decoded = list(snapshot.read_snapshot(io.BytesIO(data)))
+            users = dict(x[1][::3] for x in decoded if x[0] == 'user')
+            assert users == dict((k, v[2])
+                                 for k, v in self.state[0].items())
+
+    def test_restore_not_empty(self):
+        """
+        Tests that a snapshot isn't restored over existing data
+        """
+        data = b''.join(snapshot.export_binary(db.engine))
+        self.assertRaises(snapshot.SnapshotError, snapshot.restore,
+                          db.engine, io.BytesIO(data))
+        self.assertRaises(snapshot.SnapshotError, snapshot.restore,
+                          db.engine, io.BytesIO(data[:-3]))
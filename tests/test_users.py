@@ -1,7 +1,10 @@
 import app
+import threading
+import time
 import unittest
 import json
 from copy import deepcopy
+from werkzeug.exceptions import HTTPException
 from app import db
 
 
@@ -53,6 +56,37 @@ class UserTestCase(unittest.TestCase):
         for groupid in self.test_user1_groups:
             assert groupid in data['groups']
 
+    def test_new_user_new_groups(self):
+        """
+        Tests that groups created for a new user are only added once
+        """
+        body = dict(self.test_user2_data, groups=['villains', 'villains'])
+        resp = self.app.post('/users', data=json.dumps(body))
+        assert resp.status_code == 200
+        assert json.loads(resp.data)['groups'] == ['villains']
+
+        resp = self.app.get('/groups/villains/stats')
+        assert json.loads(resp.data)['member_count'] == 1
+
+    def test_new_user_rolled_back(self):
+        """
+        Tests that groups created for a new user are rolled back with it
+        """
+        def fail(*args):
+            raise RuntimeError('index_users failed')
+
+        index_users = app.search.index_users
+        app.search.index_users = fail
+        try:
+            body = dict(self.test_user2_data, groups=['villains'])
+            self.assertRaises(RuntimeError, self.app.post, '/users',
+                              data=json.dumps(body))
+        finally:
+            app.search.index_users = index_users
+
+        resp = self.app.get('/groups/villains')
+        assert resp.status_code == 404
+
     def test_new_user_409(self):
         """
         Tests that a duplicate user creation attempt results in a 409
@@ -90,6 +124,25 @@ class UserTestCase(unittest.TestCase):
         resp = self.app.post('/users', data=json.dumps(user1_body))
         assert resp.status_code == 400
 
+    def test_new_user_400_errors(self):
+        """
+        Tests that a 400 lists every problem with the body
+        """
+        user1_body = deepcopy(self.test_user1_data)
+        del(user1_body['first_name'])
+        user1_body['last_name'] = 7
+        user1_body['groups'] = [self.test_group1_groupid, None]
+        resp = self.app.post('/users', data=json.dumps(user1_body))
+        assert resp.status_code == 400
+        assert resp.mimetype == 'application/json'
+        errors = json.loads(resp.data)['errors']
+        assert sorted(x['field'] for x in errors) == ['first_name', 'groups.1',
+                                                      'last_name']
+
+        resp = self.app.post('/users', data='{"userid": ')
+        assert resp.status_code == 400
+        assert json.loads(resp.data)['errors'][0]['field'] is None
+
     def test_get_user_exists(self):
         """
         Tests that once a user is created a subsequent get on that user returns valid user data.
@@ -321,3 +374,763 @@ class UserTestCase(unittest.TestCase):
         # Fetch the group to check that it persists
         resp = self.app.get('/groups/{}'.format(groupid))
         assert resp.status_code == 200
+
+    def group_stats(self, groupid):
+        resp = self.app.get('/groups/{}/stats'.format(groupid))
+        assert resp.status_code == 200
+        return json.loads(resp.data)
+
+    def test_group_stats(self):
+        """
+        Tests that member counts follow every write that changes memberships
+        """
+        resp = self.app.get('/groups/{}/stats'.format(self.test_group1_groupid))
+        assert resp.status_code == 404
+
+        resp = self.app.post('/users', data=json.dumps(self.test_user1_data))
+        assert resp.status_code == 200
+        assert self.group_stats(self.test_group1_groupid) == {
+            'groupid': self.test_group1_groupid, 'member_count': 1,
+            'subgroup_count': 0}
+
+        records = [dict(self.test_user2_data, userid='user{}'.format(i))
+                   for i in range(3)]
+        resp = self.app.post('/users/_bulk', data=json.dumps(records))
+        assert resp.status_code == 200
+        assert self.group_stats(self.test_group2_groupid)['member_count'] == 4
+
+        resp = self.app.put('/groups/{}'.format(self.test_group1_groupid),
+                            data=json.dumps(['user0', 'user1']))
+        assert resp.status_code == 200
+        assert self.group_stats(self.test_group1_groupid)['member_count'] == 2
+
+        resp = self.app.patch('/users/user0/groups', data=json.dumps(
+            {'add': ['villains'], 'remove': [self.test_group2_groupid]}))
+        assert resp.status_code == 200
+        assert self.group_stats('villains')['member_count'] == 1
+        assert self.group_stats(self.test_group2_groupid)['member_count'] == 3
+
+        resp = self.app.put('/users/user1', data=json.dumps(
+            dict(self.test_user2_data, userid='user1', groups=['villains'])))
+        assert resp.status_code == 200
+        assert self.group_stats('villains')['member_count'] == 2
+        assert self.group_stats(self.test_group1_groupid)['member_count'] == 1
+
+        resp = self.app.delete('/users/user1')
+        assert resp.status_code == 200
+        assert self.group_stats('villains')['member_count'] == 1
+
+        # The counts match the member lists
+        for groupid in (self.test_group1_groupid, self.test_group2_groupid,
+                        'villains'):
+            resp = self.app.get('/groups/{}'.format(groupid))
+            assert self.group_stats(groupid)['member_count'] == \
+                len(json.loads(resp.data))
+
+    def test_list_groups(self):
+        """
+        Tests listing groups with their member counts a page at a time
+        """
+        resp = self.app.post('/users', data=json.dumps(self.test_user1_data))
+        assert resp.status_code == 200
+        resp = self.app.post('/users', data=json.dumps(self.test_user2_data))
+        assert resp.status_code == 200
+        resp = self.app.post('/groups', data=json.dumps({'name': 'villains'}))
+        assert resp.status_code == 200
+
+        resp = self.app.get('/groups')
+        assert resp.status_code == 200
+        assert 'Link' not in resp.headers
+        assert json.loads(resp.data) == [
+            {'groupid': self.test_group1_groupid, 'member_count': 1},
+            {'groupid': self.test_group2_groupid, 'member_count': 2},
+            {'groupid': 'villains', 'member_count': 0}]
+
+        pages = []
+        url = '/groups?limit=2'
+        while url:
+            resp = self.app.get(url)
+            assert resp.status_code == 200
+            pages.append([x['groupid'] for x in json.loads(resp.data)])
+            link = resp.headers.get('Link')
+            url = link[1:link.index('>')] if link else None
+        assert pages == [[self.test_group1_groupid, self.test_group2_groupid],
+                         ['villains']]
+
+        # A full last page doesn't link to an empty one
+        resp = self.app.get('/groups?limit=3')
+        assert len(json.loads(resp.data)) == 3
+        assert 'Link' not in resp.headers
+
+        # The page starts after the groupid whether or not it exists
+        resp = self.app.get('/groups?after=b')
+        assert [x['groupid'] for x in json.loads(resp.data)] == \
+            [self.test_group2_groupid, 'villains']
+
+        for args, message in [('limit=0', 'must be between 1 and 1000'),
+                              ('limit=1001', 'must be between 1 and 1000'),
+                              ('limit=x', 'must be a whole number')]:
+            resp = self.app.get('/groups?' + args)
+            assert resp.status_code == 400
+            assert json.loads(resp.data) == {'errors': [
+                {'field': 'limit', 'message': message}]}
+
+    def test_bulk_new_users(self):
+        """
+        Test creating many users in one request with a mix of new, duplicate and invalid records
+        """
+        # Create a user ahead of time so the bulk load conflicts with it
+        resp = self.app.post('/users', data=json.dumps(self.test_user2_data))
+        assert resp.status_code == 200
+
+        invalid = deepcopy(self.test_user1_data)
+        invalid['userid'] = 'invalid'
+        del(invalid['first_name'])
+        records = [self.test_user1_data, self.test_user2_data,
+                   self.test_user1_data, invalid]
+        resp = self.app.post('/users/_bulk', data=json.dumps(records))
+        assert resp.status_code == 200
+
+        data = json.loads(resp.data)
+        assert [x['status'] for x in data] == [200, 409, 409, 400]
+        assert [x['userid'] for x in data] == [self.test_user1_userid,
+                                               self.test_user2_userid,
+                                               self.test_user1_userid,
+                                               'invalid']
+        assert data[3]['errors'] == [{'field': 'first_name',
+                                      'message': 'is required'}]
+
+        # The new user and its groups should now be fetchable
+        resp = self.app.get('/users/{}'.format(self.test_user1_userid))
+        assert resp.status_code == 200
+
+        data = json.loads(resp.data)
+        assert sorted(data['groups']) == sorted(self.test_user1_groups)
+
+        resp = self.app.get('/groups/{}'.format(self.test_group2_groupid))
+        data = json.loads(resp.data)
+        assert sorted(data) == sorted([self.test_user1_userid,
+                                       self.test_user2_userid])
+
+    def test_bulk_new_users_ndjson(self):
+        """
+        Test that the bulk endpoint accepts newline delimited json
+        """
+        body = '\n'.join([json.dumps(self.test_user1_data),
+                          json.dumps(self.test_user2_data)])
+        # Without the NDJSON Content-Type the body has to be one array
+        resp = self.app.post('/users/_bulk', data=body)
+        assert resp.status_code == 400
+
+        resp = self.app.post('/users/_bulk', data=body,
+                             content_type=app.NDJSON_MIMETYPE)
+        assert resp.status_code == 200
+
+        data = json.loads(resp.data)
+        assert [x['result'] for x in data] == ['created', 'created']
+
+        resp = self.app.get('/users/{}'.format(self.test_user2_userid))
+        assert resp.status_code == 200
+
+    def test_bulk_new_users_ndjson_invalid_line(self):
+        """
+        Test that a line that isn't json or a user only fails its own record
+        """
+        body = '\n'.join(['[1, 2]', json.dumps(self.test_user1_data),
+                          'not json', json.dumps(self.test_user2_data)])
+        resp = self.app.post('/users/_bulk', data=body,
+                             content_type=app.NDJSON_MIMETYPE)
+        assert resp.status_code == 200
+
+        data = json.loads(resp.data)
+        assert [x['status'] for x in data] == [400, 200, 400, 200]
+        assert data[2] == {'userid': None, 'status': 400,
+                           'result': 'invalid',
+                           'errors': [{'field': None,
+                                       'message': 'must be valid json'}]}
+
+        resp = self.app.get('/users/{}'.format(self.test_user2_userid))
+        assert resp.status_code == 200
+
+    def test_get_users(self):
+        """
+        Tests that many users are fetched at once with missing ones as null
+        """
+        for data in [self.test_user1_data, self.test_user2_data]:
+            resp = self.app.post('/users', data=json.dumps(data))
+            assert resp.status_code == 200
+
+        userids = [self.test_user1_userid, 'nobody', self.test_user2_userid]
+        resp = self.app.post('/users/_mget', data=json.dumps(userids))
+        assert resp.status_code == 200
+
+        data = json.loads(resp.data)
+        assert sorted(data) == sorted(userids)
+        assert data['nobody'] is None
+        for user_data in [self.test_user1_data, self.test_user2_data]:
+            found = data[user_data['userid']]
+            assert sorted(found['groups']) == sorted(user_data['groups'])
+            del found['groups']
+            for key in ['first_name', 'last_name', 'userid']:
+                assert found[key] == user_data[key]
+
+    def test_get_users_400(self):
+        """
+        Tests that asking for more users than allowed fails with 400
+        """
+        app.app.config['USERS_MGET_MAX_IDS'] = 2
+        try:
+            resp = self.app.post('/users/_mget',
+                                 data=json.dumps(['a', 'b', 'c']))
+        finally:
+            app.app.config['USERS_MGET_MAX_IDS'] = 500
+        assert resp.status_code == 400
+
+        resp = self.app.post('/users/_mget', data=json.dumps({'ids': []}))
+        assert resp.status_code == 400
+
+    def test_search_users(self):
+        """
+        Tests that users are found by prefixes of their userid and names, best matches first
+        """
+        peter = deepcopy(self.test_user2_data)
+        peter.update(userid='peterq', first_name='Quill', last_name='Peterson')
+        resp = self.app.post('/users/_bulk', data=json.dumps(
+            [self.test_user1_data, self.test_user2_data, peter]))
+        assert resp.status_code == 200
+
+        def search(path):
+            resp = self.app.get(path)
+            assert resp.status_code == 200
+            return [x['userid'] for x in json.loads(resp.data)]
+
+        # A userid prefix beats a name prefix and an exact name beats both
+        assert search('/users/_search?q=pete') == ['peterq', 'spiderman']
+        assert search('/users/_search?q=peter') == ['spiderman', 'peterq']
+        assert search('/users/_search?q=PETER%20park') == ['spiderman']
+        assert search('/users/_search?q=wil') == ['deadpool']
+        assert search('/users/_search?q=nobody') == []
+
+        resp = self.app.get('/users/_search?q=peter&limit=1')
+        assert [x['userid'] for x in json.loads(resp.data)] == ['spiderman']
+        assert json.loads(resp.data)[0]['first_name'] == 'Peter'
+        assert 'offset=1' in resp.headers['Link']
+        resp = self.app.get('/users/_search?q=peter&limit=1&offset=1')
+        assert [x['userid'] for x in json.loads(resp.data)] == ['peterq']
+        assert 'Link' not in resp.headers
+
+        # Renames and deletes are searchable straight away
+        renamed = dict(self.test_user1_data, first_name='Ben')
+        resp = self.app.put('/users/spiderman', data=json.dumps(renamed))
+        assert resp.status_code == 200
+        assert search('/users/_search?q=peter') == ['peterq']
+        assert search('/users/_search?q=ben') == ['spiderman']
+        resp = self.app.delete('/users/peterq')
+        assert resp.status_code == 200
+        assert search('/users/_search?q=pete') == []
+
+    def test_search_users_400(self):
+        """
+        Tests that searches without words or with bad paging fail with 400
+        """
+        for path, field in [
+                ('/users/_search', 'q'),
+                ('/users/_search?q=%20-', 'q'),
+                ('/users/_search?q=' + '+'.join('abcdefghi'), 'q'),
+                ('/users/_search?q=a&limit=0', 'limit'),
+                ('/users/_search?q=a&limit=101', 'limit'),
+                ('/users/_search?q=a&offset=-1', 'offset'),
+                ('/users/_search?q=a&offset=x', 'offset')]:
+            resp = self.app.get(path)
+            assert resp.status_code == 400, path
+            errors = json.loads(resp.data)['errors']
+            assert [x['field'] for x in errors] == [field], path
+
+    def test_modify_user_groups(self):
+        """
+        Tests that a PUT only changes the memberships that differ from what is stored
+        """
+        resp = self.app.post('/users', data=json.dumps(self.test_user1_data))
+        assert resp.status_code == 200
+
+        new_body = deepcopy(self.test_user1_data)
+        new_body['groups'] = [self.test_group2_groupid, u'avengers']
+        resp = self.app.put('/users/{}'.format(self.test_user1_userid),
+                            data=json.dumps(new_body))
+        assert resp.status_code == 200
+
+        data = json.loads(resp.data)
+        assert sorted(data['groups']) == sorted(new_body['groups'])
+
+        # The removed group should no longer list the user
+        resp = self.app.get('/groups/{}'.format(self.test_group1_groupid))
+        assert resp.status_code == 200
+        assert json.loads(resp.data) == []
+
+    def test_patch_user_groups(self):
+        """
+        Tests adding and removing groups without sending the full group list
+        """
+        resp = self.app.post('/users', data=json.dumps(self.test_user1_data))
+        assert resp.status_code == 200
+
+        body = {'add': [u'avengers', self.test_group2_groupid],
+                'remove': [self.test_group1_groupid, u'notagroup']}
+        resp = self.app.patch('/users/{}/groups'.format(self.test_user1_userid),
+                              data=json.dumps(body))
+        assert resp.status_code == 200
+
+        data = json.loads(resp.data)
+        assert sorted(data['groups']) == sorted([u'avengers',
+                                                 self.test_group2_groupid])
+
+        # Bad data type for add
+        resp = self.app.patch('/users/{}/groups'.format(self.test_user1_userid),
+                              data=json.dumps({'add': u'avengers'}))
+        assert resp.status_code == 400
+
+        resp = self.app.patch('/users/thisuserdoesntexist/groups',
+                              data=json.dumps(body))
+        assert resp.status_code == 404
+
+    def test_patch_user_groups_overlap(self):
+        """
+        Tests that a groupid in both add and remove is rejected
+        """
+        resp = self.app.post('/users', data=json.dumps(self.test_user1_data))
+        assert resp.status_code == 200
+
+        body = {'add': [u'villains', self.test_group1_groupid, u'avengers'],
+                'remove': [u'avengers', self.test_group1_groupid]}
+        resp = self.app.patch('/users/{}/groups'.format(self.test_user1_userid),
+                              data=json.dumps(body))
+        assert resp.status_code == 400
+        assert json.loads(resp.data) == {'errors': [
+            {'field': 'remove',
+             'message': 'must not also be added: admins, avengers'}]}
+
+        # Nothing was changed
+        resp = self.app.get('/users/{}'.format(self.test_user1_userid))
+        assert sorted(json.loads(resp.data)['groups']) == \
+            sorted(self.test_user1_groups)
+
+    def next_link(self, resp):
+        link = resp.headers['Link']
+        return link[1:link.index('>')]
+
+    def test_list_group_paginated(self):
+        """
+        Page through a group's members using the after and limit parameters
+        """
+        resp = self.app.post('/users', data=json.dumps(self.test_user1_data))
+        assert resp.status_code == 200
+
+        resp = self.app.post('/users', data=json.dumps(self.test_user2_data))
+        assert resp.status_code == 200
+
+        resp = self.app.get('/groups/{}?limit=1'.format(self.test_group2_groupid))
+        assert resp.status_code == 200
+        assert json.loads(resp.data) == [self.test_user1_userid]
+        assert 'rel="next"' in resp.headers['Link']
+
+        # The cursor outlives the user the page ended with
+        next_url = self.next_link(resp)
+        resp = self.app.delete('/users/{}'.format(self.test_user1_userid))
+        assert resp.status_code == 200
+
+        resp = self.app.get(next_url)
+        assert resp.status_code == 200
+        assert json.loads(resp.data) == [self.test_user2_userid]
+        # The last page is full but there's nothing after it
+        assert 'Link' not in resp.headers
+
+        resp = self.app.get('/groups/{}?limit=1&after=9999'.format(
+            self.test_group2_groupid))
+        assert resp.status_code == 200
+        assert json.loads(resp.data) == []
+        assert 'Link' not in resp.headers
+
+        # Bad limit and after
+        resp = self.app.get('/groups/{}?limit=0'.format(self.test_group2_groupid))
+        assert resp.status_code == 400
+
+        resp = self.app.get('/groups/{}?after=thisisnotacursor'.format(
+            self.test_group2_groupid))
+        assert resp.status_code == 400
+
+    def test_list_group_stream(self):
+        """
+        Stream a group's members as a chunked json array
+        """
+        resp = self.app.post('/users', data=json.dumps(self.test_user1_data))
+        assert resp.status_code == 200
+
+        resp = self.app.post('/users', data=json.dumps(self.test_user2_data))
+        assert resp.status_code == 200
+
+        resp = self.app.get('/groups/{}?stream=1'.format(self.test_group2_groupid))
+        assert resp.status_code == 200
+        assert json.loads(resp.data) == [self.test_user1_userid,
+                                         self.test_user2_userid]
+
+        resp = self.app.get('/groups/{}?stream=1'.format(self.test_group1_groupid))
+        assert json.loads(resp.data) == [self.test_user1_userid]
+
+    def test_query_groups(self):
+        """
+        Tests and, or and not expressions over group memberships
+        """
+        resp = self.app.post('/users', data=json.dumps(self.test_user1_data))
+        assert resp.status_code == 200
+
+        resp = self.app.post('/users', data=json.dumps(self.test_user2_data))
+        assert resp.status_code == 200
+
+        admins, users = self.test_group1_groupid, self.test_group2_groupid
+        spiderman, deadpool = self.test_user1_userid, self.test_user2_userid
+        expected = [
+            (admins, [spiderman]),
+            ({'and': [users, admins]}, [spiderman]),
+            ({'or': [admins, users]}, [spiderman, deadpool]),
+            ({'and': [users, {'not': admins}]}, [deadpool]),
+            ({'not': admins}, [deadpool]),
+            ({'and': [{'or': [admins, users]}, {'not': users}]}, []),
+        ]
+        for expr, userids in expected:
+            resp = self.app.post('/groups/_query', data=json.dumps(expr))
+            assert resp.status_code == 200
+            assert json.loads(resp.data) == userids
+
+        # Unknown groups and malformed expressions
+        resp = self.app.post('/groups/_query',
+                             data=json.dumps({'or': [admins, 'nogroup']}))
+        assert resp.status_code == 404
+
+        for expr, field in [
+                ({'and': []}, 'and'),
+                ({'xor': [admins, users]}, None),
+                ([admins], None),
+                ({'not': admins, 'and': [users]}, None),
+                ({'or': admins}, 'or'),
+                ({'or': [admins, {'not': {'and': [users, 10]}}]},
+                 'or.1.not.and.1'),
+                ({'or': [admins] * (app.MAX_QUERY_TERMS + 1)}, None)]:
+            resp = self.app.post('/groups/_query', data=json.dumps(expr))
+            assert resp.status_code == 400
+            errors = json.loads(resp.data)['errors']
+            assert [x['field'] for x in errors] == [field]
+
+    def test_query_groups_paginated(self):
+        """
+        Page through and stream the result of a group expression
+        """
+        resp = self.app.post('/users', data=json.dumps(self.test_user1_data))
+        assert resp.status_code == 200
+
+        resp = self.app.post('/users', data=json.dumps(self.test_user2_data))
+        assert resp.status_code == 200
+
+        expr = json.dumps({'or': [self.test_group1_groupid,
+                                  self.test_group2_groupid]})
+        resp = self.app.post('/groups/_query?limit=1', data=expr)
+        assert resp.status_code == 200
+        assert json.loads(resp.data) == [self.test_user1_userid]
+        assert 'rel="next"' in resp.headers['Link']
+
+        # The cursor outlives the user the page ended with
+        next_url = self.next_link(resp)
+        new_body = dict(self.test_user1_data, userid='venom')
+        resp = self.app.put('/users/{}'.format(self.test_user1_userid),
+                            data=json.dumps(new_body))
+        assert resp.status_code == 200
+
+        resp = self.app.post(next_url, data=expr)
+        assert json.loads(resp.data) == [self.test_user2_userid]
+        assert 'Link' not in resp.headers
+
+        resp = self.app.post('/groups/_query?stream=1', data=expr)
+        assert resp.status_code == 200
+        assert json.loads(resp.data) == ['venom', self.test_user2_userid]
+
+    def test_group_expression_query_plan(self):
+        """
+        Tests that an and expression walks one group through the (groupid, userid) index
+        """
+        expr = {'and': [{'not': u'b'}, u'a', u'c']}
+        query = app.group_expression_query(expr, {u'a': 1, u'b': 2, u'c': 3},
+                                           after_id=1)
+        sql = str(query.compile(compile_kwargs={'literal_binds': True}))
+        plan = db.session.execute('EXPLAIN QUERY PLAN ' + sql).fetchall()
+        plan = ' '.join(str(tuple(x)[-1]) for x in plan)
+        assert 'ix_usergroups_groupid_userid' in plan
+        assert 'SCAN ' not in plan
+
+    def test_group_members_query_plan(self):
+        """
+        Tests that listing a group's members is answered from the (groupid, userid) index
+        """
+        query = app.group_members_query(1, after_id=1)
+        sql = str(query.compile(compile_kwargs={'literal_binds': True}))
+        plan = db.session.execute('EXPLAIN QUERY PLAN ' + sql).fetchall()
+        plan = ' '.join(str(tuple(x)[-1]) for x in plan)
+        assert 'ix_usergroups_groupid_userid' in plan
+        assert 'SCAN TABLE usergroups' not in plan
+
+    def test_modify_group_unknown_users(self):
+        """
+        Tests that replacing a group's members reports userids that don't exist
+        """
+        resp = self.app.post('/users', data=json.dumps(self.test_user1_data))
+        assert resp.status_code == 200
+
+        resp = self.app.post('/users', data=json.dumps(self.test_user2_data))
+        assert resp.status_code == 200
+
+        # Swap user1 out for user2 and ask for a user that doesn't exist
+        resp = self.app.put('/groups/{}'.format(self.test_group1_groupid),
+                            data=json.dumps([self.test_user2_userid, 'nobody']))
+        assert resp.status_code == 200
+        assert json.loads(resp.data) == [self.test_user2_userid]
+        assert json.loads(resp.headers['X-Unknown-Userids']) == ['nobody']
+
+        resp = self.app.get('/users/{}'.format(self.test_user1_userid))
+        assert self.test_group1_groupid not in json.loads(resp.data)['groups']
+
+        # Members have to be a list of userids
+        resp = self.app.put('/groups/{}'.format(self.test_group1_groupid),
+                            data=json.dumps({'users': [self.test_user2_userid]}))
+        assert resp.status_code == 400
+
+    def test_get_user_etag(self):
+        """
+        Tests conditional GETs of a user and that its ETag changes with its document
+        """
+        resp = self.app.post('/users', data=json.dumps(self.test_user1_data))
+        assert resp.status_code == 200
+        etag = resp.headers['ETag']
+
+        resp = self.app.get('/users/{}'.format(self.test_user1_userid))
+        assert resp.status_code == 200
+        assert resp.headers['ETag'] == etag
+
+        resp = self.app.get('/users/{}'.format(self.test_user1_userid),
+                            headers={'If-None-Match': etag})
+        assert resp.status_code == 304
+        assert resp.data == b''
+        assert resp.headers['ETag'] == etag
+
+        resp = self.app.get('/users/nobody', headers={'If-None-Match': etag})
+        assert resp.status_code == 404
+
+        # Taking the user out of a group changes its document
+        resp = self.app.put('/groups/{}'.format(self.test_group1_groupid),
+                            data=json.dumps([]))
+        assert resp.status_code == 200
+
+        resp = self.app.get('/users/{}'.format(self.test_user1_userid),
+                            headers={'If-None-Match': etag})
+        assert resp.status_code == 200
+        assert resp.headers['ETag'] != etag
+        assert json.loads(resp.data)['groups'] == [self.test_group2_groupid]
+
+    def test_list_group_etag(self):
+        """
+        Tests conditional GETs of a group and that its ETag changes with its members
+        """
+        resp = self.app.post('/users', data=json.dumps(self.test_user1_data))
+        assert resp.status_code == 200
+
+        resp = self.app.get('/groups/{}'.format(self.test_group2_groupid))
+        assert resp.status_code == 200
+        etag = resp.headers['ETag']
+
+        resp = self.app.get('/groups/{}'.format(self.test_group2_groupid),
+                            headers={'If-None-Match': etag})
+        assert resp.status_code == 304
+
+        # A new member changes the group's ETag, not the other group's
+        resp = self.app.get('/groups/{}'.format(self.test_group1_groupid))
+        other_etag = resp.headers['ETag']
+
+        resp = self.app.post('/users', data=json.dumps(self.test_user2_data))
+        assert resp.status_code == 200
+
+        resp = self.app.get('/groups/{}'.format(self.test_group2_groupid),
+                            headers={'If-None-Match': etag})
+        assert resp.status_code == 200
+        assert json.loads(resp.data) == [self.test_user1_userid,
+                                         self.test_user2_userid]
+
+        resp = self.app.get('/groups/{}'.format(self.test_group1_groupid),
+                            headers={'If-None-Match': other_etag})
+        assert resp.status_code == 304
+
+        # So does a member changing its userid
+        resp = self.app.get('/groups/{}'.format(self.test_group2_groupid))
+        etag = resp.headers['ETag']
+        new_body = deepcopy(self.test_user2_data)
+        new_body['userid'] = u'venom'
+        resp = self.app.put('/users/{}'.format(self.test_user2_userid),
+                            data=json.dumps(new_body))
+        assert resp.status_code == 200
+
+        resp = self.app.get('/groups/{}'.format(self.test_group2_groupid),
+                            headers={'If-None-Match': etag})
+        assert resp.status_code == 200
+
+    def test_precondition_failed_rolls_back(self):
+        """
+        Tests that a 412 rolls back what the request wrote before its check
+        """
+        group_table = app.Group.__table__
+        with app.app.test_request_context(
+                '/groups/admins', method='DELETE',
+                headers={'If-Match': '"stale"'}):
+            db.session.execute(group_table.insert(), [{'groupid': u'early'}])
+            try:
+                app.claim_version(group_table, 1, 1)
+            except HTTPException as exc:
+                resp = app.app.make_response(
+                    app.app.handle_user_exception(exc))
+            assert resp.status_code == 412
+
+            count = db.session.execute(
+                db.select([db.func.count()]).select_from(group_table))
+            assert count.scalar() == 0
+            db.session.remove()
+
+    def test_if_match(self):
+        """
+        Tests that writes with a stale If-Match ETag fail with 412
+        """
+        resp = self.app.post('/users', data=json.dumps(self.test_user1_data))
+        assert resp.status_code == 200
+        etag = resp.headers['ETag']
+
+        body = deepcopy(self.test_user1_data)
+        body['first_name'] = u'Miles'
+        resp = self.app.put('/users/{}'.format(self.test_user1_userid),
+                            data=json.dumps(body),
+                            headers={'If-Match': etag})
+        assert resp.status_code == 200
+        new_etag = resp.headers['ETag']
+        assert new_etag != etag
+
+        # A second writer holding the old ETag loses
+        body['first_name'] = u'Ben'
+        for method in (self.app.put, self.app.delete):
+            resp = method('/users/{}'.format(self.test_user1_userid),
+                          data=json.dumps(body), headers={'If-Match': etag})
+            assert resp.status_code == 412
+
+        resp = self.app.patch('/users/{}/groups'.format(self.test_user1_userid),
+                              data=json.dumps({'add': [u'villains']}),
+                              headers={'If-Match': etag})
+        assert resp.status_code == 412
+
+        resp = self.app.get('/users/{}'.format(self.test_user1_userid))
+        assert json.loads(resp.data)['first_name'] == u'Miles'
+        assert u'villains' not in json.loads(resp.data)['groups']
+
+        resp = self.app.delete('/users/{}'.format(self.test_user1_userid),
+                               headers={'If-Match': new_etag})
+        assert resp.status_code == 200
+
+        # Groups work the same way, * matches any version
+        resp = self.app.get('/groups/{}'.format(self.test_group1_groupid))
+        etag = resp.headers['ETag']
+        resp = self.app.put('/groups/{}'.format(self.test_group1_groupid),
+                            data=json.dumps([]), headers={'If-Match': '*'})
+        assert resp.status_code == 200
+        assert resp.headers['ETag'] != etag
+
+        resp = self.app.delete('/groups/{}'.format(self.test_group1_groupid),
+                               headers={'If-Match': etag})
+        assert resp.status_code == 412
+
+        resp = self.app.delete('/groups/{}'.format(self.test_group1_groupid),
+                               headers={'If-Match': '*'})
+        assert resp.status_code == 200
+
+    def test_changes(self):
+        """
+        Tests that every write is recorded in the change log in order
+        """
+        resp = self.app.get('/changes')
+        assert resp.status_code == 200
+        assert json.loads(resp.data) == {'changes': [], 'next': 0,
+                                         'latest': 0}
+
+        resp = self.app.post('/users', data=json.dumps(self.test_user1_data))
+        assert resp.status_code == 200
+
+        new_body = deepcopy(self.test_user1_data)
+        new_body['userid'] = u'venom'
+        new_body['groups'] = [self.test_group1_groupid]
+        resp = self.app.put('/users/{}'.format(self.test_user1_userid),
+                            data=json.dumps(new_body))
+        assert resp.status_code == 200
+
+        resp = self.app.delete('/groups/{}'.format(self.test_group1_groupid))
+        assert resp.status_code == 200
+
+        resp = self.app.get('/changes')
+        data = json.loads(resp.data)
+        entries = [(x['entity'], x['id'], x['op']) for x in data['changes']]
+        assert entries == [
+            # Creating the user adds it to both groups
+            ('user', self.test_user1_userid, 'put'),
+            ('group', self.test_group1_groupid, 'put'),
+            ('group', self.test_group2_groupid, 'put'),
+            # Renaming it changes the member list of both groups
+            ('user', self.test_user1_userid, 'delete'),
+            ('user', u'venom', 'put'),
+            ('group', self.test_group1_groupid, 'put'),
+            ('group', self.test_group2_groupid, 'put'),
+            ('group', self.test_group1_groupid, 'delete'),
+            ('user', u'venom', 'put'),
+        ]
+        seqs = [x['seq'] for x in data['changes']]
+        assert seqs == sorted(seqs)
+        assert data['next'] == data['latest'] == seqs[-1]
+
+        # Paging through with since and limit
+        resp = self.app.get('/changes?since={}&limit=2'.format(seqs[2]))
+        data = json.loads(resp.data)
+        assert [x['seq'] for x in data['changes']] == seqs[3:5]
+        assert data['next'] == seqs[4]
+
+        resp = self.app.get('/changes?since={}'.format(seqs[-1]))
+        assert json.loads(resp.data)['changes'] == []
+
+        for query in ('limit=0', 'since=x', 'wait=-1', 'wait=nan'):
+            resp = self.app.get('/changes?' + query)
+            assert resp.status_code == 400
+            errors = json.loads(resp.data)['errors']
+            assert [x['field'] for x in errors] == [query.split('=')[0]]
+
+    def test_changes_long_poll(self):
+        """
+        Tests that a long-poll returns as soon as something changes
+        """
+        resp = self.app.get('/changes')
+        since = json.loads(resp.data)['latest']
+
+        start = time.time()
+        resp = self.app.get('/changes?since={}&wait=0.2'.format(since))
+        assert json.loads(resp.data)['changes'] == []
+        assert time.time() - start >= 0.2
+
+        def write():
+            time.sleep(0.3)
+            app.app.test_client().post('/groups',
+                                       data=json.dumps({'name': u'late'}))
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        start = time.time()
+        resp = self.app.get('/changes?since={}&wait=10'.format(since))
+        writer.join()
+        assert time.time() - start < 5
+        changes = json.loads(resp.data)['changes']
+        assert [(x['id'], x['op']) for x in changes] == [(u'late', 'put')]
@@ -0,0 +1,74 @@
+import json
+import unittest
+import serialization
+from validation import Schema, array, record, string
+
+
+class ValidationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.schema = Schema(record({
+            'name': string(non_empty=True),
+            'tags': array(string(), non_empty=True),
+            'pairs': array(record({'a': string()}, required=['a']))
+        }, required=['name']))
+
+    def test_valid(self):
+        """
+        Tests that valid documents have no errors and unknown keys are ignored
+        """
+        assert self.schema.is_valid({'name': u'x'})
+        assert self.schema.is_valid({'name': u'x', 'tags': [u'a', u'b'],
+                                     'pairs': [{'a': u''}], 'other': 1})
+
+    def test_all_errors(self):
+        """
+        Tests that every error is reported with the path to the bad value
+        """
+        errors = self.schema.errors({'tags': [u'a', 1, None],
+                                     'pairs': [{'a': u'b'}, {}, 3]})
+        assert errors == [
+            {'field': 'name', 'message': 'is required'},
+            {'field': 'pairs.1.a', 'message': 'is required'},
+            {'field': 'pairs.2', 'message': 'must be an object'},
+            {'field': 'tags.1', 'message': 'must be a string'},
+            {'field': 'tags.2', 'message': 'must be a string'},
+        ]
+
+        errors = self.schema.errors({'name': u'', 'tags': []})
+        assert errors == [
+            {'field': 'name', 'message': 'must not be empty'},
+            {'field': 'tags', 'message': 'must not be empty'},
+        ]
+
+        assert self.schema.errors([]) == [
+            {'field': None, 'message': 'must be an object'}]
+        assert Schema(array(string())).errors({}) == [
+            {'field': None, 'message': 'must be a list'}]
+
+
+class SerializationTestCase(unittest.TestCase):
+    def test_backends(self):
+        """
+        Tests that every installed backend round trips to compact json bytes
+        """
+        doc = {'userid': u'spiderman', 'groups': [u'admins', u'\xfcsers']}
+        for name in serialization.available_backends():
+            backend = serialization.get_backend(name)
+            body = backend.dumps(doc)
+            assert isinstance(body, bytes)
+            assert b', ' not in body
+            assert json.loads(body) == doc
+            assert backend.loads(body) == doc
+            self.assertRaises(ValueError, backend.loads, b'{"userid": ')
+
+    def test_get_backend(self):
+        """
+        Tests picking a backend by name
+        """
+        expected = 'orjson' if serialization.orjson is not None else 'json'
+        assert serialization.get_backend().name == expected
+        assert serialization.get_backend('json').name == 'json'
+        self.assertRaises(ValueError, serialization.get_backend, 'yaml')
+        if serialization.orjson is None:
+            self.assertRaises(ImportError, serialization.get_backend,
+                              'orjson')
@@ -0,0 +1,130 @@
+"""
+Validators for decoded JSON request bodies.
+
+A schema is built once out of string(), array() and record() checks,
+each of which is a closure with everything it needs already bound, so
+validating a body is a straight walk over the data.  Every problem
+found is reported, not just the first, as a dict naming the field and
+what is wrong with it.
+
+    schema = Schema(record({'name': string()}, required=['name']))
+    schema.errors({'name': 1})
+    # [{'field': 'name', 'message': 'must be a string'}]
+"""
+text_type = type(u'')
+
+
+def error(path, message):
+    """
+    :param path: tuple of keys and indexes leading to the value
+    :param message: what is wrong with the value
+    :return: error dict, field is None for the body itself
+    """
+    field = '.'.join(str(x) for x in path) if path else None
+    return {'field': field, 'message': message}
+
+
+def string(non_empty=False):
+    """
+    :param non_empty: reject empty strings
+    :return: check for a string value
+    """
+    def check(value, path, errors):
+        if not isinstance(value, text_type):
+            errors.append(error(path, 'must be a string'))
+        elif non_empty and not value:
+            errors.append(error(path, 'must not be empty'))
+
+    check.any_string = not non_empty
+    return check
+
+
+def array(items, non_empty=False):
+    """
+    :param items: check run on every item
+    :param non_empty: reject empty lists
+    :return: check for a list value
+    """
+    def check(value, path, errors):
+        if not isinstance(value, list):
+            errors.append(error(path, 'must be a list'))
+            return
+
+        if non_empty and not value:
+            errors.append(error(path, 'must not be empty'))
+
+        for i, item in enumerate(value):
+            items(item, path + (i,), errors)
+
+    if getattr(items, 'any_string', False):
+        # Lists of strings are by far the most common and the longest,
+        # check them without a call per item.
+        def check_strings(value, path, errors):
+            if not isinstance(value, list):
+                errors.append(error(path, 'must be a list'))
+                return
+
+            if non_empty and not value:
+                errors.append(error(path, 'must not be empty'))
+
+            for i, item in enumerate(value):
+                if not isinstance(item, text_type):
+                    errors.append(error(path + (i,), 'must be a string'))
+
+        return check_strings
+
+    return check
+
+
+def record(fields, required=()):
+    """
+    :param fields: dict of key to the check run on its value, keys not
+                   listed are ignored
+    :param required: keys that must be present
+    :return: check for a dict value
+    """
+    required = frozenset(required)
+    compiled = [(key, fields[key], key in required) for key in sorted(fields)]
+
+    def check(value, path, errors):
+        if not isinstance(value, dict):
+            errors.append(error(path, 'must be an object'))
+            return
+
+        for key, field_check, is_required in compiled:
+            if key not in value:
+                if is_required:
+                    errors.append(error(path + (key,), 'is required'))
+                continue
+
+            field_check(value[key], path + (key,), errors)
+
+    return check
+
+
+class Schema(object):
+    """
+    Validator for one kind of request body.
+    """
+
+    def __init__(self, check):
+        """
+        :param check: check built with string(), array() or record()
+        """
+        self._check = check
+
+    def errors(self, data):
+        """
+        :param data: decoded json
+        :return: list of error dicts, empty when data is valid
+        """
+        errors = []
+        self._check(data, (), errors)
+        return errors
+
+    def is_valid(self, data):
+        """
+        :param data: decoded json
+        :return: True if data is valid, otherwise False
+        """
+        return not self.errors(data)